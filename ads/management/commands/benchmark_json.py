@@ -0,0 +1,53 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from ads.fast_serializers import serialize_ads
+from ads.models import Ad
+from contractingo.fast_json import FastJSONRenderer, fast_json_enabled, loads
+from messaging.fast_serializers import serialize_messages
+from messaging.models import Message
+
+class Command(BaseCommand):
+    help = 'Compare stdlib and orjson JSON encoding / decoding throughput on real Ad and Message payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=500, help='Ads and messages in each payload')
+        parser.add_argument('--repeat', type=int, default=50, help='Encodes / decodes of each payload')
+
+    def handle(self, *args, **options):
+        if not fast_json_enabled():
+            raise CommandError('orjson is not installed or FAST_JSON is off')
+
+        limit = options['limit']
+        payloads = {
+            'ads': {'success': True, 'data': serialize_ads(Ad.objects.values_list('id', flat=True)[:limit])},
+            'messages': serialize_messages(Message.objects.values_list('id', flat=True)[:limit]),
+        }
+
+        stdlib, fast = JSONRenderer(), FastJSONRenderer()
+        for name, payload in payloads.items():
+            stdlib_bytes = stdlib.render(payload)
+            fast_bytes = fast.render(payload)
+            same = 'identical' if stdlib_bytes == fast_bytes else 'DIFFERENT'
+            size = len(stdlib_bytes)
+
+            encode_stdlib = throughput(lambda: stdlib.render(payload), size, options['repeat'])
+            encode_fast = throughput(lambda: fast.render(payload), size, options['repeat'])
+            decode_stdlib = throughput(lambda: json.loads(stdlib_bytes), size, options['repeat'])
+            decode_fast = throughput(lambda: loads(stdlib_bytes), size, options['repeat'])
+
+            self.stdout.write(self.style.SUCCESS(f'\n=== {name}: {size} bytes, output {same} ==='))
+            self.stdout.write(f'encode: stdlib {encode_stdlib:.1f} MB/s, orjson {encode_fast:.1f} MB/s ({encode_fast / encode_stdlib:.1f}x)')
+            self.stdout.write(f'decode: stdlib {decode_stdlib:.1f} MB/s, orjson {decode_fast:.1f} MB/s ({decode_fast / decode_stdlib:.1f}x)')
+
+
+def throughput(run, size, repeat):
+    """Best-case MB/s of run over repeat runs"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return size / max(best, 1e-9) / 1e6
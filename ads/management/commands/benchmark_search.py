@@ -0,0 +1,63 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from ads.models import Ad
+from ads.search.benchmark import CorpusGenerator, QUERY_MIX, delete_corpus, run_benchmark
+
+class Command(BaseCommand):
+    help = 'Benchmark search_ads against a synthetic ad corpus (p50/p95/p99 latency, queries and rows read per search)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[10000, 100000, 1000000],
+            help='Corpus sizes (active ads) to benchmark at; the corpus is grown to each size in turn',
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Times each query of the mix is replayed')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the corpus generator')
+        parser.add_argument(
+            '--cursor',
+            action='store_true',
+            help='Benchmark cursor pagination instead of page numbers',
+        )
+        parser.add_argument(
+            '--cleanup',
+            action='store_true',
+            help='Delete the synthetic corpus when done',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            generator = CorpusGenerator(seed=options['seed'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        params = {'cursor': ''} if options['cursor'] else None
+
+        for size in sorted(options['sizes']):
+            missing = size - Ad.objects.filter(is_active=True).count()
+            if missing > 0:
+                self.stdout.write(f'Generating {missing} ads...')
+                started = time.perf_counter()
+                generator.generate(missing)
+                self.stdout.write(f'Generated in {time.perf_counter() - started:.1f}s')
+
+            results = run_benchmark(QUERY_MIX, options['repeat'], params)
+
+            self.stdout.write(self.style.SUCCESS(f'\n=== {size} ads ==='))
+            self.stdout.write(f'{"query":<32} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8} {"rows":>10} {"results":>8}')
+            for query, result in results.items():
+                self.stdout.write(
+                    f'{query:<32} {result["p50_ms"]:>8.1f} {result["p95_ms"]:>8.1f} {result["p99_ms"]:>8.1f} '
+                    f'{result["queries"]:>8} {format_optional(result["rows_read"]):>10} '
+                    f'{format_optional(result["results"]):>8}'
+                )
+
+        if options['cleanup']:
+            deleted = delete_corpus()
+            self.stdout.write(self.style.WARNING(f'Deleted {deleted} benchmark rows'))
+
+
+def format_optional(value):
+    return '-' if value is None else str(value)
@@ -0,0 +1,90 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+from ads.fast_serializers import serialize_ads
+from ads.models import Ad
+from ads.querysets import ad_list_queryset, ad_summary_queryset
+from ads.serializers import AdSerializer
+from messaging.fast_serializers import serialize_conversations, serialize_messages
+from messaging.models import Conversation, Message
+from messaging.serializers import ConversationSerializer, MessageSerializer
+
+class Command(BaseCommand):
+    help = 'Check that the fast serializers render the same JSON as the DRF serializers and time both'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=500, help='Objects of each kind to serialize')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each serializer (best is reported)')
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+        ad_ids = list(Ad.objects.values_list('id', flat=True)[:limit])
+        message_ids = list(Message.objects.values_list('id', flat=True)[:limit])
+        conversation_ids = list(Conversation.objects.values_list('id', flat=True)[:limit])
+
+        cases = [
+            (
+                'ads',
+                lambda: AdSerializer(ad_list_queryset(Ad.objects.filter(id__in=ad_ids)).order_by('id'), many=True).data,
+                lambda: serialize_ads(sorted(ad_ids)),
+            ),
+            (
+                'messages',
+                lambda: MessageSerializer(
+                    Message.objects.filter(id__in=message_ids).select_related('sender').prefetch_related('attachments').order_by('id'),
+                    many=True,
+                ).data,
+                lambda: serialize_messages(sorted(message_ids)),
+            ),
+            (
+                'conversations',
+                lambda: ConversationSerializer(
+                    Conversation.objects.filter(id__in=conversation_ids).select_related('last_message__sender').prefetch_related(
+                        'participants', 'last_message__attachments', Prefetch('ad', queryset=ad_summary_queryset())
+                    ).order_by('id'),
+                    many=True,
+                ).data,
+                lambda: serialize_conversations(sorted(conversation_ids)),
+            ),
+            (
+                'conversations with full ads',
+                lambda: ConversationSerializer(
+                    Conversation.objects.filter(id__in=conversation_ids).select_related('last_message__sender').prefetch_related(
+                        'participants', 'last_message__attachments', Prefetch('ad', queryset=ad_list_queryset())
+                    ).order_by('id'),
+                    many=True,
+                    context={'expand_ad': True},
+                ).data,
+                lambda: serialize_conversations(sorted(conversation_ids), expand_ad=True),
+            ),
+        ]
+
+        renderer = JSONRenderer()
+        failed = False
+        for name, drf, fast in cases:
+            drf_json = renderer.render(drf())
+            fast_json = renderer.render(fast())
+            if drf_json != fast_json:
+                failed = True
+                self.stdout.write(self.style.ERROR(f'{name}: fast output differs from DRF ({len(fast_json)} vs {len(drf_json)} bytes)'))
+                continue
+
+            drf_time = best_time(drf, options['repeat'])
+            fast_time = best_time(fast, options['repeat'])
+            self.stdout.write(self.style.SUCCESS(
+                f'{name}: identical ({len(drf_json)} bytes), DRF {drf_time * 1000:.1f}ms, '
+                f'fast {fast_time * 1000:.1f}ms, {drf_time / max(fast_time, 1e-9):.1f}x faster'
+            ))
+
+        if failed:
+            raise SystemExit(1)
+
+
+def best_time(serialize, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        serialize()
+        times.append(time.perf_counter() - started)
+    return min(times)
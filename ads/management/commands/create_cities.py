@@ -7,121 +7,121 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         cities_data = [
             # Ontario (20 cities)
-            {'name': 'Toronto', 'province': 'ON'},
-            {'name': 'Ottawa', 'province': 'ON'},
-            {'name': 'Mississauga', 'province': 'ON'},
-            {'name': 'Brampton', 'province': 'ON'},
-            {'name': 'Hamilton', 'province': 'ON'},
-            {'name': 'London', 'province': 'ON'},
-            {'name': 'Markham', 'province': 'ON'},
-            {'name': 'Vaughan', 'province': 'ON'},
-            {'name': 'Kitchener', 'province': 'ON'},
-            {'name': 'Windsor', 'province': 'ON'},
-            {'name': 'Richmond Hill', 'province': 'ON'},
-            {'name': 'Oakville', 'province': 'ON'},
-            {'name': 'Burlington', 'province': 'ON'},
-            {'name': 'Oshawa', 'province': 'ON'},
-            {'name': 'Barrie', 'province': 'ON'},
-            {'name': 'St. Catharines', 'province': 'ON'},
-            {'name': 'Cambridge', 'province': 'ON'},
-            {'name': 'Waterloo', 'province': 'ON'},
-            {'name': 'Guelph', 'province': 'ON'},
-            {'name': 'Kingston', 'province': 'ON'},
+            {'name': 'Toronto', 'province': 'ON', 'latitude': 43.6532, 'longitude': -79.3832},
+            {'name': 'Ottawa', 'province': 'ON', 'latitude': 45.4215, 'longitude': -75.6972},
+            {'name': 'Mississauga', 'province': 'ON', 'latitude': 43.589, 'longitude': -79.6441},
+            {'name': 'Brampton', 'province': 'ON', 'latitude': 43.7315, 'longitude': -79.7624},
+            {'name': 'Hamilton', 'province': 'ON', 'latitude': 43.2557, 'longitude': -79.8711},
+            {'name': 'London', 'province': 'ON', 'latitude': 42.9849, 'longitude': -81.2453},
+            {'name': 'Markham', 'province': 'ON', 'latitude': 43.8561, 'longitude': -79.337},
+            {'name': 'Vaughan', 'province': 'ON', 'latitude': 43.8361, 'longitude': -79.4983},
+            {'name': 'Kitchener', 'province': 'ON', 'latitude': 43.4516, 'longitude': -80.4925},
+            {'name': 'Windsor', 'province': 'ON', 'latitude': 42.3149, 'longitude': -83.0364},
+            {'name': 'Richmond Hill', 'province': 'ON', 'latitude': 43.8828, 'longitude': -79.4403},
+            {'name': 'Oakville', 'province': 'ON', 'latitude': 43.4675, 'longitude': -79.6877},
+            {'name': 'Burlington', 'province': 'ON', 'latitude': 43.3255, 'longitude': -79.799},
+            {'name': 'Oshawa', 'province': 'ON', 'latitude': 43.8971, 'longitude': -78.8658},
+            {'name': 'Barrie', 'province': 'ON', 'latitude': 44.3894, 'longitude': -79.6903},
+            {'name': 'St. Catharines', 'province': 'ON', 'latitude': 43.1594, 'longitude': -79.2469},
+            {'name': 'Cambridge', 'province': 'ON', 'latitude': 43.3616, 'longitude': -80.3144},
+            {'name': 'Waterloo', 'province': 'ON', 'latitude': 43.4643, 'longitude': -80.5204},
+            {'name': 'Guelph', 'province': 'ON', 'latitude': 43.5448, 'longitude': -80.2482},
+            {'name': 'Kingston', 'province': 'ON', 'latitude': 44.2312, 'longitude': -76.486},
             
             # Quebec (15 cities)
-            {'name': 'Montreal', 'province': 'QC'},
-            {'name': 'Quebec City', 'province': 'QC'},
-            {'name': 'Laval', 'province': 'QC'},
-            {'name': 'Gatineau', 'province': 'QC'},
-            {'name': 'Longueuil', 'province': 'QC'},
-            {'name': 'Sherbrooke', 'province': 'QC'},
-            {'name': 'Saguenay', 'province': 'QC'},
-            {'name': 'Lévis', 'province': 'QC'},
-            {'name': 'Trois-Rivières', 'province': 'QC'},
-            {'name': 'Terrebonne', 'province': 'QC'},
-            {'name': 'Saint-Jean-sur-Richelieu', 'province': 'QC'},
-            {'name': 'Repentigny', 'province': 'QC'},
-            {'name': 'Brossard', 'province': 'QC'},
-            {'name': 'Drummondville', 'province': 'QC'},
-            {'name': 'Saint-Jérôme', 'province': 'QC'},
+            {'name': 'Montreal', 'province': 'QC', 'latitude': 45.5017, 'longitude': -73.5673},
+            {'name': 'Quebec City', 'province': 'QC', 'latitude': 46.8139, 'longitude': -71.208},
+            {'name': 'Laval', 'province': 'QC', 'latitude': 45.6066, 'longitude': -73.7124},
+            {'name': 'Gatineau', 'province': 'QC', 'latitude': 45.4765, 'longitude': -75.7013},
+            {'name': 'Longueuil', 'province': 'QC', 'latitude': 45.5312, 'longitude': -73.5181},
+            {'name': 'Sherbrooke', 'province': 'QC', 'latitude': 45.4042, 'longitude': -71.8929},
+            {'name': 'Saguenay', 'province': 'QC', 'latitude': 48.428, 'longitude': -71.0686},
+            {'name': 'Lévis', 'province': 'QC', 'latitude': 46.8033, 'longitude': -71.1779},
+            {'name': 'Trois-Rivières', 'province': 'QC', 'latitude': 46.343, 'longitude': -72.543},
+            {'name': 'Terrebonne', 'province': 'QC', 'latitude': 45.7, 'longitude': -73.647},
+            {'name': 'Saint-Jean-sur-Richelieu', 'province': 'QC', 'latitude': 45.3071, 'longitude': -73.2625},
+            {'name': 'Repentigny', 'province': 'QC', 'latitude': 45.742, 'longitude': -73.45},
+            {'name': 'Brossard', 'province': 'QC', 'latitude': 45.458, 'longitude': -73.466},
+            {'name': 'Drummondville', 'province': 'QC', 'latitude': 45.8833, 'longitude': -72.4833},
+            {'name': 'Saint-Jérôme', 'province': 'QC', 'latitude': 45.78, 'longitude': -74.003},
             
             # British Columbia (15 cities)
-            {'name': 'Vancouver', 'province': 'BC'},
-            {'name': 'Surrey', 'province': 'BC'},
-            {'name': 'Burnaby', 'province': 'BC'},
-            {'name': 'Richmond', 'province': 'BC'},
-            {'name': 'Abbotsford', 'province': 'BC'},
-            {'name': 'Coquitlam', 'province': 'BC'},
-            {'name': 'Kelowna', 'province': 'BC'},
-            {'name': 'Victoria', 'province': 'BC'},
-            {'name': 'Langley', 'province': 'BC'},
-            {'name': 'Delta', 'province': 'BC'},
-            {'name': 'Kamloops', 'province': 'BC'},
-            {'name': 'Nanaimo', 'province': 'BC'},
-            {'name': 'Prince George', 'province': 'BC'},
-            {'name': 'Chilliwack', 'province': 'BC'},
-            {'name': 'Vernon', 'province': 'BC'},
+            {'name': 'Vancouver', 'province': 'BC', 'latitude': 49.2827, 'longitude': -123.1207},
+            {'name': 'Surrey', 'province': 'BC', 'latitude': 49.1913, 'longitude': -122.849},
+            {'name': 'Burnaby', 'province': 'BC', 'latitude': 49.2488, 'longitude': -122.9805},
+            {'name': 'Richmond', 'province': 'BC', 'latitude': 49.1666, 'longitude': -123.1336},
+            {'name': 'Abbotsford', 'province': 'BC', 'latitude': 49.0504, 'longitude': -122.3045},
+            {'name': 'Coquitlam', 'province': 'BC', 'latitude': 49.2838, 'longitude': -122.7932},
+            {'name': 'Kelowna', 'province': 'BC', 'latitude': 49.888, 'longitude': -119.496},
+            {'name': 'Victoria', 'province': 'BC', 'latitude': 48.4284, 'longitude': -123.3656},
+            {'name': 'Langley', 'province': 'BC', 'latitude': 49.1044, 'longitude': -122.66},
+            {'name': 'Delta', 'province': 'BC', 'latitude': 49.0847, 'longitude': -123.0586},
+            {'name': 'Kamloops', 'province': 'BC', 'latitude': 50.6745, 'longitude': -120.3273},
+            {'name': 'Nanaimo', 'province': 'BC', 'latitude': 49.1659, 'longitude': -123.9401},
+            {'name': 'Prince George', 'province': 'BC', 'latitude': 53.9171, 'longitude': -122.7497},
+            {'name': 'Chilliwack', 'province': 'BC', 'latitude': 49.1579, 'longitude': -121.9515},
+            {'name': 'Vernon', 'province': 'BC', 'latitude': 50.2671, 'longitude': -119.272},
             
             # Alberta (12 cities)
-            {'name': 'Calgary', 'province': 'AB'},
-            {'name': 'Edmonton', 'province': 'AB'},
-            {'name': 'Red Deer', 'province': 'AB'},
-            {'name': 'Lethbridge', 'province': 'AB'},
-            {'name': 'St. Albert', 'province': 'AB'},
-            {'name': 'Medicine Hat', 'province': 'AB'},
-            {'name': 'Grande Prairie', 'province': 'AB'},
-            {'name': 'Airdrie', 'province': 'AB'},
-            {'name': 'Fort McMurray', 'province': 'AB'},
-            {'name': 'Spruce Grove', 'province': 'AB'},
-            {'name': 'Leduc', 'province': 'AB'},
-            {'name': 'Okotoks', 'province': 'AB'},
+            {'name': 'Calgary', 'province': 'AB', 'latitude': 51.0447, 'longitude': -114.0719},
+            {'name': 'Edmonton', 'province': 'AB', 'latitude': 53.5461, 'longitude': -113.4938},
+            {'name': 'Red Deer', 'province': 'AB', 'latitude': 52.269, 'longitude': -113.8116},
+            {'name': 'Lethbridge', 'province': 'AB', 'latitude': 49.6935, 'longitude': -112.8418},
+            {'name': 'St. Albert', 'province': 'AB', 'latitude': 53.6305, 'longitude': -113.6256},
+            {'name': 'Medicine Hat', 'province': 'AB', 'latitude': 50.0405, 'longitude': -110.6766},
+            {'name': 'Grande Prairie', 'province': 'AB', 'latitude': 55.1707, 'longitude': -118.7947},
+            {'name': 'Airdrie', 'province': 'AB', 'latitude': 51.2917, 'longitude': -114.0144},
+            {'name': 'Fort McMurray', 'province': 'AB', 'latitude': 56.7267, 'longitude': -111.381},
+            {'name': 'Spruce Grove', 'province': 'AB', 'latitude': 53.545, 'longitude': -113.9008},
+            {'name': 'Leduc', 'province': 'AB', 'latitude': 53.2594, 'longitude': -113.5492},
+            {'name': 'Okotoks', 'province': 'AB', 'latitude': 50.7255, 'longitude': -113.9749},
             
             # Manitoba (5 cities)
-            {'name': 'Winnipeg', 'province': 'MB'},
-            {'name': 'Brandon', 'province': 'MB'},
-            {'name': 'Steinbach', 'province': 'MB'},
-            {'name': 'Thompson', 'province': 'MB'},
-            {'name': 'Portage la Prairie', 'province': 'MB'},
+            {'name': 'Winnipeg', 'province': 'MB', 'latitude': 49.8951, 'longitude': -97.1384},
+            {'name': 'Brandon', 'province': 'MB', 'latitude': 49.8485, 'longitude': -99.9501},
+            {'name': 'Steinbach', 'province': 'MB', 'latitude': 49.5258, 'longitude': -96.6839},
+            {'name': 'Thompson', 'province': 'MB', 'latitude': 55.7435, 'longitude': -97.8558},
+            {'name': 'Portage la Prairie', 'province': 'MB', 'latitude': 49.9728, 'longitude': -98.2926},
             
             # Saskatchewan (5 cities)
-            {'name': 'Saskatoon', 'province': 'SK'},
-            {'name': 'Regina', 'province': 'SK'},
-            {'name': 'Prince Albert', 'province': 'SK'},
-            {'name': 'Moose Jaw', 'province': 'SK'},
-            {'name': 'Swift Current', 'province': 'SK'},
+            {'name': 'Saskatoon', 'province': 'SK', 'latitude': 52.1332, 'longitude': -106.67},
+            {'name': 'Regina', 'province': 'SK', 'latitude': 50.4452, 'longitude': -104.6189},
+            {'name': 'Prince Albert', 'province': 'SK', 'latitude': 53.2033, 'longitude': -105.7531},
+            {'name': 'Moose Jaw', 'province': 'SK', 'latitude': 50.3934, 'longitude': -105.5519},
+            {'name': 'Swift Current', 'province': 'SK', 'latitude': 50.2881, 'longitude': -107.7939},
             
             # Nova Scotia (5 cities)
-            {'name': 'Halifax', 'province': 'NS'},
-            {'name': 'Dartmouth', 'province': 'NS'},
-            {'name': 'Sydney', 'province': 'NS'},
-            {'name': 'Truro', 'province': 'NS'},
-            {'name': 'New Glasgow', 'province': 'NS'},
+            {'name': 'Halifax', 'province': 'NS', 'latitude': 44.6488, 'longitude': -63.5752},
+            {'name': 'Dartmouth', 'province': 'NS', 'latitude': 44.6713, 'longitude': -63.5772},
+            {'name': 'Sydney', 'province': 'NS', 'latitude': 46.1368, 'longitude': -60.1942},
+            {'name': 'Truro', 'province': 'NS', 'latitude': 45.365, 'longitude': -63.2866},
+            {'name': 'New Glasgow', 'province': 'NS', 'latitude': 45.5926, 'longitude': -62.6455},
             
             # New Brunswick (5 cities)
-            {'name': 'Moncton', 'province': 'NB'},
-            {'name': 'Saint John', 'province': 'NB'},
-            {'name': 'Fredericton', 'province': 'NB'},
-            {'name': 'Dieppe', 'province': 'NB'},
-            {'name': 'Bathurst', 'province': 'NB'},
+            {'name': 'Moncton', 'province': 'NB', 'latitude': 46.0878, 'longitude': -64.7782},
+            {'name': 'Saint John', 'province': 'NB', 'latitude': 45.2733, 'longitude': -66.0633},
+            {'name': 'Fredericton', 'province': 'NB', 'latitude': 45.9636, 'longitude': -66.6431},
+            {'name': 'Dieppe', 'province': 'NB', 'latitude': 46.0784, 'longitude': -64.6873},
+            {'name': 'Bathurst', 'province': 'NB', 'latitude': 47.6186, 'longitude': -65.6513},
             
             # Newfoundland and Labrador (4 cities)
-            {'name': "St. John's", 'province': 'NL'},
-            {'name': 'Mount Pearl', 'province': 'NL'},
-            {'name': 'Corner Brook', 'province': 'NL'},
-            {'name': 'Conception Bay South', 'province': 'NL'},
+            {'name': "St. John's", 'province': 'NL', 'latitude': 47.5615, 'longitude': -52.7126},
+            {'name': 'Mount Pearl', 'province': 'NL', 'latitude': 47.5189, 'longitude': -52.8058},
+            {'name': 'Corner Brook', 'province': 'NL', 'latitude': 48.949, 'longitude': -57.9503},
+            {'name': 'Conception Bay South', 'province': 'NL', 'latitude': 47.5, 'longitude': -52.999},
             
             # Prince Edward Island (2 cities)
-            {'name': 'Charlottetown', 'province': 'PE'},
-            {'name': 'Summerside', 'province': 'PE'},
+            {'name': 'Charlottetown', 'province': 'PE', 'latitude': 46.2382, 'longitude': -63.1311},
+            {'name': 'Summerside', 'province': 'PE', 'latitude': 46.3934, 'longitude': -63.7902},
             
             # Yukon (1 city)
-            {'name': 'Whitehorse', 'province': 'YT'},
+            {'name': 'Whitehorse', 'province': 'YT', 'latitude': 60.7212, 'longitude': -135.0568},
             
             # Northwest Territories (1 city)
-            {'name': 'Yellowknife', 'province': 'NT'},
+            {'name': 'Yellowknife', 'province': 'NT', 'latitude': 62.454, 'longitude': -114.3718},
             
             # Nunavut (1 city)
-            {'name': 'Iqaluit', 'province': 'NU'},
+            {'name': 'Iqaluit', 'province': 'NU', 'latitude': 63.7467, 'longitude': -68.517},
         ]
         
         created_count = 0
@@ -134,6 +134,12 @@ class Command(BaseCommand):
                 defaults=city_data
             )
             
+            # Backfill coordinates of cities created before they were tracked
+            if not created and (city.latitude is None or city.longitude is None):
+                city.latitude = city_data['latitude']
+                city.longitude = city_data['longitude']
+                city.save(update_fields=['latitude', 'longitude'])
+
             if created:
                 created_count += 1
                 self.stdout.write(
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ads.ratings import check_rating_stats, rebuild_rating_stats
+
+class Command(BaseCommand):
+    help = 'Backfill and repair per-user rating stats from the Review table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report users whose stats do not match their reviews, without fixing them',
+        )
+
+    def handle(self, *args, **options):
+        if options['check']:
+            wrong = check_rating_stats()
+            if not wrong:
+                self.stdout.write(self.style.SUCCESS('Rating stats match the reviews'))
+                return
+            self.stdout.write(self.style.ERROR(f'{len(wrong)} users have wrong rating stats, e.g. {wrong[:10]}'))
+            raise SystemExit(1)
+
+        with transaction.atomic():
+            repaired = rebuild_rating_stats()
+        self.stdout.write(self.style.SUCCESS(f'Repaired rating stats of {len(repaired)} users'))
@@ -0,0 +1,40 @@
+import time
+from django.core.management.base import BaseCommand
+from ads.search.index import ad_index
+
+class Command(BaseCommand):
+    help = 'Rebuild the in-process ad search index and check that it matches the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Verify the index against the database after rebuilding it',
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        ad_index.build()
+        elapsed = time.perf_counter() - started
+
+        stats = ad_index.stats()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Indexed {stats["ads"]} ads, {stats["tokens"]} tokens, '
+                f'{stats["postings"]} postings in {elapsed:.2f}s'
+            )
+        )
+
+        if not options['check']:
+            return
+
+        problems = ad_index.verify()
+        if not problems:
+            self.stdout.write(self.style.SUCCESS('Search index matches the database'))
+            return
+
+        for name, detail in problems.items():
+            if isinstance(detail, list):
+                detail = f'{len(detail)} ads, e.g. {detail[:10]}'
+            self.stdout.write(self.style.ERROR(f'{name}: {detail}'))
+        raise SystemExit(1)
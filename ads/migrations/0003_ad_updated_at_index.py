@@ -0,0 +1,19 @@
+# Generated by Django 5.2.2 on 2026-10-17 16:19
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0002_city'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(fields=['updated_at'], name='ads_ad_updated_e77b11_idx'),
+        ),
+    ]
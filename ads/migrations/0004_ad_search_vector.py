@@ -0,0 +1,48 @@
+# Generated by Django 5.2.2 on 2026-10-17 16:21
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # GIN indexes and tsvectors only exist on PostgreSQL, other databases (SQLite in tests) just keep the empty column
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    from django.contrib.postgres.search import SearchVector
+
+    config = getattr(settings, 'ADS_SEARCH_FTS_CONFIG', 'english')
+    Ad = apps.get_model('ads', 'Ad')
+    Ad.objects.update(search_vector=(
+        SearchVector('title', weight='A', config=config)
+        + SearchVector('tags', weight='B', config=config)
+        + SearchVector('skills', weight='B', config=config)
+        + SearchVector('description', weight='C', config=config)
+        + SearchVector('location', weight='D', config=config)
+    ))
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS ads_ad_search_vector_gin ON ads_ad USING gin (search_vector)'
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS ads_ad_search_vector_gin')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0003_ad_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.2 on 2026-10-17 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0004_ad_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.2 on 2026-10-17 16:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_rating_stats(apps, schema_editor):
+    Review = apps.get_model('ads', 'Review')
+    UserRatingStats = apps.get_model('ads', 'UserRatingStats')
+
+    rows = Review.objects.order_by().values('reviewee_id').annotate(
+        rating_count=Count('id'),
+        rating_sum=Sum('rating'),
+        **{f'rating_{rating}_count': Count('id', filter=Q(rating=rating)) for rating in range(1, 6)},
+    )
+    UserRatingStats.objects.bulk_create(
+        [UserRatingStats(user_id=row.pop('reviewee_id'), **row) for row in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0005_city_coordinates'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRatingStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.PositiveIntegerField(default=0)),
+                ('rating_1_count', models.PositiveIntegerField(default=0)),
+                ('rating_2_count', models.PositiveIntegerField(default=0)),
+                ('rating_3_count', models.PositiveIntegerField(default=0)),
+                ('rating_4_count', models.PositiveIntegerField(default=0)),
+                ('rating_5_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'User rating stats',
+            },
+        ),
+        migrations.RunPython(backfill_rating_stats, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import connection, models
+from django.contrib.postgres.search import SearchVectorField
 from supabase_auth.models import User
 
 class AdType(models.Model):
@@ -11,6 +12,8 @@ class AdType(models.Model):
 class City(models.Model):
     name = models.CharField(max_length=100)
     province = models.CharField(max_length=2, help_text="Two-letter province/territory code (e.g., ON, BC, QC)")
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
     
     class Meta:
         ordering = ['name']
@@ -20,6 +23,9 @@ class City(models.Model):
     def __str__(self):
         return f"{self.name}, {self.province}"
 
+# Columns that feed Ad.search_vector (see ads.search.backends.ad_search_vector)
+SEARCH_VECTOR_FIELDS = ('title', 'tags', 'skills', 'description', 'location')
+
 class Ad(models.Model):
 
     # Ad fields
@@ -34,6 +40,8 @@ class Ad(models.Model):
     location = models.CharField(max_length=200, blank=True, help_text="City / General Area")
     tags = models.CharField(max_length = 200, blank=True, help_text="Comma-separated tags like: wedding (for photography), blog (for website)")
     skills = models.CharField(max_length = 200, blank=True, help_text="Comma-separated skills like: Photoshop, Django, etc.")
+    # Weighted tsvector for the postgres search backend (see ads/search/backends.py), GIN indexed on PostgreSQL only
+    search_vector = SearchVectorField(null=True, editable=False)
 
     # User relationship
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ads')
@@ -49,9 +57,27 @@ class Ad(models.Model):
             models.Index(fields=['tags']),
             models.Index(fields=['location']),
             models.Index(fields=['ad_type']),
-            models.Index(fields=['is_available_now'])
+            models.Index(fields=['is_available_now']),
+            # Lets the search index catch up on ads changed by other workers
+            models.Index(fields=['updated_at']),
         ]
     
+    def save(self, *args, **kwargs):
+        # The postgres search backend's tsvector is written in the same statement as the row
+        update_fields = kwargs.get('update_fields')
+        write_vector = connection.vendor == 'postgresql' and (
+            update_fields is None or not set(update_fields).isdisjoint(SEARCH_VECTOR_FIELDS)
+        )
+        if write_vector:
+            from .search.backends import ad_search_vector
+            self.search_vector = ad_search_vector(self)
+            if update_fields is not None:
+                kwargs['update_fields'] = [*update_fields, 'search_vector']
+        super().save(*args, **kwargs)
+        if write_vector:
+            # Holds the expression now, reloaded from the database if it's ever read
+            del self.search_vector
+
     def __str__(self):
         return f"{self.title} by {self.user.name}"
 
@@ -120,3 +146,34 @@ class Review(models.Model):
 
 
     
+
+class UserRatingStats(models.Model):
+    """Running totals of the reviews a user received, kept up to date by ads/ratings.py"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='rating_stats')
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+
+    # Histogram: number of 1 to 5 star reviews
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'User rating stats'
+
+    @property
+    def average_rating(self):
+        if not self.rating_count:
+            return None
+        return round(self.rating_sum / self.rating_count, 1)
+
+    @property
+    def histogram(self):
+        return {rating: getattr(self, f'rating_{rating}_count') for rating in range(1, 6)}
+
+    def __str__(self):
+        return f"{self.user_id}: {self.rating_count} reviews, average {self.average_rating}"
@@ -0,0 +1,97 @@
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+
+from .models import Ad, AdRequest, Photo
+
+"""
+AD LIST QUERYSETS:
+
+    AdSerializer shows each ad's pending request count, its owner's name and average rating and its photos.
+    Loaded lazily that is 4+ queries per ad, so a 20 ad page cost 80+ queries. ad_list_queryset loads all
+    of it with the ads instead:
+        - pending_requests_count is a correlated subquery, computed in the same SELECT as the ads (a subquery
+          rather than JOIN + GROUP BY so it composes with the search relevance annotation and ordering)
+        - the owner and their rating stats row (see ratings.py) are joined with select_related, photos come
+          from one prefetch query for the whole page
+    AdSerializer reads the annotation when it is present and falls back to per-ad queries otherwise.
+
+    Conversations embed a compact summary of their ad instead (id, title, first photo, see AdSummarySerializer),
+    loaded by ad_summary_queryset with the first photo as a subquery, so one query covers a whole inbox page.
+
+    List endpoints also take a sparse fieldset (?fields=title,cost or ?omit=description,photos). Skipped fields
+    are left out of only(), and their joins, prefetches and subqueries aren't added at all.
+"""
+
+
+def pending_requests_count():
+    """Subquery counting the pending requests of the outer ad"""
+    pending_requests = AdRequest.objects.filter(
+        ad=OuterRef('pk'), status='pending'
+    ).order_by().values('ad').annotate(count=Count('id')).values('count')
+    return Subquery(pending_requests, output_field=IntegerField())
+
+
+def first_photo_url():
+    """Subquery getting the image url of the outer ad's first photo"""
+    first_photo = Photo.objects.filter(ad=OuterRef('pk')).order_by('order', 'uploaded_at', 'id').values('image_url')[:1]
+    return Subquery(first_photo)
+
+
+def ad_summary_queryset(ads=None):
+    """Load only what AdSummarySerializer shows"""
+    if ads is None:
+        ads = Ad.objects.all()
+    return ads.only('id', 'title').annotate(first_photo_url=first_photo_url())
+
+
+# AdSerializer field -> model fields it reads (photos and requests_count come from a prefetch and a subquery)
+AD_FIELD_COLUMNS = {
+    'id': ('id',),
+    'title': ('title',),
+    'description': ('description',),
+    'is_available_now': ('is_available_now',),
+    'ad_type': ('ad_type',),
+    'user': ('user',),
+    'user_name': ('user', 'user__name'),
+    'photos': (),
+    'location': ('location',),
+    'tags': ('tags',),
+    'skills': ('skills',),
+    'created_at': ('created_at',),
+    'updated_at': ('updated_at',),
+    'is_active': ('is_active',),
+    'cost': ('cost',),
+    'requests_count': (),
+    'user_average_rating': ('user', 'user__rating_stats__rating_count', 'user__rating_stats__rating_sum'),
+}
+
+
+def ad_list_queryset(ads=None, fields=None):
+    """
+    Annotate and preload an Ad queryset so serializing a list of it costs a constant number of queries.
+    With fields (a sparse fieldset of AdSerializer fields) only what those fields need is loaded
+    """
+    if ads is None:
+        ads = Ad.objects.all()
+    if fields is None:
+        fields = AD_FIELD_COLUMNS
+
+    related = []
+    if 'user_name' in fields or 'user_average_rating' in fields:
+        related.append('user')
+    if 'user_average_rating' in fields:
+        related.append('user__rating_stats')
+    if related:
+        ads = ads.select_related(*related)
+
+    if 'photos' in fields:
+        ads = ads.prefetch_related('photos')
+    if 'requests_count' in fields:
+        ads = ads.annotate(pending_requests_count=pending_requests_count())
+
+    if fields is not AD_FIELD_COLUMNS:
+        # created_at is kept for cursor pagination, which reads it from the last ad of the page
+        columns = {'id', 'created_at'}
+        for field in fields:
+            columns.update(AD_FIELD_COLUMNS[field])
+        ads = ads.only(*columns)
+    return ads
@@ -0,0 +1,112 @@
+from django.db.models import Count, F, Q, Sum
+
+from .models import Review, UserRatingStats
+
+"""
+USER RATING STATS:
+
+    Every serialized ad and user profile showed an average rating aggregated over the whole Review table.
+    UserRatingStats keeps one row of running totals per reviewed user (count, sum, 1-5 star histogram) instead,
+    so reading a rating is a single row lookup:
+        - Review create / delete signals (see ads/signals.py) add or subtract the review in the same transaction,
+          with F() expressions so concurrent reviews of the same user don't lose updates
+        - Edited reviews recompute their reviewee's row from scratch
+        - rebuild_rating_stats (management command) backfills the table and repairs drifted rows
+"""
+
+RATINGS = range(1, 6)
+
+
+def user_average_rating(user):
+    """Get a user's average rating from their stats row, None if they have no reviews"""
+    try:
+        return user.rating_stats.average_rating
+    except UserRatingStats.DoesNotExist:
+        return None
+
+
+def histogram_field(rating):
+    """Get the histogram field counting a rating, or None for ratings outside 1-5"""
+    try:
+        rating = int(rating)
+    except (TypeError, ValueError):
+        return None
+    return f'rating_{rating}_count' if rating in RATINGS else None
+
+
+def _apply_review(reviewee_id, rating, sign):
+    updates = {
+        'rating_count': F('rating_count') + sign,
+        'rating_sum': F('rating_sum') + sign * int(rating),
+    }
+    field = histogram_field(rating)
+    if field:
+        updates[field] = F(field) + sign
+    return UserRatingStats.objects.filter(user_id=reviewee_id).update(**updates)
+
+
+def record_review(review):
+    """Add a new review to its reviewee's stats"""
+    UserRatingStats.objects.get_or_create(user_id=review.reviewee_id)
+    _apply_review(review.reviewee_id, review.rating, 1)
+
+
+def forget_review(review):
+    """Remove a deleted review from its reviewee's stats"""
+    _apply_review(review.reviewee_id, review.rating, -1)
+
+
+def expected_rating_stats(user_ids=None):
+    """Get {user id: field values} of the stats computed from the Review table"""
+    reviews = Review.objects.order_by()
+    if user_ids is not None:
+        reviews = reviews.filter(reviewee_id__in=user_ids)
+
+    rows = reviews.values('reviewee_id').annotate(
+        rating_count=Count('id'),
+        rating_sum=Sum('rating'),
+        **{f'rating_{rating}_count': Count('id', filter=Q(rating=rating)) for rating in RATINGS},
+    )
+    return {row.pop('reviewee_id'): row for row in rows}
+
+
+def stored_rating_stats(user_ids=None):
+    """Get {user id: field values} of the stored stats, ignoring rows left empty by deleted reviews"""
+    stored = UserRatingStats.objects.filter(rating_count__gt=0)
+    if user_ids is not None:
+        stored = stored.filter(user_id__in=user_ids)
+    return {
+        row.pop('user_id'): row
+        for row in stored.values('user_id', 'rating_count', 'rating_sum', *(f'rating_{r}_count' for r in RATINGS))
+    }
+
+
+def check_rating_stats(user_ids=None):
+    """Get the ids of users whose stored stats don't match their reviews"""
+    expected = expected_rating_stats(user_ids)
+    stored = stored_rating_stats(user_ids)
+    return sorted(user_id for user_id in set(expected) | set(stored) if expected.get(user_id) != stored.get(user_id))
+
+
+def rebuild_rating_stats(user_ids=None):
+    """
+    Recompute stats from the Review table, for every user or only user_ids.
+    Returns the ids of the users whose stored stats were wrong or missing
+    """
+    expected = expected_rating_stats(user_ids)
+    stored = stored_rating_stats(user_ids)
+    wrong = sorted(user_id for user_id in set(expected) | set(stored) if expected.get(user_id) != stored.get(user_id))
+
+    # Users without reviews anymore don't need a row
+    UserRatingStats.objects.filter(user_id__in=[user_id for user_id in wrong if user_id not in expected]).delete()
+
+    repaired = [UserRatingStats(user_id=user_id, **expected[user_id]) for user_id in wrong if user_id in expected]
+    if repaired:
+        UserRatingStats.objects.bulk_create(
+            repaired,
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['rating_count', 'rating_sum', *(f'rating_{r}_count' for r in RATINGS)],
+            batch_size=1000,
+        )
+    return wrong
@@ -0,0 +1,199 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Q, Case, When, IntegerField, FloatField, Value, F
+
+from ads.models import Ad
+from .index import ad_index
+from .keywords import get_search_keywords
+
+"""
+SEARCH BACKENDS:
+
+    index (default):
+        - The in-process inverted index (index.py) narrows the candidates, then icontains clauses filter
+          them exactly and a hand-built Case/When expression scores them
+        - Works on any database
+
+    postgres:
+        - Ad.search_vector holds a stored tsvector (title, tags, skills, description, location) with a GIN index,
+          written by Ad.save in the same INSERT / UPDATE as the row
+        - Matching uses the tsvector @@ tsquery operator and ordering uses ts_rank, both answered from the index.
+          Service type and location matches (including ads only found by a radius search) add fixed boosts on
+          top, in the same order as the index backend's scores
+        - Only available on PostgreSQL, on other databases (e.g. SQLite in tests) search falls back to the index backend
+
+    Picked with the ADS_SEARCH_BACKEND setting.
+"""
+
+INDEX_BACKEND = 'index'
+POSTGRES_BACKEND = 'postgres'
+
+
+def get_search_backend():
+    """Get the configured search backend, falling back to the index backend when the database can't do full-text search"""
+    backend = getattr(settings, 'ADS_SEARCH_BACKEND', INDEX_BACKEND)
+    if backend == POSTGRES_BACKEND and connection.vendor != 'postgresql':
+        return INDEX_BACKEND
+    return backend
+
+
+def ad_search_vector(ad=None):
+    """
+    Weighted tsvector expression stored in Ad.search_vector, over the row's own columns (for queryset updates),
+    or over the field values of ad, which an INSERT can use too
+    """
+    config = settings.ADS_SEARCH_FTS_CONFIG
+
+    def field(name):
+        return name if ad is None else Value(getattr(ad, name) or '')
+
+    return (
+        SearchVector(field('title'), weight='A', config=config)
+        + SearchVector(field('tags'), weight='B', config=config)
+        + SearchVector(field('skills'), weight='B', config=config)
+        + SearchVector(field('description'), weight='C', config=config)
+        + SearchVector(field('location'), weight='D', config=config)
+    )
+
+
+def nearby_ad_ids(city_id, km):
+    """Get ids of ads located within km of a city, or None when the city has no coordinates"""
+    city_grid = get_search_keywords().city_grid
+    if not city_grid.has_coordinates(city_id):
+        return None
+    return ad_index.city_matches(city_grid.within(city_id, km))
+
+
+def search_queryset(query, service_type_ids, location_keywords, location_ad_ids=None):
+    """
+    Get active ads matching a search query, annotated with relevance and ordered best first.
+    service_type_ids are the ids of ad types named in the query, location_keywords the place named in it (if any)
+    and location_ad_ids the ads around that place when the query asked for "near <city>"
+    """
+    if get_search_backend() == POSTGRES_BACKEND:
+        ads = postgres_search(query, service_type_ids, location_keywords, location_ad_ids)
+    else:
+        ads = index_search(query, service_type_ids, location_keywords, location_ad_ids)
+    # The tsvector is only needed inside the database
+    return ads.defer('search_vector')
+
+
+def location_filter(location_keywords, location_ad_ids):
+    """Ads in the named place: location text match, plus the ads around it for radius searches"""
+    location_q = Q(location__icontains=location_keywords)
+    if location_ad_ids:
+        location_q |= Q(id__in=location_ad_ids)
+    return location_q
+
+
+def index_search(query, service_type_ids, location_keywords, location_ad_ids=None):
+    ads = Ad.objects.filter(is_active=True)
+
+    # Narrow down to the ads the inverted index says can match, instead of scanning the whole table
+    candidate_ids = ad_index.candidates(query, service_type_ids, location_keywords)
+    if candidate_ids is not None:
+        if location_ad_ids:
+            candidate_ids = candidate_ids | location_ad_ids
+        ads = ads.filter(id__in=candidate_ids)
+
+    relevance_score = Case(
+        # Exact title match: 10 points
+        When(title__iexact=query, then=Value(10)),
+        # Partial title match: +5 points
+        When(title__icontains=query, then=Value(5)),
+        default=Value(0),
+        output_field=IntegerField()
+    )
+
+    # Add ad type score
+    if service_type_ids:
+        relevance_score = relevance_score + Case(
+            When(ad_type_id__in=service_type_ids, then=Value(8)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+
+    # Add location score
+    if location_keywords:
+        relevance_score = relevance_score + Case(
+            When(location_filter(location_keywords, location_ad_ids), then=Value(7)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+
+    # Add description/tags/skills score
+    relevance_score = relevance_score + Case(
+        When(description__icontains=query, then=Value(3)),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+    relevance_score = relevance_score + Case(
+        When(tags__icontains=query, then=Value(3)),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+    relevance_score = relevance_score + Case(
+        When(skills__icontains=query, then=Value(3)),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+    # Build final query with OR conditions
+    q_objects = Q(title__icontains=query) | Q(description__icontains=query)
+
+    if service_type_ids:
+        q_objects |= Q(ad_type_id__in=service_type_ids)
+
+    if location_keywords:
+        q_objects |= location_filter(location_keywords, location_ad_ids)
+
+    q_objects |= Q(tags__icontains=query) | Q(skills__icontains=query)
+
+    return ads.filter(q_objects).annotate(
+        relevance=relevance_score
+    ).order_by('-relevance', '-created_at', '-id')
+
+
+def postgres_search(query, service_type_ids, location_keywords, location_ad_ids=None):
+    config = settings.ADS_SEARCH_FTS_CONFIG
+    text_query = SearchQuery(query, search_type='websearch', config=config)
+
+    # Every clause is answered from an index (GIN on search_vector, btree on ad_type) so Postgres can BitmapOr them
+    ranked_query = text_query
+    q_objects = Q(search_vector=text_query)
+
+    location_q = Q()
+    if location_keywords:
+        location_query = SearchQuery(location_keywords, search_type='plain', config=config)
+        ranked_query = ranked_query | location_query
+        location_q = Q(search_vector=location_query)
+    if location_ad_ids:
+        location_q |= Q(id__in=location_ad_ids)
+
+    relevance_score = SearchRank(F('search_vector'), ranked_query)
+
+    if service_type_ids:
+        q_objects |= Q(ad_type_id__in=service_type_ids)
+        # Matching the requested service outweighs any text rank (ts_rank stays below 1)
+        relevance_score = relevance_score + Case(
+            When(ad_type_id__in=service_type_ids, then=Value(1.0)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+
+    if location_q:
+        q_objects |= location_q
+        # Being in the named place comes right after the service (8 vs 7 in the index backend). Ads only found
+        # by a radius search have no text rank at all, this keeps them ahead of weak text matches
+        relevance_score = relevance_score + Case(
+            When(location_q, then=Value(0.9)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+
+    return Ad.objects.filter(is_active=True).filter(q_objects).annotate(
+        relevance=relevance_score
+    ).order_by('-relevance', '-created_at', '-id')
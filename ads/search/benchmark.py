@@ -0,0 +1,249 @@
+import random
+import statistics
+import time
+
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from ads.models import Ad, AdType, City, Photo, AdRequest, Review
+from ads.ratings import rebuild_rating_stats
+from supabase_auth.models import User
+from .backends import ad_search_vector
+from .cache import search_cache
+from .index import ad_index
+
+"""
+SEARCH BENCHMARK:
+
+    Corpus:
+        - Synthetic users (uid "bench-<n>") own ads spread over every seeded AdType and City, with photos,
+          requests and reviews so serialization does the same work as in production
+        - Ad text is drawn from a per-service vocabulary plus a shared one, with Zipf-like word frequencies
+          (a few words are in most ads, most words are rare), which is what makes posting lists uneven
+        - Everything is bulk inserted, signals don't fire, so the search index is rebuilt (and on PostgreSQL
+          the search vectors recomputed) once at the end, as are the owners' rating stats
+    Run:
+        - A fixed query mix (single words, service + city, "near", misspellings, no-match) is replayed against
+          the search_ads view in-process, with the result cache cleared before each request
+        - Reports p50/p95/p99 latency, queries per request and, on PostgreSQL, rows read from the ads table
+          (pg_stat_get_xact_tuples_returned / fetched inside the request's transaction)
+"""
+
+BENCH_UID_PREFIX = 'bench-'
+
+SERVICE_WORDS = {
+    'mechanic': ['brakes', 'oil', 'tires', 'engine', 'transmission', 'diagnostic', 'alignment', 'battery'],
+    'plumber': ['leak', 'drain', 'pipes', 'faucet', 'toilet', 'water', 'heater', 'sump', 'pump'],
+    'electrician': ['wiring', 'panel', 'outlet', 'lighting', 'breaker', 'install', 'ev', 'charger'],
+    'carpenter': ['deck', 'cabinets', 'framing', 'trim', 'furniture', 'stairs', 'custom', 'woodwork'],
+    'photographer': ['wedding', 'portrait', 'event', 'headshots', 'family', 'photoshop', 'lightroom', 'drone'],
+    'snow removal': ['driveway', 'plowing', 'salting', 'shovelling', 'winter', 'sidewalk', 'seasonal'],
+    'landscaper': ['lawn', 'garden', 'sod', 'mowing', 'hedge', 'trimming', 'patio', 'interlock'],
+    'moving services': ['movers', 'truck', 'packing', 'furniture', 'piano', 'storage', 'apartment'],
+}
+COMMON_WORDS = [
+    'professional', 'experienced', 'reliable', 'affordable', 'licensed', 'insured', 'fast', 'quality',
+    'service', 'residential', 'commercial', 'repair', 'emergency', 'same', 'day', 'free', 'estimate',
+    'years', 'local', 'certified', 'friendly', 'guaranteed', 'weekend', 'available', 'small', 'jobs',
+]
+GENERIC_SERVICE_WORDS = ['repair', 'install', 'maintenance', 'consultation', 'cleanup', 'inspection']
+
+QUERY_MIX = [
+    'plumber',
+    'wedding photographer',
+    'plumber in toronto',
+    'electrician near mississauga',
+    'emergency drain repair',
+    'snow removal ottawa',
+    'lawn mowing near burlington',
+    'affordable movers',
+    'plumbr',
+    'photgrapher near vancouver',
+    'custom deck builder',
+    'xyzzy nothing matches',
+]
+
+
+def zipf_weights(count, exponent=1.1):
+    """Weights 1/rank^exponent, so the first words are much more frequent than the last"""
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class CorpusGenerator:
+    """Bulk inserts a synthetic corpus of users, ads, photos, requests and reviews"""
+
+    def __init__(self, seed=0, batch_size=2000):
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.ad_types = list(AdType.objects.all())
+        self.cities = list(City.objects.all())
+        if not self.ad_types or not self.cities:
+            raise ValueError('Seed ad types and cities first (create_ad_types, create_cities)')
+        self.common_weights = zipf_weights(len(COMMON_WORDS))
+
+    def service_words(self, ad_type):
+        return SERVICE_WORDS.get(ad_type.name.lower(), GENERIC_SERVICE_WORDS)
+
+    def words(self, vocabulary, count):
+        return self.random.choices(vocabulary, weights=zipf_weights(len(vocabulary)), k=count)
+
+    def make_users(self, count):
+        start = User.objects.filter(uid__startswith=BENCH_UID_PREFIX).count()
+        users = [
+            User(uid=f'{BENCH_UID_PREFIX}{n}', email=f'{BENCH_UID_PREFIX}{n}@example.com', name=f'Bench User {n}')
+            for n in range(start, start + count)
+        ]
+        User.objects.bulk_create(users, batch_size=self.batch_size)
+        return list(User.objects.filter(uid__startswith=BENCH_UID_PREFIX).only('id'))
+
+    def make_ad(self, user):
+        ad_type = self.random.choice(self.ad_types)
+        city = self.random.choice(self.cities)
+        service = self.service_words(ad_type)
+        title_words = self.words(service, 2) + self.random.choices(COMMON_WORDS, weights=self.common_weights, k=1)
+        description_words = (
+            self.words(service, 8)
+            + self.random.choices(COMMON_WORDS, weights=self.common_weights, k=20)
+        )
+        self.random.shuffle(description_words)
+        return Ad(
+            title=f'{ad_type.name} - {" ".join(title_words).capitalize()}',
+            description=' '.join(description_words),
+            is_available_now=self.random.random() < 0.3,
+            ad_type=ad_type,
+            cost=f'${self.random.randint(20, 200)}/hr',
+            location=f'{city.name}, {city.province}',
+            tags=', '.join(sorted(set(self.words(service, 3)))),
+            skills=', '.join(sorted(set(self.words(service, 2)))),
+            user=user,
+        )
+
+    def generate(self, ad_count, users_per_ad=0.2, photos_per_ad=1.5, requests_per_ad=0.5, review_rate=0.3):
+        """Add ad_count ads (and their users, photos, requests, reviews) to the database"""
+        users = self.make_users(max(1, int(ad_count * users_per_ad)))
+
+        for start in range(0, ad_count, self.batch_size):
+            size = min(self.batch_size, ad_count - start)
+            with transaction.atomic():
+                ads = Ad.objects.bulk_create([self.make_ad(self.random.choice(users)) for _ in range(size)])
+
+                photos = []
+                for ad in ads:
+                    for order in range(int(self.random.expovariate(1 / photos_per_ad))):
+                        photos.append(Photo(ad=ad, image_url=f'https://example.com/bench/{ad.id}/{order}.jpg', order=order))
+                Photo.objects.bulk_create(photos, batch_size=self.batch_size)
+
+                requests = []
+                for ad in ads:
+                    requesters = {self.random.choice(users).id for _ in range(int(self.random.expovariate(1 / requests_per_ad)))}
+                    requesters.discard(ad.user_id)
+                    for requester_id in requesters:
+                        completed = self.random.random() < review_rate
+                        requests.append(AdRequest(
+                            ad=ad,
+                            requester_id=requester_id,
+                            status='completed' if completed else 'pending',
+                            owner_confirmed_completion=completed,
+                            requester_confirmed_completion=completed,
+                        ))
+                AdRequest.objects.bulk_create(requests, batch_size=self.batch_size)
+
+                reviews = [
+                    Review(
+                        ad_request=ad_request,
+                        reviewer_id=ad_request.requester_id,
+                        reviewee_id=ad_request.ad.user_id,
+                        rating=self.random.choices([1, 2, 3, 4, 5], weights=[1, 1, 3, 8, 12])[0],
+                    )
+                    for ad_request in requests if ad_request.status == 'completed'
+                ]
+                Review.objects.bulk_create(reviews, batch_size=self.batch_size)
+
+        # bulk_create skips the signals that keep search data and rating stats up to date
+        rebuild_rating_stats()
+        if connection.vendor == 'postgresql':
+            Ad.objects.filter(search_vector__isnull=True).update(search_vector=ad_search_vector())
+        ad_index.build()
+
+
+def delete_corpus():
+    """Delete every benchmark user, and with them their ads, photos, requests and reviews"""
+    deleted, _ = User.objects.filter(uid__startswith=BENCH_UID_PREFIX).delete()
+    ad_index.build()
+    return deleted
+
+
+def ads_rows_read():
+    """Rows of the ads table read so far in the current transaction (PostgreSQL only)"""
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_stat_get_xact_tuples_returned(%s::regclass) + pg_stat_get_xact_tuples_fetched(%s::regclass)',
+            [Ad._meta.db_table, Ad._meta.db_table],
+        )
+        return cursor.fetchone()[0]
+
+
+def run_benchmark(queries=QUERY_MIX, repeat=5, params=None):
+    """
+    Replay queries against search_ads and measure them.
+    Returns {query: {p50_ms, p95_ms, p99_ms, queries, rows_read}} plus an 'overall' entry
+    """
+    from ads.views import search_ads
+
+    factory = RequestFactory()
+    ad_index.ensure_ready()
+    results = {}
+    all_latencies = []
+
+    for query in queries:
+        latencies, query_counts, rows = [], [], []
+        for _ in range(repeat):
+            search_cache.clear()
+            request = factory.get('/api/ads/search/', {'q': query, **(params or {})})
+
+            with transaction.atomic():
+                rows_before = ads_rows_read()
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = search_ads(request)
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                rows_after = ads_rows_read()
+
+            if response.status_code != 200:
+                raise RuntimeError(f'search_ads returned {response.status_code} for {query!r}: {response.data}')
+            latencies.append(elapsed_ms)
+            query_counts.append(len(captured.captured_queries))
+            if rows_before is not None:
+                rows.append(rows_after - rows_before)
+
+        all_latencies.extend(latencies)
+        results[query] = {
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'queries': max(query_counts),
+            'rows_read': statistics.median(rows) if rows else None,
+            'results': response.data.get('total', len(response.data['data'])),
+        }
+
+    results['overall'] = {
+        'p50_ms': percentile(all_latencies, 0.50),
+        'p95_ms': percentile(all_latencies, 0.95),
+        'p99_ms': percentile(all_latencies, 0.99),
+        'queries': max(result['queries'] for result in results.values()),
+        'rows_read': None,
+        'results': None,
+    }
+    return results
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+"""
+SEARCH RESULT CACHE:
+
+    Popular queries ("plumber in toronto") return the same page thousands of times an hour.
+    The cache keeps recent search responses per process:
+        - Keyed by the normalized query (lowercase, single spaces) plus the page/cursor and limit
+        - Stores the ordered ad ids of the page and the serialized response
+        - LRU: a hit moves the entry to the end, when full the least recently used entry is dropped
+        - Invalidated by generation: any Ad, AdType or Photo write bumps the generation (see ads/signals.py)
+          and entries from an older generation count as misses. A request reads the generation before it reads
+          the database and stores its result under that generation, so a result computed before a write is never
+          stored as current
+        - Entries also expire after ADS_SEARCH_CACHE_TTL_SECONDS, which covers data the generation doesn't track
+          (request counts, ratings) and writes made by other workers
+"""
+
+
+def normalize_query(query):
+    """Lowercase a query and collapse its whitespace"""
+    return ' '.join(query.lower().split())
+
+
+class SearchCacheEntry:
+    def __init__(self, generation, expires_at, ad_ids, response_data):
+        self.generation = generation
+        self.expires_at = expires_at
+        self.ad_ids = ad_ids
+        self.response_data = response_data
+
+
+class SearchResultCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_sets = 0
+
+    def get(self, key):
+        """Get the cached response data for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry.generation != self._generation or entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.response_data
+
+    @property
+    def generation(self):
+        """The current generation, read before computing a result to set()"""
+        with self._lock:
+            return self._generation
+
+    def set(self, key, ad_ids, response_data, generation):
+        """Store a result computed from the database as of generation, unless it has been invalidated since"""
+        max_entries = getattr(settings, 'ADS_SEARCH_CACHE_MAX_ENTRIES', 1000)
+        if max_entries <= 0:
+            return
+        ttl = getattr(settings, 'ADS_SEARCH_CACHE_TTL_SECONDS', 30)
+
+        with self._lock:
+            if generation != self._generation:
+                # Written to since the result was read, it may be stale
+                self.stale_sets += 1
+                return
+            self._entries[key] = SearchCacheEntry(generation, time.monotonic() + ttl, ad_ids, response_data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """Start a new generation, every cached result becomes stale"""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'generation': self._generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'stale_sets': self.stale_sets,
+            }
+
+
+# One cache per process, shared by every request
+search_cache = SearchResultCache()
@@ -0,0 +1,58 @@
+from django.db.models import Count, Q
+
+from .index import resolve_cities
+from .keywords import get_search_keywords
+
+"""
+FACET COUNTS:
+
+    The search UI shows how many results fall in each ad type, city and availability next to the results.
+    Counting each facet value with its own filtered query would cost one query per ad type and city, and
+    reading every matching ad would move O(matches) rows, so facets are two grouped aggregations instead:
+        - Matching ads grouped by ad type, with their count and their available-now count (a filtered Count).
+          Availability totals are the sums of those rows
+        - Cities aren't a column (ads have a free-text location): matching ads are grouped by location, and
+          each distinct location is resolved to its city like the search index does (see index.py)
+    Both only return one row per ad type / location. Names come from the in-memory search keywords, so no
+    extra query is made for them either.
+"""
+
+
+def search_facets(ads):
+    """Get facet counts {ad_type, city, is_available_now} for a search queryset"""
+    keywords = get_search_keywords()
+    ads = ads.order_by()
+
+    type_counts = {}
+    availability_counts = {True: 0, False: 0}
+    type_rows = ads.values('ad_type_id').annotate(
+        n=Count('id'), available=Count('id', filter=Q(is_available_now=True))
+    ).values_list('ad_type_id', 'n', 'available')
+    for ad_type_id, count, available in type_rows:
+        type_counts[ad_type_id] = count
+        availability_counts[True] += available
+        availability_counts[False] += count - available
+
+    city_counts = {}
+    for location, count in ads.values('location').annotate(n=Count('id')).values_list('location', 'n'):
+        for city_id in resolve_cities(location, keywords):
+            city_counts[city_id] = city_counts.get(city_id, 0) + count
+
+    return {
+        'ad_type': facet_values(type_counts, keywords.ad_types, lambda ad_type: ad_type.name),
+        'city': facet_values(city_counts, keywords.cities, lambda city: str(city)),
+        'is_available_now': {
+            'true': availability_counts[True],
+            'false': availability_counts[False],
+        },
+    }
+
+
+def facet_values(counts, objects, label):
+    """Get [{id, name, count}] for the facet values, most common first"""
+    values = [
+        {'id': object_id, 'name': label(objects[object_id]) if object_id in objects else None, 'count': count}
+        for object_id, count in counts.items()
+    ]
+    values.sort(key=lambda value: (-value['count'], value['name'] or ''))
+    return values
@@ -0,0 +1,132 @@
+import threading
+import time
+
+from django.conf import settings
+
+from .index import ad_index, tokenize, TOKEN_PATTERN
+
+"""
+TYPO TOLERANCE:
+
+    A misspelled word ("plumbr", "photgrapher") matches no ad, so the whole search comes back empty and users
+    retry. When the exact search finds fewer than ADS_SEARCH_FUZZY_MIN_RESULTS ads, each query word the index
+    doesn't know is replaced by the closest word of the ad vocabulary and the search runs once more:
+        - Candidates come from the trigram index of the vocabulary (see index.py): only the words sharing the
+          most trigrams with the misspelled word are looked at, at most ADS_SEARCH_FUZZY_MAX_CANDIDATES of them
+        - A candidate is accepted within an edit distance of 1 (2 for words of 6+ letters), computed with a
+          cutoff so hopeless candidates stop early
+        - Words shorter than 4 letters and city / service names found in the query are left alone
+
+    Latency is bounded by ADS_SEARCH_FUZZY_BUDGET_MS: once it is spent the remaining words are kept as typed, and
+    candidate gathering in the trigram index stops with what it has. The search view only gets here when the first
+    page of the exact search came back short.
+    Timings are counted per worker and exposed with the other search stats.
+"""
+
+MIN_TERM_LENGTH = 4
+
+
+def max_edits(term):
+    """Get how many typos a word of this length may contain"""
+    return 1 if len(term) < 6 else 2
+
+
+def bounded_edit_distance(a, b, max_distance):
+    """Levenshtein distance between a and b, or None when it exceeds max_distance"""
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+
+    previous = list(range(len(b) + 1))
+    for i, a_char in enumerate(a, 1):
+        current = [i]
+        for j, b_char in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (a_char != b_char),
+            ))
+        # Every path goes through this row, so the distance can only grow from its minimum
+        if min(current) > max_distance:
+            return None
+        previous = current
+
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+class FuzzyStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.corrections = 0
+        self.budget_exceeded = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms, corrected, over_budget):
+        with self._lock:
+            self.lookups += 1
+            self.corrections += corrected
+            self.budget_exceeded += over_budget
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'corrections': self.corrections,
+                'budget_exceeded': self.budget_exceeded,
+                'avg_ms': round(self.total_ms / self.lookups, 3) if self.lookups else None,
+                'max_ms': round(self.max_ms, 3),
+            }
+
+
+fuzzy_stats = FuzzyStats()
+
+
+def closest_token(term, deadline):
+    """Get the indexed token closest to a misspelled term, or None if none is close enough"""
+    limit = settings.ADS_SEARCH_FUZZY_MAX_CANDIDATES
+    max_distance = max_edits(term)
+
+    best, best_distance = None, None
+    for token, _shared in ad_index.similar_tokens(term, limit, deadline):
+        if time.perf_counter() > deadline:
+            break
+        distance = bounded_edit_distance(term, token, max_distance)
+        if distance is not None and (best_distance is None or distance < best_distance):
+            best, best_distance = token, distance
+            if distance == 1:
+                break
+    return best
+
+
+def correct_query(text, keep=()):
+    """
+    Replace the words of text the index doesn't know with their closest indexed word.
+    keep are words to leave untouched. Returns the corrected text, or None when nothing was corrected
+    """
+    started = time.perf_counter()
+    deadline = started + settings.ADS_SEARCH_FUZZY_BUDGET_MS / 1000
+    ad_index.ensure_ready()
+
+    keep = set(keep)
+    corrections = {}
+    over_budget = False
+    for term in set(tokenize(text)):
+        if len(term) < MIN_TERM_LENGTH or term in keep or ad_index.is_known_token(term):
+            continue
+        if time.perf_counter() > deadline:
+            over_budget = True
+            break
+        replacement = closest_token(term, deadline)
+        if replacement:
+            corrections[term] = replacement
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    fuzzy_stats.record(elapsed_ms, bool(corrections), over_budget or elapsed_ms > settings.ADS_SEARCH_FUZZY_BUDGET_MS)
+
+    if not corrections:
+        return None
+    return TOKEN_PATTERN.sub(lambda match: corrections.get(match.group(0).lower(), match.group(0)), text)
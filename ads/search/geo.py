@@ -0,0 +1,78 @@
+import math
+
+from django.conf import settings
+
+"""
+RADIUS SEARCH:
+
+    Ads only have a free-text location, so "near Toronto" is answered in two steps:
+        - Which cities are within km of Toronto? Cities with coordinates are bucketed into a lat/lon grid
+          (ADS_SEARCH_GEO_CELL_DEGREES per cell). Only the cells overlapping the radius' bounding box are visited,
+          then the exact great-circle distance is checked, so no scan over every city
+        - Which ads are in those cities? The search index resolves every ad's location to a City (see index.py)
+          and keeps a posting list of ad ids per city
+"""
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LAT = 111.32
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in km"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def bounding_box(lat, lon, km):
+    """Get (min_lat, max_lat, min_lon, max_lon) of the box around a point that contains the radius"""
+    delta_lat = km / KM_PER_DEGREE_LAT
+    # Longitude degrees shrink towards the poles
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    delta_lon = min(km / (KM_PER_DEGREE_LAT * cos_lat), 180.0)
+    return lat - delta_lat, lat + delta_lat, lon - delta_lon, lon + delta_lon
+
+
+class CityGrid:
+    """Grid bucket index of cities with coordinates"""
+
+    def __init__(self, cities, cell_degrees=None):
+        self.cell_degrees = cell_degrees or getattr(settings, 'ADS_SEARCH_GEO_CELL_DEGREES', 0.5)
+        self._cells = {}  # (row, column) -> [(city id, lat, lon)]
+        self._points = {}  # city id -> (lat, lon)
+
+        for city in cities:
+            if city.latitude is None or city.longitude is None:
+                continue
+            self._points[city.id] = (city.latitude, city.longitude)
+            self._cells.setdefault(self._cell(city.latitude, city.longitude), []).append(
+                (city.id, city.latitude, city.longitude)
+            )
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)
+
+    def has_coordinates(self, city_id):
+        return city_id in self._points
+
+    def within(self, city_id, km):
+        """Get {city id: distance in km} of cities within km of a city (itself included)"""
+        if city_id not in self._points:
+            return {}
+        lat, lon = self._points[city_id]
+
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, km)
+        min_row, min_column = self._cell(min_lat, min_lon)
+        max_row, max_column = self._cell(max_lat, max_lon)
+
+        nearby = {}
+        for row in range(min_row, max_row + 1):
+            for column in range(min_column, max_column + 1):
+                for other_id, other_lat, other_lon in self._cells.get((row, column), ()):
+                    # Cheap bounding box test before the trigonometry
+                    if not (min_lat <= other_lat <= max_lat and min_lon <= other_lon <= max_lon):
+                        continue
+                    distance = haversine_km(lat, lon, other_lat, other_lon)
+                    if distance <= km:
+                        nearby[other_id] = distance
+        return nearby
@@ -0,0 +1,522 @@
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import timedelta
+
+from django.conf import settings
+
+from ads.models import Ad
+from .keywords import get_search_keywords, CITY
+
+"""
+INVERTED INDEX:
+
+    search_ads used to run a chain of icontains clauses over every Ad row, so every search was a full scan.
+    The index maps each token of an ad (title, description, tags, skills, location) to the set of ad ids
+    that contain it (the posting list). A query is answered by looking up its terms and only the matching
+    ids are sent to the database, so search cost tracks the number of matching ads instead of the table size.
+
+    Substring semantics:
+        - icontains matches inside words ("plumb" matches "plumber"), so a term is looked up against every
+          suffix of every token in a sorted suffix list. A term matches a token if some suffix of the token
+          starts with the term.
+        - If a query is a substring of a field, every word of the query is a substring of a word of that
+          field, so the candidate set is always a superset of the real matches. The database still applies
+          the exact filters on top of it.
+
+    Freshness:
+        - Built lazily on first use, updated from Ad post_save/post_delete signals (see ads/signals.py)
+        - Other worker processes don't get our signals, so every ADS_SEARCH_INDEX_SYNC_SECONDS the index
+          re-reads ads whose updated_at moved since the last sync. The rows are read and tokenized without
+          holding the index lock, which is only taken to apply them, so searches never wait on the database.
+          A row older than what the index already has for its ad (a signal got there first) is skipped
+        - Ads deleted by other workers leave no row to re-read: every ADS_SEARCH_INDEX_RECONCILE_SECONDS the
+          sync also reads the ids of all active ads and drops indexed ads that aren't among them
+
+    Every ad's location is also resolved to a City (longest city name it contains), giving a posting list of
+    ad ids per city for radius search (see geo.py).
+
+    The vocabulary is also indexed by trigram (token -> its 3-letter pieces, padded with spaces) so misspelled
+    query words can be matched to the closest known words (see fuzzy.py).
+"""
+
+TOKEN_PATTERN = re.compile(r'\w+')
+INDEXED_FIELDS = ('title', 'description', 'tags', 'skills', 'location')
+# Columns read by sync(), in the order index_row() expects
+SYNC_COLUMNS = ('id', *INDEXED_FIELDS, 'ad_type_id', 'is_active', 'updated_at')
+
+# Re-read a little before the last sync point so rows committed late by other workers aren't missed
+SYNC_OVERLAP = timedelta(seconds=60)
+
+
+def tokenize(text):
+    """Split text into lowercase word tokens"""
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def resolve_cities(location, keywords):
+    """Get the ids of the city an ad location names, if any"""
+    if not location:
+        return ()
+    match = keywords.extract(location).get(CITY)
+    return tuple(match.ids) if match else ()
+
+
+def token_trigrams(token):
+    """Get the set of trigrams of a token, padded so the first and last letters count too"""
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def ad_tokens(*field_values):
+    """Get the set of tokens for an ad's indexed field values"""
+    tokens = set()
+    for value in field_values:
+        tokens.update(tokenize(value))
+    return frozenset(tokens)
+
+
+def index_row(ad_id, field_values, ad_type_id, is_active, updated_at, keywords):
+    """Get what the index stores for an ad, (id, tokens, ad type id, city ids, updated_at), tokens None if inactive"""
+    if not is_active:
+        return ad_id, None, ad_type_id, (), updated_at
+    location = field_values[INDEXED_FIELDS.index('location')]
+    return ad_id, ad_tokens(*field_values), ad_type_id, resolve_cities(location, keywords), updated_at
+
+
+class AdSearchIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Held by the one thread syncing, others keep searching the current index meanwhile
+        self._sync_lock = threading.Lock()
+        self._built = False
+
+        self._postings = {}  # token -> set of ad ids
+        self._documents = {}  # ad id -> frozenset of tokens
+        self._ad_types = {}  # ad id -> ad type id
+        self._type_postings = {}  # ad type id -> set of ad ids
+        self._cities = {}  # ad id -> tuple of city ids
+        self._city_postings = {}  # city id -> set of ad ids
+        self._suffixes = []  # sorted list of (suffix, token)
+        self._trigrams = {}  # trigram -> set of tokens
+        self._updated = {}  # ad id -> updated_at of the indexed version
+
+        self._synced_until = None  # newest updated_at seen
+        self._last_sync = 0.0
+        self._last_reconcile = 0.0
+
+    # Building
+
+    def build(self):
+        """(Re)build the whole index from the database"""
+        rows = Ad.objects.filter(is_active=True).values_list(
+            'id', *INDEXED_FIELDS, 'ad_type_id', 'updated_at'
+        ).order_by()
+
+        keywords = get_search_keywords()
+        resolved_locations = {}
+
+        postings = {}
+        documents = {}
+        ad_types = {}
+        type_postings = {}
+        cities = {}
+        city_postings = {}
+        updated = {}
+        synced_until = None
+
+        for row in rows.iterator(chunk_size=2000):
+            ad_id, ad_type_id, updated_at = row[0], row[-2], row[-1]
+            tokens = ad_tokens(*row[1:-2])
+
+            documents[ad_id] = tokens
+            updated[ad_id] = updated_at
+            for token in tokens:
+                postings.setdefault(token, set()).add(ad_id)
+
+            ad_types[ad_id] = ad_type_id
+            type_postings.setdefault(ad_type_id, set()).add(ad_id)
+
+            location = row[INDEXED_FIELDS.index('location') + 1]
+            if location not in resolved_locations:
+                resolved_locations[location] = resolve_cities(location, keywords)
+            if resolved_locations[location]:
+                cities[ad_id] = resolved_locations[location]
+                for city_id in resolved_locations[location]:
+                    city_postings.setdefault(city_id, set()).add(ad_id)
+
+            if synced_until is None or updated_at > synced_until:
+                synced_until = updated_at
+
+        suffixes = sorted(
+            (token[i:], token) for token in postings for i in range(len(token))
+        )
+
+        trigrams = {}
+        for token in postings:
+            for trigram in token_trigrams(token):
+                trigrams.setdefault(trigram, set()).add(token)
+
+        with self._lock:
+            self._postings = postings
+            self._documents = documents
+            self._ad_types = ad_types
+            self._type_postings = type_postings
+            self._cities = cities
+            self._city_postings = city_postings
+            self._suffixes = suffixes
+            self._trigrams = trigrams
+            self._updated = updated
+            self._synced_until = synced_until
+            self._last_sync = self._last_reconcile = time.monotonic()
+            self._built = True
+
+    def ensure_ready(self):
+        """Build the index on first use and catch up with other workers' writes"""
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self.build()
+            return
+
+        interval = getattr(settings, 'ADS_SEARCH_INDEX_SYNC_SECONDS', 5)
+        if time.monotonic() - self._last_sync >= interval:
+            self.sync()
+
+    def sync(self):
+        """Re-index ads that changed since the last sync, and periodically drop ads deleted elsewhere"""
+        if not self._sync_lock.acquire(blocking=False):
+            # Another thread is syncing
+            return
+        try:
+            now = time.monotonic()
+            self._last_sync = now
+            reconcile_interval = getattr(settings, 'ADS_SEARCH_INDEX_RECONCILE_SECONDS', 60)
+            reconcile = now - self._last_reconcile >= reconcile_interval
+            with self._lock:
+                synced_until = self._synced_until
+                # Only ads indexed before the id list is read can be told apart from deleted ones
+                indexed_ids = set(self._documents) if reconcile else None
+
+            # Database reads and tokenizing, without the lock
+            ads = Ad.objects.order_by()
+            if synced_until is not None:
+                ads = ads.filter(updated_at__gte=synced_until - SYNC_OVERLAP)
+            keywords = get_search_keywords()
+            changes = [
+                index_row(row[0], row[1:-3], row[-3], row[-2], row[-1], keywords)
+                for row in ads.values_list(*SYNC_COLUMNS).iterator(chunk_size=2000)
+            ]
+            deleted = ()
+            if reconcile:
+                active_ids = set(Ad.objects.filter(is_active=True).values_list('id', flat=True).order_by())
+                deleted = indexed_ids - active_ids
+                self._last_reconcile = now
+
+            with self._lock:
+                for change in changes:
+                    self._apply(*change, skip_older=True)
+                for ad_id in deleted:
+                    self.remove(ad_id)
+        finally:
+            self._sync_lock.release()
+
+    @property
+    def is_built(self):
+        return self._built
+
+    def invalidate(self):
+        """Rebuild on next use (e.g. after City changes, which change how locations resolve)"""
+        with self._lock:
+            self._built = False
+
+    # Incremental updates
+
+    def update(self, ad):
+        """Add, re-index or drop a single ad depending on whether it is active"""
+        change = index_row(
+            ad.id, [getattr(ad, field) for field in INDEXED_FIELDS], ad.ad_type_id, ad.is_active, ad.updated_at,
+            get_search_keywords(),
+        )
+        self._apply(*change)
+
+    def _apply(self, ad_id, tokens, ad_type_id, city_ids, updated_at, skip_older=False):
+        """Store an index_row() result, under the lock. With skip_older, rows older than the indexed ad are ignored"""
+        with self._lock:
+            if skip_older and updated_at is not None:
+                indexed_at = self._updated.get(ad_id)
+                if indexed_at is not None and updated_at < indexed_at:
+                    return
+            if tokens is None:
+                self.remove(ad_id)
+            else:
+                self._store(ad_id, tokens, ad_type_id, city_ids)
+            if updated_at is not None:
+                self._updated[ad_id] = updated_at
+                if self._synced_until is None or updated_at > self._synced_until:
+                    self._synced_until = updated_at
+
+    def _store(self, ad_id, tokens, ad_type_id, city_ids):
+        """Point the postings at an active ad's current tokens, type and cities, called with the lock held"""
+        old_tokens = self._documents.get(ad_id, frozenset())
+        for token in old_tokens - tokens:
+            self._remove_posting(token, ad_id)
+        for token in tokens - old_tokens:
+            self._add_posting(token, ad_id)
+        self._documents[ad_id] = tokens
+
+        old_type = self._ad_types.get(ad_id)
+        if old_type != ad_type_id:
+            if old_type is not None:
+                self._discard(self._type_postings, old_type, ad_id)
+            self._type_postings.setdefault(ad_type_id, set()).add(ad_id)
+            self._ad_types[ad_id] = ad_type_id
+
+        old_cities = self._cities.get(ad_id, ())
+        if old_cities != city_ids:
+            for city_id in old_cities:
+                self._discard(self._city_postings, city_id, ad_id)
+            for city_id in city_ids:
+                self._city_postings.setdefault(city_id, set()).add(ad_id)
+            if city_ids:
+                self._cities[ad_id] = city_ids
+            else:
+                self._cities.pop(ad_id, None)
+
+    def remove(self, ad_id):
+        """Drop an ad from the index"""
+        with self._lock:
+            self._updated.pop(ad_id, None)
+            for token in self._documents.pop(ad_id, frozenset()):
+                self._remove_posting(token, ad_id)
+
+            ad_type_id = self._ad_types.pop(ad_id, None)
+            if ad_type_id is not None:
+                self._discard(self._type_postings, ad_type_id, ad_id)
+
+            for city_id in self._cities.pop(ad_id, ()):
+                self._discard(self._city_postings, city_id, ad_id)
+
+    def _add_posting(self, token, ad_id):
+        posting = self._postings.get(token)
+        if posting is None:
+            # New vocabulary word, register its suffixes
+            posting = self._postings[token] = set()
+            for i in range(len(token)):
+                insort(self._suffixes, (token[i:], token))
+            for trigram in token_trigrams(token):
+                self._trigrams.setdefault(trigram, set()).add(token)
+        posting.add(ad_id)
+
+    def _remove_posting(self, token, ad_id):
+        posting = self._postings.get(token)
+        if posting is None:
+            return
+        posting.discard(ad_id)
+        if not posting:
+            # Word no longer used by any ad, drop it from the vocabulary
+            del self._postings[token]
+            for i in range(len(token)):
+                entry = (token[i:], token)
+                position = bisect_left(self._suffixes, entry)
+                if position < len(self._suffixes) and self._suffixes[position] == entry:
+                    del self._suffixes[position]
+            for trigram in token_trigrams(token):
+                self._discard(self._trigrams, trigram, token)
+
+    @staticmethod
+    def _discard(mapping, key, ad_id):
+        ids = mapping.get(key)
+        if ids is not None:
+            ids.discard(ad_id)
+            if not ids:
+                del mapping[key]
+
+    # Lookups
+
+    def matching_tokens(self, term):
+        """Get every indexed token that contains term"""
+        tokens = set()
+        with self._lock:
+            position = bisect_left(self._suffixes, (term, ''))
+            while position < len(self._suffixes):
+                suffix, token = self._suffixes[position]
+                if not suffix.startswith(term):
+                    break
+                tokens.add(token)
+                position += 1
+        return tokens
+
+    def term_matches(self, term):
+        """Get ids of ads with a token containing term"""
+        ids = set()
+        with self._lock:
+            for token in self.matching_tokens(term):
+                ids |= self._postings[token]
+        return ids
+
+    def phrase_matches(self, text):
+        """
+        Get ids of ads that could contain text, i.e. every word of text is part of one of the ad's words.
+        Returns None when text has no words to look up, meaning it can't narrow anything down
+        """
+        terms = sorted(set(tokenize(text)), key=len, reverse=True)
+        if not terms:
+            return None
+
+        ids = None
+        # Longest terms first, they usually have the shortest posting lists
+        for term in terms:
+            matches = self.term_matches(term)
+            ids = matches if ids is None else ids & matches
+            if not ids:
+                return set()
+        return ids
+
+    def is_known_token(self, term):
+        """Whether term is part of some indexed token (i.e. an exact search can match it)"""
+        with self._lock:
+            position = bisect_left(self._suffixes, (term, ''))
+            return position < len(self._suffixes) and self._suffixes[position][0].startswith(term)
+
+    def similar_tokens(self, term, limit, deadline=None):
+        """
+        Get up to limit indexed tokens sharing the most trigrams with term, as [(token, shared trigrams)].
+        Only posting lists of the term's own trigrams are read, not the whole vocabulary. Past deadline
+        (a time.perf_counter() value) the rest of the posting lists are skipped
+        """
+        shared = {}
+        with self._lock:
+            for trigram in token_trigrams(term):
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
+                for token in self._trigrams.get(trigram, ()):
+                    shared[token] = shared.get(token, 0) + 1
+        return sorted(shared.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def type_matches(self, ad_type_ids):
+        """Get ids of ads with one of the given ad types"""
+        ids = set()
+        with self._lock:
+            for ad_type_id in ad_type_ids:
+                ids |= self._type_postings.get(ad_type_id, set())
+        return ids
+
+    def city_matches(self, city_ids):
+        """Get ids of ads located in one of the given cities"""
+        self.ensure_ready()
+        ids = set()
+        with self._lock:
+            for city_id in city_ids:
+                ids |= self._city_postings.get(city_id, set())
+        return ids
+
+    def city_counts(self, ad_ids):
+        """Get {city id: number of the given ads located in it}"""
+        self.ensure_ready()
+        counts = {}
+        with self._lock:
+            for ad_id in ad_ids:
+                for city_id in self._cities.get(ad_id, ()):
+                    counts[city_id] = counts.get(city_id, 0) + 1
+        return counts
+
+    def candidates(self, query, ad_type_ids=None, location_keywords=None):
+        """
+        Get a superset of the ads search_ads can return for a query.
+        Returns None when the index can't narrow the search down (e.g. the query has no words)
+        """
+        self.ensure_ready()
+
+        ids = self.phrase_matches(query)
+        if ids is None:
+            return None
+
+        if ad_type_ids:
+            ids = ids | self.type_matches(ad_type_ids)
+
+        if location_keywords:
+            location_ids = self.phrase_matches(location_keywords)
+            if location_ids is None:
+                return None
+            ids = ids | location_ids
+
+        return ids
+
+    # Diagnostics
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ads': len(self._documents),
+                'tokens': len(self._postings),
+                'suffixes': len(self._suffixes),
+                'trigrams': len(self._trigrams),
+                'postings': sum(len(ids) for ids in self._postings.values()),
+                'located': len(self._cities),
+            }
+
+    def verify(self):
+        """
+        Compare the index with the database.
+        Returns a dict of problems, empty if the index matches the database
+        """
+        rows = Ad.objects.filter(is_active=True).values_list(
+            'id', *INDEXED_FIELDS, 'ad_type_id'
+        ).order_by()
+        keywords = get_search_keywords()
+        location_position = INDEXED_FIELDS.index('location') + 1
+        expected = {
+            row[0]: (ad_tokens(*row[1:-1]), row[-1], resolve_cities(row[location_position], keywords))
+            for row in rows.iterator(chunk_size=2000)
+        }
+
+        with self._lock:
+            indexed = {
+                ad_id: (tokens, self._ad_types.get(ad_id), self._cities.get(ad_id, ()))
+                for ad_id, tokens in self._documents.items()
+            }
+
+            # Posting lists must be the exact inverse of the documents
+            postings = {}
+            for ad_id, tokens in self._documents.items():
+                for token in tokens:
+                    postings.setdefault(token, set()).add(ad_id)
+            postings_match = postings == self._postings
+            suffixes_match = self._suffixes == sorted(
+                (token[i:], token) for token in self._postings for i in range(len(token))
+            )
+            trigrams = {}
+            for token in self._postings:
+                for trigram in token_trigrams(token):
+                    trigrams.setdefault(trigram, set()).add(token)
+            trigrams_match = trigrams == self._trigrams
+
+        problems = {}
+        missing = sorted(set(expected) - set(indexed))
+        extra = sorted(set(indexed) - set(expected))
+        stale = sorted(
+            ad_id for ad_id in set(expected) & set(indexed)
+            if expected[ad_id] != indexed[ad_id]
+        )
+        if missing:
+            problems['missing'] = missing
+        if extra:
+            problems['extra'] = extra
+        if stale:
+            problems['stale'] = stale
+        if not postings_match:
+            problems['postings'] = 'posting lists do not match indexed ads'
+        if not suffixes_match:
+            problems['suffixes'] = 'suffix list does not match vocabulary'
+        if not trigrams_match:
+            problems['trigrams'] = 'trigram index does not match vocabulary'
+        return problems
+
+
+# One index per process, shared by every request
+ad_index = AdSearchIndex()
@@ -0,0 +1,174 @@
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from ads.models import AdType, City
+from .geo import CityGrid
+
+"""
+KEYWORD EXTRACTION:
+
+    search_ads needs to know which city and which service (ad type) a query mentions.
+    Instead of loading every City and AdType row and testing each name against the query on every request,
+    all names are compiled once into an Aho-Corasick automaton:
+        - A trie of every lowercase name, plus "fail" links that say where to continue when the next character
+          doesn't extend the current match (like KMP, but for many patterns at once)
+        - Scanning the query once finds every name it contains, wherever they overlap
+        - When several names match (e.g. "Richmond" and "Richmond Hill") the longest one wins
+    The cities with coordinates are also bucketed into a CityGrid (see geo.py) for radius search.
+
+    The compiled keywords are cached per process, dropped when a City or AdType row changes (see ads/signals.py)
+    and rebuilt at least every ADS_SEARCH_KEYWORDS_TTL_SECONDS so changes made by other workers show up too.
+"""
+
+CITY = 'city'
+AD_TYPE = 'ad_type'
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over a set of lowercase patterns"""
+
+    def __init__(self, patterns):
+        # Node 0 is the root. Each node has its transitions, fail link and the patterns ending there
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def _add(self, pattern):
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[node][char] = next_node
+            node = next_node
+        self._output[node].append(pattern)
+
+    def _link(self):
+        # Breadth first so every node's fail target is already linked when we reach it
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+
+                # A match ending here also ends every shorter pattern that is a suffix of it
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find_all(self, text):
+        """Get (start, end, pattern) for every pattern occurrence in text"""
+        matches = []
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for pattern in self._output[node]:
+                matches.append((position + 1 - len(pattern), position + 1, pattern))
+        return matches
+
+
+class KeywordMatch:
+    def __init__(self, kind, keyword, ids, start, end):
+        self.kind = kind
+        self.keyword = keyword  # name as stored in the database
+        self.ids = ids  # ids of the rows this keyword refers to
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f'KeywordMatch({self.kind!r}, {self.keyword!r}, {self.ids!r})'
+
+
+class SearchKeywords:
+    """City and ad type names compiled for one-pass extraction from search queries"""
+
+    def __init__(self, cities, ad_types):
+        self.cities = {city.id: city for city in cities}
+        self.ad_types = {ad_type.id: ad_type for ad_type in ad_types}
+        self.city_grid = CityGrid(self.cities.values())
+
+        # pattern -> [(kind, display name, ids)]
+        self._entries = {}
+
+        city_ids = {}
+        city_names = {}
+        for city in self.cities.values():
+            pattern = city.name.lower()
+            city_ids.setdefault(pattern, []).append(city.id)
+            city_names.setdefault(pattern, city.name)
+        for pattern, ids in city_ids.items():
+            self._entries.setdefault(pattern, []).append((CITY, city_names[pattern], ids))
+
+        type_names = {}
+        for ad_type in self.ad_types.values():
+            type_names.setdefault(ad_type.name.lower(), ad_type.name)
+        for pattern, name in type_names.items():
+            # Same as ad_type__name__icontains=name: every type whose name contains the matched one
+            ids = [ad_type.id for ad_type in self.ad_types.values() if pattern in ad_type.name.lower()]
+            self._entries.setdefault(pattern, []).append((AD_TYPE, name, ids))
+
+        self._automaton = KeywordAutomaton(pattern for pattern in self._entries if pattern)
+
+    def find_all(self, text):
+        """Get every city/ad type name found in text"""
+        matches = []
+        for start, end, pattern in self._automaton.find_all(text.lower()):
+            for kind, keyword, ids in self._entries[pattern]:
+                matches.append(KeywordMatch(kind, keyword, ids, start, end))
+        return matches
+
+    def extract(self, text):
+        """Get the best (longest, then leftmost) match of each kind found in text, keyed by kind"""
+        best = {}
+        for match in self.find_all(text):
+            current = best.get(match.kind)
+            if (
+                current is None
+                or match.end - match.start > current.end - current.start
+                or (match.end - match.start == current.end - current.start and match.start < current.start)
+            ):
+                best[match.kind] = match
+        return best
+
+
+_keywords = None
+_built_at = 0.0
+_lock = threading.Lock()
+
+
+def get_search_keywords():
+    """Get the cached SearchKeywords, (re)building them when they were invalidated or are too old"""
+    global _keywords, _built_at
+
+    ttl = getattr(settings, 'ADS_SEARCH_KEYWORDS_TTL_SECONDS', 300)
+    keywords = _keywords
+    if keywords is not None and time.monotonic() - _built_at < ttl:
+        return keywords
+
+    with _lock:
+        if _keywords is None or time.monotonic() - _built_at >= ttl:
+            _keywords = SearchKeywords(City.objects.all(), AdType.objects.all())
+            _built_at = time.monotonic()
+        return _keywords
+
+
+def invalidate_search_keywords():
+    """Drop the cached keywords so the next search rebuilds them"""
+    global _keywords
+    with _lock:
+        _keywords = None
@@ -0,0 +1,70 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+
+"""
+KEYSET (CURSOR) PAGINATION:
+
+    Paginator runs a COUNT(*) over the whole relevance query and then an OFFSET query, so page 50 makes the
+    database build and throw away 49 pages first. Keyset pagination remembers where the last page ended instead:
+        - Results are ordered by (relevance, created_at, id), all descending, id makes the order total
+        - The cursor is the (relevance, created_at, id) of the last ad on the page, base64 encoded so clients
+          treat it as opaque
+        - The next page is "everything after that row", which costs the same on page 1 and page 500
+"""
+
+ORDERING = ('-relevance', '-created_at', '-id')
+
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(ad):
+    """Encode the position of an ad in the search results"""
+    position = [ad.relevance, ad.created_at.isoformat(), ad.id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (relevance, created_at, id)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        relevance, created_at, ad_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(relevance, (int, float)) or not isinstance(ad_id, int):
+            raise InvalidCursor('Invalid cursor')
+        return relevance, datetime.fromisoformat(created_at), ad_id
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor('Invalid cursor') from e
+
+
+def paginate_by_cursor(ads, cursor, limit):
+    """
+    Get one page of a relevance-annotated search queryset.
+    Returns (ads on the page, cursor of the next page or None)
+    """
+    ads = ads.order_by(*ORDERING)
+
+    if cursor:
+        relevance, created_at, ad_id = decode_cursor(cursor)
+        ads = ads.filter(
+            Q(relevance__lt=relevance)
+            | Q(relevance=relevance, created_at__lt=created_at)
+            | Q(relevance=relevance, created_at=created_at, id__lt=ad_id)
+        )
+
+    # Fetch one extra row to know whether there is a next page
+    page = list(ads[:limit + 1])
+    if len(page) > limit:
+        page = page[:limit]
+        return page, encode_cursor(page[-1])
+    return page, None
+
+
+def approximate_count(ads, cap):
+    """Count results, but stop counting at cap so huge result sets stay cheap"""
+    return ads.order_by()[:cap].count()
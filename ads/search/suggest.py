@@ -0,0 +1,330 @@
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+
+from ads.models import Ad
+from .keywords import get_search_keywords
+
+logger = logging.getLogger(__name__)
+
+"""
+TYPEAHEAD SUGGESTIONS:
+
+    The search box asks for suggestions on every keystroke, so answers come from memory, never the database:
+        - Phrases: ad titles, each tag, each skill, ad locations, AdType names and City names
+        - A phrase's frequency is the number of active ads using it. City and ad type names are always
+          suggestable even when no ad uses them yet
+        - Sorted array prefix index: every word position of every phrase is stored as (text from that word on, phrase)
+          in one sorted list, so "rep" finds "Emergency plumbing repair". A prefix lookup is a binary search
+          plus a walk over the matching entries
+        - One and two letter prefixes match a large part of the index, so their best MAX_SUGGESTIONS phrases
+          (plus some spares) are ranked when the index is built and kept ranked by incremental updates: a lookup
+          never walks more than that. Between rebuilds, a short prefix only reorders its kept phrases
+        - The top results of recent prefixes are memoized, any change to the phrases clears the memo
+
+    Kept up to date from Ad signals (see ads/signals.py) and rebuilt from the database every
+    ADS_SEARCH_SUGGEST_TTL_SECONDS so other workers' writes and City/AdType changes show up. Only the very first
+    build runs inside a request: later rebuilds (expired, or City/AdType changes) run in a background thread while
+    requests keep getting the current suggestions, and ad updates made during the rebuild are replayed onto it.
+"""
+
+MEMO_SIZE = 2048
+# Most suggestions one lookup returns
+MAX_SUGGESTIONS = 20
+# Prefixes up to this long are answered from their precomputed ranking, which keeps this many phrases
+SHORT_PREFIX_LENGTH = 2
+SHORT_PREFIX_KEPT = MAX_SUGGESTIONS * 2
+
+
+def normalize_phrase(text):
+    return ' '.join(text.lower().split())
+
+
+def split_list(value):
+    """Split a comma-separated tags/skills value"""
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def word_starts(key):
+    """Get the phrase from each of its words on, e.g. 'a b c' -> 'a b c', 'b c', 'c'"""
+    words = key.split(' ')
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+def short_prefixes(key):
+    """Get the short prefixes a phrase matches, e.g. 'dog walker' -> 'd', 'do', 'w', 'wa'"""
+    prefixes = set()
+    for start in word_starts(key):
+        for length in range(1, SHORT_PREFIX_LENGTH + 1):
+            prefix = start[:length]
+            if len(prefix) == length and not prefix.endswith(' '):
+                prefixes.add(prefix)
+    return prefixes
+
+
+class SuggestionIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built_at = None
+
+        self._counts = {}  # phrase key -> number of active ads using it
+        self._labels = {}  # phrase key -> text shown to the user
+        self._pinned = set()  # City / AdType phrase keys, kept even when no ad uses them
+        self._documents = {}  # ad id -> tuple of phrase keys
+        self._entries = []  # sorted list of (text from a word on, phrase key)
+        self._top = {}  # short prefix -> its best phrase keys, ranked
+        self._memo = OrderedDict()  # (prefix, limit) -> suggestions
+
+        self._stale = False
+        self._rebuilding = False
+        self._replay = []  # ad updates made while a background rebuild reads the database
+
+    # Building
+
+    def build(self):
+        """(Re)build the suggestions from the database"""
+        keywords = get_search_keywords()
+        type_names = {ad_type.id: ad_type.name for ad_type in keywords.ad_types.values()}
+
+        counts = {}
+        labels = {}
+        documents = {}
+        pinned = set()
+
+        for name in list(type_names.values()) + [city.name for city in keywords.cities.values()]:
+            key = normalize_phrase(name)
+            if key:
+                pinned.add(key)
+                counts.setdefault(key, 0)
+                labels.setdefault(key, name)
+
+        rows = Ad.objects.filter(is_active=True).values_list(
+            'id', 'title', 'tags', 'skills', 'location', 'ad_type_id'
+        ).order_by()
+        for ad_id, title, tags, skills, location, ad_type_id in rows.iterator(chunk_size=2000):
+            phrases = self._phrases(title, tags, skills, location, type_names.get(ad_type_id))
+            documents[ad_id] = tuple(phrases)
+            for key, label in phrases.items():
+                counts[key] = counts.get(key, 0) + 1
+                labels.setdefault(key, label)
+
+        entries = sorted((start, key) for key in counts for start in word_starts(key))
+
+        matches = {}
+        for key in counts:
+            for prefix in short_prefixes(key):
+                matches.setdefault(prefix, []).append(key)
+        top = {
+            prefix: heapq.nsmallest(SHORT_PREFIX_KEPT, keys, key=lambda key, prefix=prefix: self._rank(counts, prefix, key))
+            for prefix, keys in matches.items()
+        }
+
+        with self._lock:
+            self._counts = counts
+            self._labels = labels
+            self._pinned = pinned
+            self._documents = documents
+            self._entries = entries
+            self._top = top
+            self._memo.clear()
+            self._built_at = time.monotonic()
+            self._stale = False
+
+            # Ads written while the database was being read may be missing from it
+            replay, self._replay = self._replay, []
+            for ad_id, ad in replay:
+                if ad is None:
+                    self._remove(ad_id)
+                else:
+                    self._update(ad)
+
+    def ensure_ready(self):
+        """Build the index on first use, and start a background rebuild when it has expired"""
+        if self._built_at is None:
+            with self._lock:
+                if self._built_at is None:
+                    self.build()
+            return
+        ttl = getattr(settings, 'ADS_SEARCH_SUGGEST_TTL_SECONDS', 600)
+        if self._stale or time.monotonic() - self._built_at >= ttl:
+            self.refresh()
+
+    def refresh(self):
+        """Rebuild from the database in a background thread, answering from the current index until it's done"""
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild, name='suggestion-index-rebuild', daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception('Could not rebuild the suggestion index, retrying after ADS_SEARCH_SUGGEST_TTL_SECONDS')
+            with self._lock:
+                self._built_at = time.monotonic()
+                self._stale = False
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._replay = []
+            # This thread's database connection
+            connection.close()
+
+    @property
+    def is_built(self):
+        return self._built_at is not None
+
+    def invalidate(self):
+        """Rebuild in the background (e.g. after City or AdType changes), still answering meanwhile"""
+        if self._built_at is None:
+            return
+        with self._lock:
+            self._stale = True
+        self.refresh()
+
+    @staticmethod
+    def _rank(counts, prefix, key):
+        # Most used first, then phrases that start with the prefix, then shortest
+        return (-counts[key], not key.startswith(prefix), len(key), key)
+
+    @staticmethod
+    def _phrases(title, tags, skills, location, ad_type_name):
+        """Get {phrase key: label} for one ad"""
+        phrases = {}
+        for label in [title, *split_list(tags), *split_list(skills), location, ad_type_name]:
+            if label:
+                key = normalize_phrase(label)
+                if key:
+                    phrases.setdefault(key, label.strip())
+        return phrases
+
+    # Incremental updates
+
+    def update(self, ad):
+        """Add, refresh or drop one ad's phrases"""
+        if not ad.is_active:
+            self.remove(ad.id)
+            return
+
+        with self._lock:
+            if self._rebuilding:
+                self._replay.append((ad.id, ad))
+            self._update(ad)
+
+    def _update(self, ad):
+        ad_type = get_search_keywords().ad_types.get(ad.ad_type_id)
+        phrases = self._phrases(ad.title, ad.tags, ad.skills, ad.location, ad_type.name if ad_type else None)
+
+        with self._lock:
+            old_keys = set(self._documents.get(ad.id, ()))
+            for key in old_keys - set(phrases):
+                self._decrement(key)
+            for key in set(phrases) - old_keys:
+                self._increment(key, phrases[key])
+            self._documents[ad.id] = tuple(phrases)
+            self._memo.clear()
+
+    def remove(self, ad_id):
+        with self._lock:
+            if self._rebuilding:
+                self._replay.append((ad_id, None))
+            self._remove(ad_id)
+
+    def _remove(self, ad_id):
+        with self._lock:
+            for key in self._documents.pop(ad_id, ()):
+                self._decrement(key)
+            self._memo.clear()
+
+    def _increment(self, key, label):
+        if key not in self._counts:
+            self._counts[key] = 0
+            self._labels[key] = label
+            for start in word_starts(key):
+                insort(self._entries, (start, key))
+        self._counts[key] += 1
+        self._rerank(key)
+
+    def _decrement(self, key):
+        if key not in self._counts:
+            return
+        self._counts[key] -= 1
+        if self._counts[key] <= 0 and key not in self._pinned:
+            del self._counts[key]
+            del self._labels[key]
+            for start in word_starts(key):
+                entry = (start, key)
+                position = bisect_left(self._entries, entry)
+                if position < len(self._entries) and self._entries[position] == entry:
+                    del self._entries[position]
+        self._rerank(key)
+
+    def _rerank(self, key):
+        """Move a phrase whose count changed within the rankings of its short prefixes"""
+        exists = key in self._counts
+        for prefix in short_prefixes(key):
+            top = self._top.get(prefix, [])
+            if key in top:
+                top.remove(key)
+            elif not exists:
+                continue
+            if exists:
+                top.append(key)
+                top.sort(key=lambda key: self._rank(self._counts, prefix, key))
+                del top[SHORT_PREFIX_KEPT:]
+            self._top[prefix] = top
+
+    # Lookups
+
+    def suggest(self, prefix, limit=8):
+        """Get up to limit {'text', 'count'} suggestions for a prefix, most used first"""
+        prefix = normalize_phrase(prefix)
+        if not prefix:
+            return []
+
+        memo_key = (prefix, limit)
+        with self._lock:
+            cached = self._memo.get(memo_key)
+            if cached is not None:
+                self._memo.move_to_end(memo_key)
+                return cached
+
+            if len(prefix) <= SHORT_PREFIX_LENGTH:
+                best = self._top.get(prefix, [])[:limit]
+            else:
+                keys = set()
+                position = bisect_left(self._entries, (prefix, ''))
+                while position < len(self._entries):
+                    start, key = self._entries[position]
+                    if not start.startswith(prefix):
+                        break
+                    keys.add(key)
+                    position += 1
+                best = heapq.nsmallest(limit, keys, key=lambda key: self._rank(self._counts, prefix, key))
+            suggestions = [{'text': self._labels[key], 'count': self._counts[key]} for key in best]
+
+            self._memo[memo_key] = suggestions
+            if len(self._memo) > MEMO_SIZE:
+                self._memo.popitem(last=False)
+            return suggestions
+
+    def stats(self):
+        with self._lock:
+            return {
+                'phrases': len(self._counts),
+                'entries': len(self._entries),
+                'ads': len(self._documents),
+            }
+
+
+# One suggestion index per process, shared by every request
+suggestion_index = SuggestionIndex()
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import Ad, AdType, Photo, AdRequest, Review, City
+from .ratings import user_average_rating
 
 class AdTypeSerializer(serializers.ModelSerializer):
     class Meta:
@@ -9,7 +10,7 @@ class AdTypeSerializer(serializers.ModelSerializer):
 class CitySerializer(serializers.ModelSerializer):
     class Meta:
         model = City
-        fields = ['id', 'name', 'province']
+        fields = ['id', 'name', 'province', 'latitude', 'longitude']
 
 class PhotoSerializer(serializers.ModelSerializer):
     class Meta:
@@ -31,19 +32,39 @@ class AdSerializer(serializers.ModelSerializer):
             'cost', 'requests_count', 'user_average_rating']
         
         read_only_fields =  ['user', 'user_name', 'created_at', 'requests_count', 'user_average_rating']
+
+    def __init__(self, *args, **kwargs):
+        # Optional sparse fieldset, e.g. AdSerializer(ads, many=True, fields=['id', 'title'])
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
     
     def get_requests_count(self, obj):
+        # Annotated by ad_list_queryset (the subquery gives None when there are no pending requests)
+        if hasattr(obj, 'pending_requests_count'):
+            return obj.pending_requests_count or 0
         return obj.requests.filter(status='pending').count()
 
     def get_user_average_rating(self, obj):
         """Get the average rating of the ad owner"""
-        reviews = Review.objects.filter(reviewee=obj.user)
-        if not reviews.exists():
-            return None
-        
-        from django.db.models import Avg
-        average = reviews.aggregate(Avg('rating'))['rating__avg']
-        return round(average, 1) if average else None
+        return user_average_rating(obj.user)
+
+class AdSummarySerializer(serializers.ModelSerializer):
+    """Compact ad embedded in conversations: id, title and first photo"""
+    first_photo = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Ad
+        fields = ['id', 'title', 'first_photo']
+
+    def get_first_photo(self, obj):
+        # Annotated by ad_summary_queryset
+        if hasattr(obj, 'first_photo_url'):
+            return obj.first_photo_url
+        photo = obj.photos.order_by('order', 'uploaded_at', 'id').only('image_url').first()
+        return photo.image_url if photo else None
 
 class AdRequestSerializer(serializers.ModelSerializer):
     requester_name = serializers.CharField(source='requester.name', read_only=True)
@@ -0,0 +1,69 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Ad, AdType, City, Photo, Review
+from .ratings import record_review, forget_review, rebuild_rating_stats
+from .search.cache import search_cache
+from .search.index import ad_index
+from .search.keywords import invalidate_search_keywords
+from .search.suggest import suggestion_index
+
+
+# Keep the in-process search and suggestion indexes in step with Ad writes.
+# Only touch the indexes once the transaction commits so rolled back writes never show up in search.
+@receiver(post_save, sender=Ad)
+def index_ad(sender, instance, **kwargs):
+    if ad_index.is_built:
+        transaction.on_commit(lambda: ad_index.update(instance))
+    if suggestion_index.is_built:
+        transaction.on_commit(lambda: suggestion_index.update(instance))
+
+
+@receiver(post_delete, sender=Ad)
+def unindex_ad(sender, instance, **kwargs):
+    ad_id = instance.id
+    if ad_index.is_built:
+        transaction.on_commit(lambda: ad_index.remove(ad_id))
+    if suggestion_index.is_built:
+        transaction.on_commit(lambda: suggestion_index.remove(ad_id))
+
+
+# City and ad type names are compiled into the keyword matcher used to parse search queries
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+@receiver(post_save, sender=AdType)
+@receiver(post_delete, sender=AdType)
+def invalidate_keywords(sender, **kwargs):
+    transaction.on_commit(invalidate_search_keywords)
+    # Suggestions include every city and ad type name
+    transaction.on_commit(suggestion_index.invalidate)
+    # Ad locations are resolved to cities in the search index
+    if sender is City:
+        transaction.on_commit(ad_index.invalidate)
+
+
+# Cached search results embed ads, their ad types and photos, so any write to those starts a new cache generation
+@receiver(post_save, sender=Ad)
+@receiver(post_delete, sender=Ad)
+@receiver(post_save, sender=AdType)
+@receiver(post_delete, sender=AdType)
+@receiver(post_save, sender=Photo)
+@receiver(post_delete, sender=Photo)
+def invalidate_search_cache(sender, **kwargs):
+    transaction.on_commit(search_cache.invalidate)
+
+
+# Reviewee rating stats change in the same transaction as the review itself
+@receiver(post_save, sender=Review)
+def update_rating_stats(sender, instance, created, **kwargs):
+    if created:
+        record_review(instance)
+    else:
+        # The rating may have been edited, recount this user
+        rebuild_rating_stats([instance.reviewee_id])
+
+
+@receiver(post_delete, sender=Review)
+def remove_rating_stats(sender, instance, **kwargs):
+    forget_review(instance)
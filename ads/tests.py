@@ -1,3 +1,674 @@
-from django.test import TestCase
+import threading
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connection
+from django.db.models import Value
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from contractingo import fast_json
+from contractingo.fast_json import FastJSONRenderer
+from supabase_auth.models import User
+from .fast_serializers import serialize_ads
+from .models import Ad, AdRequest, AdType, City, Photo, Review, UserRatingStats
+from .querysets import ad_list_queryset
+from .ratings import check_rating_stats, rebuild_rating_stats
+from .search.backends import INDEX_BACKEND, get_search_backend, search_queryset
+from .search.cache import SearchResultCache, search_cache
+from .search.facets import search_facets
+from .search.fuzzy import closest_token
+from .search.index import AdSearchIndex, ad_index
+from .search.keywords import (
+    AD_TYPE, CITY, KeywordAutomaton, SearchKeywords, get_search_keywords, invalidate_search_keywords,
+)
+from .search.suggest import SuggestionIndex
+from .serializers import AdSerializer
+from .views import AdViewSet, get_ads_by_type, search_ads
+
+
+def create_user(n):
+    return User.objects.create_user(uid=f'uid-{n}', email=f'user{n}@example.com', name=f'User {n}')
+
+
+class FastSerializerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner, rated_owner, requester = create_user(1), create_user(2), create_user(3)
+        UserRatingStats.objects.create(user=rated_owner, rating_count=3, rating_sum=13)
+        plumbing = AdType.objects.create(name='Plumbing')
+        plain = Ad.objects.create(title='Plumber', description='', ad_type=plumbing, cost='50', user=owner)
+        full = Ad.objects.create(
+            title='Emergency plumbing', description='24/7', ad_type=plumbing, cost='80', location='Ottawa',
+            tags='pipes', skills='soldering', is_available_now=True, user=rated_owner,
+        )
+        Photo.objects.create(ad=full, image_url='https://example.com/2.jpg', order=1)
+        Photo.objects.create(ad=full, image_url='https://example.com/1.jpg', order=0)
+        AdRequest.objects.create(ad=full, requester=requester)
+        AdRequest.objects.create(ad=plain, requester=requester, status='declined')
+        cls.ad_ids = [full.id, plain.id]
+
+    def assertSameJSON(self, fast, drf):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(fast), renderer.render(drf))
+
+    def test_serialize_ads_matches_ad_serializer(self):
+        ads = ad_list_queryset(Ad.objects.filter(id__in=self.ad_ids)).order_by('-id')
+        self.assertSameJSON(serialize_ads(self.ad_ids), AdSerializer(ads, many=True).data)
+
+    def test_serialize_ads_matches_ad_serializer_with_a_sparse_fieldset(self):
+        fields = ('id', 'photos', 'requests_count', 'user_average_rating')
+        ads = ad_list_queryset(Ad.objects.filter(id__in=self.ad_ids), fields).order_by('-id')
+        self.assertSameJSON(serialize_ads(self.ad_ids, fields), AdSerializer(ads, many=True, fields=fields).data)
+
+
+@skipIf(fast_json.orjson is None, 'orjson is not installed')
+@override_settings(FAST_JSON=True)
+class FastJSONRendererTests(SimpleTestCase):
+
+    def assertSameRendering(self, data):
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_output_matches_drf(self):
+        self.assertSameRendering({
+            'id': 1,
+            'title': 'Plombier à Montréal ✓',
+            'cost': Decimal('49.90'),
+            'rating': 4.5,
+            'created_at': timezone.now(),
+            'uid': uuid.uuid4(),
+            'tags': ['pipes', None, True],
+            'nested': {'empty': [], 'photos': ({'order': 0},)},
+        })
+
+    def test_line_and_paragraph_separators_are_escaped(self):
+        data = {'description': 'first\u2028second\u2029third'}
+        self.assertSameRendering(data)
+        self.assertIn(b'\\u2028', FastJSONRenderer().render(data))
+
+    def test_non_finite_numbers_are_rejected(self):
+        for value in (float('nan'), float('inf'), -float('inf'), Decimal('NaN')):
+            with self.assertRaises(ValueError):
+                JSONRenderer().render({'rating': value, 'note': None})
+            with self.assertRaises(ValueError):
+                FastJSONRenderer().render({'rating': value, 'note': None})
+
+
+class RatingStatsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = create_user(1)
+        cls.requesters = [create_user(2), create_user(3)]
+        plumbing = AdType.objects.create(name='Plumbing')
+        cls.ad = Ad.objects.create(title='Plumber', description='', ad_type=plumbing, cost='50', user=cls.owner)
+
+    def review(self, requester, rating):
+        ad_request = AdRequest.objects.create(ad=self.ad, requester=requester, status='completed')
+        return Review.objects.create(ad_request=ad_request, reviewer=requester, reviewee=self.owner, rating=rating)
+
+    def stats(self):
+        return UserRatingStats.objects.get(user=self.owner)
+
+    def test_created_reviews_are_added(self):
+        self.review(self.requesters[0], 5)
+        self.review(self.requesters[1], 2)
+        stats = self.stats()
+        self.assertEqual((stats.rating_count, stats.rating_sum, stats.average_rating), (2, 7, 3.5))
+        self.assertEqual(stats.histogram, {1: 0, 2: 1, 3: 0, 4: 0, 5: 1})
+        self.assertEqual(check_rating_stats(), [])
+
+    def test_edited_review_is_recounted(self):
+        self.review(self.requesters[0], 5)
+        review = self.review(self.requesters[1], 2)
+        review.rating = 4
+        review.save()
+        stats = self.stats()
+        self.assertEqual((stats.rating_count, stats.rating_sum), (2, 9))
+        self.assertEqual(stats.histogram, {1: 0, 2: 0, 3: 0, 4: 1, 5: 1})
+
+    def test_deleted_review_is_subtracted(self):
+        self.review(self.requesters[0], 5)
+        self.review(self.requesters[1], 2).delete()
+        stats = self.stats()
+        self.assertEqual((stats.rating_count, stats.rating_sum, stats.average_rating), (1, 5, 5.0))
+        self.assertEqual(stats.histogram, {1: 0, 2: 0, 3: 0, 4: 0, 5: 1})
+
+        Review.objects.get().delete()
+        self.assertIsNone(self.stats().average_rating)
+        self.assertEqual(check_rating_stats(), [])
+
+    def test_rebuild_repairs_drifted_stats(self):
+        self.review(self.requesters[0], 3)
+        UserRatingStats.objects.filter(user=self.owner).update(rating_count=7, rating_sum=1)
+        self.assertEqual(check_rating_stats(), [self.owner.id])
+
+        self.assertEqual(rebuild_rating_stats(), [self.owner.id])
+        stats = self.stats()
+        self.assertEqual((stats.rating_count, stats.rating_sum), (1, 3))
+        self.assertEqual(check_rating_stats(), [])
+
+
+class AdListQueryCountTests(TestCase):
+    """The ad lists load a page in a fixed number of queries, whatever its size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.requester = create_user(1), create_user(2)
+        cls.plumbing = AdType.objects.create(name='Plumbing')
+
+    def setUp(self):
+        ad_index.invalidate()
+        search_cache.clear()
+
+    def create_ads(self, count):
+        first = Ad.objects.count()
+        for i in range(first, first + count):
+            owner = create_user(10 + i) if i % 2 else self.owner
+            UserRatingStats.objects.get_or_create(user=owner, defaults={'rating_count': 1, 'rating_sum': 4})
+            ad = Ad.objects.create(
+                title='Plumber', description='Leaks and pipes', ad_type=self.plumbing, cost='50', location='Toronto',
+                user=owner,
+            )
+            Photo.objects.create(ad=ad, image_url=f'https://example.com/{ad.id}.jpg', order=0)
+            AdRequest.objects.create(ad=ad, requester=self.requester)
+        ad_index.ensure_ready()
+        get_search_keywords()
+
+    def get_by_type(self):
+        request = APIRequestFactory().get('/api/ads/get_ads_by_type/')
+        return get_ads_by_type(request, self.plumbing.id)
+
+    def search(self):
+        request = APIRequestFactory().get('/api/ads/search/', {'q': 'plumber', 'limit': 50})
+        return search_ads(request)
+
+    def my_ads(self):
+        request = APIRequestFactory().get('/api/ads/my_ads/')
+        force_authenticate(request, user=self.owner)
+        return AdViewSet.as_view({'get': 'my_ads'})(request)
+
+    def assertQueriesForSizes(self, view, fast, queries):
+        created = 0
+        for size in (2, 6):
+            self.create_ads(size - created)
+            created = size
+            search_cache.clear()
+            with self.subTest(size=size), self.settings(FAST_SERIALIZERS=fast, ADS_SEARCH_FUZZY_MIN_RESULTS=0):
+                with self.assertNumQueries(queries):
+                    response = view()
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.data['data'])
+
+    def test_ads_by_type(self):
+        # Ad ids, then the ads with their owners and rating stats, then the photos
+        self.assertQueriesForSizes(self.get_by_type, True, 3)
+
+    def test_ads_by_type_drf(self):
+        # Ads with request counts, owners and rating stats, then the photos
+        self.assertQueriesForSizes(self.get_by_type, False, 2)
+
+    def test_search(self):
+        # Page mode: COUNT(*) and the ids of the page, then the ads and their photos
+        self.assertQueriesForSizes(self.search, True, 4)
+
+    def test_search_drf(self):
+        self.assertQueriesForSizes(self.search, False, 3)
+
+    def test_my_ads(self):
+        self.assertQueriesForSizes(self.my_ads, True, 3)
+
+    def test_my_ads_drf(self):
+        self.assertQueriesForSizes(self.my_ads, False, 2)
+
+
+class SparseFieldsetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = create_user(1)
+        cls.plumbing = AdType.objects.create(name='Plumbing')
+        ad = Ad.objects.create(title='Plumber', description='Leaks and pipes', ad_type=cls.plumbing, cost='50', user=cls.owner)
+        Photo.objects.create(ad=ad, image_url='https://example.com/1.jpg', order=0)
+
+    def get_by_type(self, **params):
+        request = APIRequestFactory().get('/api/ads/get_ads_by_type/', params)
+        return get_ads_by_type(request, self.plumbing.id)
+
+    def test_only_the_requested_fields_are_selected(self):
+        for fast in (True, False):
+            with self.subTest(fast=fast), self.settings(FAST_SERIALIZERS=fast):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.get_by_type(fields='id,title')
+                self.assertEqual([list(ad) for ad in response.data['data']], [['id', 'title']])
+                sql = ' '.join(query['sql'] for query in queries)
+                self.assertIn('"title"', sql)
+                for column in ('"description"', '"ads_photo"', '"supabase_auth_user"', '"ads_adrequest"'):
+                    self.assertNotIn(column, sql)
+
+    def test_omitted_fields_are_left_out(self):
+        for fast in (True, False):
+            with self.subTest(fast=fast), self.settings(FAST_SERIALIZERS=fast):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.get_by_type(omit='photos,description')
+                ad = response.data['data'][0]
+                self.assertNotIn('photos', ad)
+                self.assertNotIn('description', ad)
+                self.assertEqual(ad['user_name'], 'User 1')
+                self.assertFalse(any('"ads_photo"' in query['sql'] for query in queries))
+
+    def test_unknown_fields_are_rejected(self):
+        for params in ({'fields': 'id,password'}, {'omit': 'secret'}):
+            response = self.get_by_type(**params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertFalse(response.data['success'])
+
+        request = APIRequestFactory().get('/api/ads/search/', {'q': 'plumber', 'fields': 'id,password'})
+        response = search_ads(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Unknown fields: password')
+
+
+class AdSearchIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(1)
+        cls.plumbing = AdType.objects.create(name='Plumbing')
+        cls.painting = AdType.objects.create(name='Painting')
+        cls.toronto = City.objects.create(name='Toronto', province='ON')
+        cls.plumber = Ad.objects.create(title='Plumber', description='Leaks and pipes', ad_type=cls.plumbing, cost='50', location='Toronto', user=cls.user)
+        cls.emergency = Ad.objects.create(title='Emergency plumbing', description='24/7 repairs', ad_type=cls.plumbing, cost='80', location='Ottawa', user=cls.user)
+        cls.painter = Ad.objects.create(title='House painter', description='Walls and fences', ad_type=cls.painting, cost='40', location='Toronto', user=cls.user)
+
+    def setUp(self):
+        invalidate_search_keywords()
+        self.index = AdSearchIndex()
+        self.index.build()
+
+    def test_build_indexes_every_active_ad(self):
+        self.assertEqual(self.index.verify(), {})
+        self.assertEqual(self.index.stats()['ads'], 3)
+        self.assertEqual(self.index.city_matches([self.toronto.id]), {self.plumber.id, self.painter.id})
+
+    def test_terms_match_inside_words_and_phrases_need_every_word(self):
+        self.assertEqual(self.index.term_matches('plumb'), {self.plumber.id, self.emergency.id})
+        self.assertEqual(self.index.phrase_matches('emergency plumb'), {self.emergency.id})
+        self.assertEqual(self.index.phrase_matches('plumb fences'), set())
+        self.assertIsNone(self.index.phrase_matches('  '))
+
+    def test_candidates_add_ad_type_and_location_matches(self):
+        self.assertEqual(self.index.candidates('leaks'), {self.plumber.id})
+        self.assertEqual(self.index.candidates('leaks', ad_type_ids=[self.plumbing.id]), {self.plumber.id, self.emergency.id})
+        self.assertEqual(self.index.candidates('leaks', location_keywords='toronto'), {self.plumber.id, self.painter.id})
+        self.assertIsNone(self.index.candidates('!!'))
+
+    def test_update_reindexes_an_ad(self):
+        self.painter.title = 'Plumbing and painting'
+        self.painter.save()
+        self.index.update(self.painter)
+        self.assertIn(self.painter.id, self.index.term_matches('plumb'))
+        self.assertEqual(self.index.term_matches('house'), set())
+        self.assertEqual(self.index.verify(), {})
+
+        self.painter.is_active = False
+        self.painter.save()
+        self.index.update(self.painter)
+        self.assertNotIn(self.painter.id, self.index.term_matches('plumb'))
+        self.assertEqual(self.index.verify(), {})
+
+    def test_remove_drops_an_ad_and_its_unused_words(self):
+        self.index.remove(self.painter.id)
+        self.assertEqual(self.index.term_matches('fences'), set())
+        self.assertFalse(self.index.is_known_token('fences'))
+        self.assertEqual(self.index.city_matches([self.toronto.id]), {self.plumber.id})
+
+    @override_settings(ADS_SEARCH_INDEX_RECONCILE_SECONDS=0)
+    def test_sync_reads_other_workers_changes_and_deletions(self):
+        # Queryset writes send no save signals, like changes made by another worker
+        Ad.objects.filter(id=self.plumber.id).update(title='Drain cleaning', updated_at=timezone.now())
+        Ad.objects.filter(id=self.emergency.id).delete()
+        self.index.sync()
+        self.assertEqual(self.index.term_matches('drain'), {self.plumber.id})
+        self.assertEqual(self.index.term_matches('plumb'), set())
+        self.assertEqual(self.index.verify(), {})
+
+    def test_sync_skips_rows_older_than_the_indexed_ad(self):
+        self.painter.title = 'Plumbing and painting'
+        self.painter.save()
+        self.index.update(self.painter)
+        # A sync that read the row before that save
+        Ad.objects.filter(id=self.painter.id).update(title='House painter', updated_at=self.painter.updated_at - timedelta(seconds=1))
+        self.index.sync()
+        self.assertIn(self.painter.id, self.index.term_matches('plumb'))
+
+    def test_sync_reads_the_database_without_holding_the_index_lock(self):
+        from .search import index as index_module
+        blocked = []
+
+        def search():
+            if self.index._lock.acquire(timeout=1):
+                self.index._lock.release()
+                blocked.append(False)
+            else:
+                blocked.append(True)
+
+        def resolve_cities(location, keywords):
+            # Another thread searches while the sync tokenizes the rows it read
+            searcher = threading.Thread(target=search)
+            searcher.start()
+            searcher.join()
+            return ()
+
+        Ad.objects.filter(id=self.plumber.id).update(updated_at=timezone.now())
+        with mock.patch.object(index_module, 'resolve_cities', side_effect=resolve_cities):
+            self.index.sync()
+        self.assertTrue(blocked)
+        self.assertFalse(any(blocked))
+
+
+class KeywordExtractionTests(SimpleTestCase):
+
+    def keywords(self):
+        cities = [
+            City(id=1, name='Richmond', province='BC'),
+            City(id=2, name='Richmond Hill', province='ON'),
+            City(id=3, name='Richmond', province='QC'),
+            City(id=4, name='Ottawa', province='ON'),
+        ]
+        ad_types = [AdType(id=1, name='Plumbing'), AdType(id=2, name='Emergency Plumbing'), AdType(id=3, name='Painting')]
+        return SearchKeywords(cities, ad_types)
+
+    def test_automaton_finds_overlapping_patterns(self):
+        automaton = KeywordAutomaton(['he', 'she', 'his', 'hers'])
+        self.assertEqual(
+            sorted(automaton.find_all('ushers')),
+            [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')],
+        )
+
+    def test_automaton_follows_fail_links_after_a_partial_match(self):
+        automaton = KeywordAutomaton(['abcd', 'bce'])
+        self.assertEqual(automaton.find_all('abce'), [(1, 4, 'bce')])
+
+    def test_extract_prefers_the_longest_match(self):
+        matches = self.keywords().extract('plumber in richmond hill')
+        self.assertEqual(matches[CITY].keyword, 'Richmond Hill')
+        self.assertEqual(matches[CITY].ids, [2])
+
+    def test_extract_prefers_the_leftmost_of_equal_lengths(self):
+        matches = self.keywords().extract('painting in Ottawa or Richmond')
+        self.assertEqual(matches[CITY].keyword, 'Richmond')
+
+        matches = self.keywords().extract('ottawa painters, not ottawa plumbers')
+        self.assertEqual((matches[CITY].start, matches[CITY].end), (0, 6))
+
+    def test_extract_groups_cities_sharing_a_name_and_types_containing_the_name(self):
+        matches = self.keywords().extract('PLUMBING richmond')
+        self.assertEqual(sorted(matches[CITY].ids), [1, 3])
+        self.assertEqual(matches[AD_TYPE].keyword, 'Plumbing')
+        self.assertEqual(sorted(matches[AD_TYPE].ids), [1, 2])
+
+    def test_extract_without_matches(self):
+        self.assertEqual(self.keywords().extract('gardener'), {})
+
+
+class SearchBackendTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = create_user(1)
+        plumbing = AdType.objects.create(name='Plumbing')
+        painting = AdType.objects.create(name='Painting')
+        Ad.objects.create(title='Plumber', description='Leaks and pipes', ad_type=plumbing, cost='50', location='Toronto', user=user)
+        Ad.objects.create(title='Emergency plumbing', description='24/7 plumber', ad_type=plumbing, cost='80', location='Ottawa', user=user)
+        Ad.objects.create(title='House painter', description='Walls and fences', ad_type=painting, cost='40', location='Toronto', user=user)
+
+    def setUp(self):
+        # The index is per process, rebuild it from this test's ads
+        ad_index.invalidate()
+
+    def search_ids(self, query):
+        return list(search_queryset(query, [], None).values_list('id', flat=True))
+
+    @override_settings(ADS_SEARCH_BACKEND='postgres')
+    def test_postgres_backend_falls_back_to_index_on_sqlite(self):
+        self.assertEqual(get_search_backend(), INDEX_BACKEND)
+
+    def test_postgres_backend_returns_the_index_backend_results_on_sqlite(self):
+        with self.settings(ADS_SEARCH_BACKEND='index'):
+            expected = self.search_ids('plumber')
+        with self.settings(ADS_SEARCH_BACKEND='postgres'):
+            self.assertEqual(self.search_ids('plumber'), expected)
+        self.assertEqual(len(expected), 2)
+
+    def test_save_writes_the_search_vector_in_its_own_statement_when_an_indexed_field_changes(self):
+        ad = Ad.objects.get(title='Plumber')
+        vector = mock.Mock(return_value=Value(None, output_field=SearchVectorField()))
+        with mock.patch('ads.models.connection.vendor', 'postgresql'), \
+                mock.patch('ads.search.backends.ad_search_vector', vector):
+            with CaptureQueriesContext(connection) as queries:
+                ad.title = 'Plumber and gasfitter'
+                ad.save(update_fields=['title'])
+            self.assertEqual(len(queries), 1)
+            self.assertIn('"search_vector"', queries[0]['sql'])
+            vector.assert_called_once_with(ad)
+
+            with CaptureQueriesContext(connection) as queries:
+                ad.is_active = False
+                ad.save(update_fields=['is_active'])
+            self.assertEqual(len(queries), 1)
+            self.assertNotIn('"search_vector"', queries[0]['sql'])
+            vector.assert_called_once()
+
+
+class SearchFacetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = create_user(1)
+        cls.plumbing = AdType.objects.create(name='Plumbing')
+        cls.painting = AdType.objects.create(name='Painting')
+        cls.toronto = City.objects.create(name='Toronto', province='ON')
+        cls.ottawa = City.objects.create(name='Ottawa', province='ON')
+        for ad_type, location, available in [
+            (cls.plumbing, 'Toronto', True), (cls.plumbing, 'Toronto', False), (cls.plumbing, 'Ottawa', True),
+            (cls.painting, 'Toronto', False), (cls.painting, 'Nowhere', False),
+        ]:
+            Ad.objects.create(
+                title='Repairs', description='', ad_type=ad_type, cost='1', location=location,
+                is_available_now=available, user=user,
+            )
+
+    def setUp(self):
+        invalidate_search_keywords()
+        get_search_keywords()
+
+    def test_facets_are_counted_by_grouped_queries(self):
+        with self.assertNumQueries(2):
+            facets = search_facets(Ad.objects.filter(title='Repairs'))
+        self.assertEqual(facets['ad_type'], [
+            {'id': self.plumbing.id, 'name': 'Plumbing', 'count': 3},
+            {'id': self.painting.id, 'name': 'Painting', 'count': 2},
+        ])
+        self.assertEqual(facets['city'], [
+            {'id': self.toronto.id, 'name': 'Toronto, ON', 'count': 3},
+            {'id': self.ottawa.id, 'name': 'Ottawa, ON', 'count': 1},
+        ])
+        self.assertEqual(facets['is_available_now'], {'true': 2, 'false': 3})
+
+
+class RadiusSearchTests(TestCase):
+
+    def test_non_finite_radius_is_rejected(self):
+        for km in ('nan', 'inf', '-inf'):
+            request = APIRequestFactory().get('/api/ads/search/', {'q': 'plumber', 'near': 40, 'km': km})
+            response = search_ads(request)
+            self.assertEqual(response.status_code, 400, km)
+            self.assertFalse(response.data['success'])
+
+
+class SearchPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = create_user(1)
+        plumbing = AdType.objects.create(name='Plumbing')
+        cls.ads = [
+            Ad.objects.create(title='Plumber', description='Leaks and pipes', ad_type=plumbing, cost='50', location='Toronto', user=user)
+            for i in range(5)
+        ]
+
+    def setUp(self):
+        ad_index.invalidate()
+        search_cache.clear()
+
+    def search(self, **params):
+        request = APIRequestFactory().get('/api/ads/search/', {'q': 'plumber', **params})
+        return search_ads(request)
+
+    def test_limit_is_clamped(self):
+        for limit in (0, -5):
+            response = self.search(cursor='', limit=limit)
+            self.assertEqual(response.status_code, 200, limit)
+            self.assertEqual(len(response.data['data']), 1, limit)
+            self.assertTrue(response.data['has_next'], limit)
+
+        with mock.patch('ads.views.MAX_PAGE_SIZE', 2):
+            response = self.search(cursor='', limit=1000)
+        self.assertEqual(len(response.data['data']), 2)
+
+    def test_non_integer_limit_or_page_is_rejected(self):
+        for params in ({'limit': 'ten'}, {'limit': '2.5', 'cursor': ''}, {'page': 'last'}):
+            response = self.search(**params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertFalse(response.data['success'])
+
+    def test_invalid_cursor_is_rejected(self):
+        for cursor in ('not-a-cursor', 'WyJhIiwgImIiLCAiYyJd'):
+            response = self.search(cursor=cursor, limit=2)
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(response.data['error'], 'Invalid cursor')
+
+    def test_cursor_walks_every_result_once_then_stops(self):
+        seen = []
+        cursor = ''
+        for _ in range(len(self.ads)):
+            response = self.search(cursor=cursor, limit=2)
+            seen.extend(ad['id'] for ad in response.data['data'])
+            if not response.data['has_next']:
+                break
+            cursor = response.data['next_cursor']
+        self.assertFalse(response.data['has_next'])
+        self.assertIsNone(response.data['next_cursor'])
+        self.assertEqual(sorted(seen), sorted(ad.id for ad in self.ads))
+
+
+class FuzzySearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = create_user(1)
+        plumbing = AdType.objects.create(name='Plumbing')
+        for i in range(3):
+            Ad.objects.create(title='Plumber', description='Leaks and pipes', ad_type=plumbing, cost='50', location='Toronto', user=user)
+
+    def setUp(self):
+        ad_index.invalidate()
+        ad_index.ensure_ready()
+
+    def search(self, **params):
+        request = APIRequestFactory().get('/api/ads/search/', params)
+        return search_ads(request)
+
+    def test_misspelled_query_is_corrected(self):
+        response = self.search(q='plumbr', cursor='')
+        self.assertEqual(response.data['corrected_query'], 'plumber')
+        self.assertEqual(len(response.data['data']), 3)
+
+    @override_settings(ADS_SEARCH_FUZZY_MIN_RESULTS=3)
+    def test_full_first_page_is_neither_counted_nor_corrected(self):
+        with mock.patch('ads.views.correct_query') as correct_query, \
+                mock.patch('ads.views.approximate_count') as approximate_count:
+            response = self.search(q='plumber', cursor='', limit=3)
+        self.assertEqual(len(response.data['data']), 3)
+        correct_query.assert_not_called()
+        approximate_count.assert_not_called()
+
+    def test_candidate_gathering_stops_at_the_deadline(self):
+        self.assertEqual(ad_index.similar_tokens('plumbr', 10, deadline=0), [])
+        self.assertIsNone(closest_token('plumbr', deadline=0))
+        self.assertTrue(ad_index.similar_tokens('plumbr', 10))
+
+
+class SearchResultCacheTests(SimpleTestCase):
+
+    def test_result_read_before_an_invalidation_is_not_cached(self):
+        cache = SearchResultCache()
+        generation = cache.generation
+        # An ad is saved while the search is reading the database
+        cache.invalidate()
+        cache.set('plumber', [1], {'data': 'stale'}, generation)
+        self.assertIsNone(cache.get('plumber'))
+
+    def test_result_of_the_current_generation_is_cached(self):
+        cache = SearchResultCache()
+        cache.set('plumber', [1], {'data': 'fresh'}, cache.generation)
+        self.assertEqual(cache.get('plumber'), {'data': 'fresh'})
+
+
+class SuggestionIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = create_user(1)
+        services = AdType.objects.create(name='Home services')
+        for i, title in enumerate(['Plumber', 'Pipe repair', 'Plumber', 'Painter', 'Pool cleaning', 'Pipe repair', 'Plumber']):
+            Ad.objects.create(title=title, description='', ad_type=services, cost='1', tags=f'tag{i}', user=user)
+
+    def setUp(self):
+        invalidate_search_keywords()
+        self.index = SuggestionIndex()
+        self.index.build()
+
+    def walked(self, prefix, limit):
+        """The suggestions for prefix found by walking every matching phrase"""
+        keys = {key for key in self.index._counts if any(start.startswith(prefix) for start in key.split(' '))}
+        best = sorted(keys, key=lambda key: self.index._rank(self.index._counts, prefix, key))[:limit]
+        return [{'text': self.index._labels[key], 'count': self.index._counts[key]} for key in best]
+
+    def test_short_prefixes_match_a_full_walk(self):
+        for prefix in ('p', 'pl', 'pi', 't', 'ta'):
+            self.assertEqual(self.index.suggest(prefix, 5), self.walked(prefix, 5), prefix)
+        self.assertEqual(self.index.suggest('p', 1), [{'text': 'Plumber', 'count': 3}])
+
+    def test_short_prefix_rankings_follow_incremental_updates(self):
+        user = User.objects.get()
+        for _ in range(4):
+            ad = Ad.objects.create(title='Pool cleaning', description='', ad_type_id=Ad.objects.first().ad_type_id, cost='1', user=user)
+            self.index.update(ad)
+        self.assertEqual(self.index.suggest('p', 1), [{'text': 'Pool cleaning', 'count': 5}])
+        for ad in Ad.objects.filter(title='Plumber'):
+            self.index.remove(ad.id)
+        self.assertEqual(self.index.suggest('pl', 5), self.walked('pl', 5))
+        self.assertEqual(self.index.suggest('p', 20), self.walked('p', 20))
+
+    def test_invalidate_keeps_answering_while_rebuilding(self):
+        building, release = threading.Event(), threading.Event()
+
+        def slow_build():
+            building.set()
+            release.wait(5)
+
+        with mock.patch.object(self.index, 'build', side_effect=slow_build):
+            self.index.invalidate()
+            self.assertTrue(building.wait(5))
+            # The rebuild is still reading the database, lookups use the current phrases
+            self.assertEqual(self.index.suggest('plu', 1), [{'text': 'Plumber', 'count': 3}])
+            release.set()
@@ -3,15 +3,55 @@ from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
 from .models import Ad, AdType, Photo, AdRequest, Review, City
+from .fast_serializers import serialize_ads, fast_serializers_enabled
+from .querysets import ad_list_queryset
 from .serializers import AdSerializer, AdTypeSerializer, AdRequestSerializer, CitySerializer, ReviewSerializer
+from .search.backends import search_queryset, nearby_ad_ids
+from .search.cache import search_cache, normalize_query
+from .search.facets import search_facets
+from .search.fuzzy import correct_query, fuzzy_stats
+from .search.index import ad_index, tokenize
+from .search.keywords import get_search_keywords, CITY, AD_TYPE
+from .search.pagination import MAX_PAGE_SIZE, paginate_by_cursor, approximate_count, InvalidCursor
+from .search.suggest import MAX_SUGGESTIONS, suggestion_index
+import math
 import uuid
 import json
 from contractingo.supabase_client import supabase
-from django.db import models
-from django.db.models import Q, Case, When, IntegerField, Value
+from django.conf import settings
+from django.db import models, transaction
 from django.core.paginator import Paginator
 import re
 
+def requested_ad_fields(request):
+    """
+    Get the AdSerializer fields a list request asked for with ?fields=a,b or ?omit=c,d, or None for all of them.
+    Raises ValueError for unknown field names
+    """
+    fields = [name.strip() for name in request.GET.get('fields', '').split(',') if name.strip()]
+    omit = [name.strip() for name in request.GET.get('omit', '').split(',') if name.strip()]
+    if not fields and not omit:
+        return None
+
+    unknown = set(fields + omit) - set(AdSerializer.Meta.fields)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    selected = set(fields or AdSerializer.Meta.fields) - set(omit)
+    return tuple(name for name in AdSerializer.Meta.fields if name in selected)
+
+def ad_list_data(ads, fields=None):
+    """Serialize a list of ads, with the fast serializer when enabled (see fast_serializers.py)"""
+    if fast_serializers_enabled():
+        return serialize_ads(ads.values_list('id', flat=True), fields)
+    return AdSerializer(ad_list_queryset(ads, fields), many=True, fields=fields).data
+
+def invalid_fields_response(error):
+    return Response({
+        'success': False,
+        'error': str(error)
+    }, status=status.HTTP_400_BAD_REQUEST)
+
 class IsOwnerOrReadOnly(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         if request.method in permissions.SAFE_METHODS:
@@ -26,6 +66,16 @@ class AdViewSet(viewsets.ModelViewSet):
     # Want to make sure the user is authenticated and only the owner can edit or delete the ad
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
 
+    def list(self, request, *args, **kwargs):
+        # Lists load request counts, ratings, owners and photos up front (see querysets.py); single ad actions
+        # modify photos after loading the ad, so they keep reading them lazily
+        try:
+            fields = requested_ad_fields(request)
+        except ValueError as e:
+            return invalid_fields_response(e)
+        ads = self.filter_queryset(self.get_queryset())
+        return Response(ad_list_data(ads, fields))
+
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
@@ -45,11 +95,14 @@ class AdViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=['get'])
     def my_ads(self, request):
+        try:
+            fields = requested_ad_fields(request)
+        except ValueError as e:
+            return invalid_fields_response(e)
         ads = Ad.objects.filter(user=request.user)
-        serializer = self.get_serializer(ads, many=True)
         return Response({
             'success': True,
-            'data': serializer.data
+            'data': ad_list_data(ads, fields)
         })   
     
     @action(detail=False, methods=['get'], permission_classes=[permissions.AllowAny])
@@ -396,14 +449,15 @@ class AdReviewViewSet(viewsets.ModelViewSet):
                 'error': 'Only the requester can review this ad'
             }, status=status.HTTP_403_FORBIDDEN)
         
-        # Create review
-        review = Review.objects.create(
-            ad_request=ad_request,
-            reviewer=request.user,
-            reviewee=ad_request.ad.user,
-            rating=rating,
-            comment=comment
-        )
+        # Create review, the reviewee's rating stats are updated in the same transaction (see signals.py)
+        with transaction.atomic():
+            review = Review.objects.create(
+                ad_request=ad_request,
+                reviewer=request.user,
+                reviewee=ad_request.ad.user,
+                rating=rating,
+                comment=comment
+            )
 
         serializer = ReviewSerializer(review)
         return Response({
@@ -478,11 +532,14 @@ class AdReviewViewSet(viewsets.ModelViewSet):
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
 def get_ads_by_type(request, ad_type_id):
+    try:
+        fields = requested_ad_fields(request)
+    except ValueError as e:
+        return invalid_fields_response(e)
     ads = Ad.objects.filter(ad_type_id=ad_type_id, is_active=True)
-    serializer = AdSerializer(ads, many=True)
     return Response({
         'success': True,
-        'data': serializer.data
+        'data': ad_list_data(ads, fields)
     })
 
 @api_view(['GET'])
@@ -507,19 +564,63 @@ def get_all_cities(request):
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
 def search_ads(request):
-    query = request.GET.get('q', '').strip()
-    page_num = int(request.GET.get('page', 1))
-    limit = int(request.GET.get('limit', 20))
+    query = ' '.join(request.GET.get('q', '').split())
+    try:
+        page_num = int(request.GET.get('page', 1))
+        limit = min(max(int(request.GET.get('limit', 20)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return Response({
+            'success': False,
+            'error': 'page and limit must be integers'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    cursor_mode = 'cursor' in request.GET
+    with_facets = bool(request.GET.get('facets'))
 
     if not query:
         return Response({
             'success': False,
             'error': 'Search query is required'
         }, status=status.HTTP_400_BAD_REQUEST)
+
+    # Sparse fieldset (?fields= / ?omit=)
+    try:
+        fields = requested_ad_fields(request)
+    except ValueError as e:
+        return invalid_fields_response(e)
     
+    # Radius filter: ?near=<city id>&km=<radius>
+    near_city_id = request.GET.get('near')
+    try:
+        near_city_id = int(near_city_id) if near_city_id else None
+        km = float(request.GET.get('km', settings.ADS_SEARCH_NEAR_DEFAULT_KM))
+        if not math.isfinite(km):
+            # nan / inf would get through the clamp below
+            raise ValueError(km)
+    except ValueError:
+        return Response({
+            'success': False,
+            'error': 'near must be a city id and km a number'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    km = min(max(km, 0), settings.ADS_SEARCH_NEAR_MAX_KM)
+
+    # Popular queries are answered from the result cache
+    near_key = (near_city_id, km) if near_city_id else None
+    if cursor_mode:
+        cache_key = (normalize_query(query), near_key, with_facets, fields, 'cursor', request.GET.get('cursor'), limit, bool(request.GET.get('with_total')))
+    else:
+        cache_key = (normalize_query(query), near_key, with_facets, fields, 'page', page_num, limit)
+
+    # Read before the database, so a write made while this search runs keeps its result out of the cache
+    cache_generation = search_cache.generation
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return Response(cached)
+
     # Parse Query
     query_lower = query.lower()
-    search_terms = query_lower.split()
+
+    # Find the city and service names mentioned in the query in one pass
+    keywords = get_search_keywords().extract(query_lower)
 
     # Extract location
     location_keywords = None
@@ -528,108 +629,146 @@ def search_ads(request):
 
     if location_match:
         location_keywords = location_match.group(1).strip()
-    else:
-        cities = City.objects.all()
-        for city in cities:
-            if city.name.lower() in query_lower:
-                location_keywords = city.name
-                break
+    elif CITY in keywords:
+        location_keywords = keywords[CITY].keyword
     
+    # "near <city>": also match ads in the cities around it, not just ads naming it
+    location_ad_ids = None
+    if (
+        location_match
+        and location_match.group(0).startswith('near')
+        and CITY in keywords
+        and keywords[CITY].start == location_match.start(1)
+    ):
+        location_keywords = keywords[CITY].keyword
+        location_ad_ids = nearby_ad_ids(keywords[CITY].ids[0], settings.ADS_SEARCH_NEAR_DEFAULT_KM)
+
     # Extract service type by matching against ad type names
-    service_keywords = None
-    ad_types = AdType.objects.all()
-    for ad_type in ad_types:
-        if ad_type.name.lower() in query_lower:
-            service_keywords = ad_type.name
-            break
-    
-    ads = Ad.objects.filter(is_active=True)
-
-    relevance_score = Case(
-        # Exact title match: 10 points
-        When(title__iexact=query, then=Value(10)),
-        # Partial title match: +5 points
-        When(title__icontains=query, then=Value(5)),
-        default=Value(0),
-        output_field=IntegerField()
-    )
-
-    # Add ad type score
-    if service_keywords:
-        relevance_score = relevance_score + Case(
-            When(ad_type__name__icontains=service_keywords, then=Value(8)),
-            default=Value(0),
-            output_field=IntegerField(),
-        )
-    
-    # Add location score
-    if location_keywords:
-        relevance_score = relevance_score + Case(
-            When(location__icontains=location_keywords, then=Value(7)),
-            default=Value(0),
-            output_field=IntegerField(),
-        )
-    
-    # Add description/tags/skills score
-    relevance_score = relevance_score + Case(
-        When(description__icontains=query, then=Value(3)),
-        default=Value(0),
-        output_field=IntegerField(),
-    )
-    
-    relevance_score = relevance_score + Case(
-        When(tags__icontains=query, then=Value(3)),
-        default=Value(0),
-        output_field=IntegerField(),
-    )
-
-    relevance_score = relevance_score + Case(
-        When(skills__icontains=query, then=Value(3)),
-        default=Value(0),
-        output_field=IntegerField(),
-    )
-
-    # Build final query with OR conditions
-    q_objects = Q(title__icontains=query) | Q(description__icontains=query)
-
-    if service_keywords:
-        q_objects |= Q(ad_type__name__icontains=service_keywords)
-    
-    if location_keywords:
-        q_objects |= Q(location__icontains=location_keywords)
-    
-    q_objects |= Q(tags__icontains=query) | Q(skills__icontains=query)
+    service_type_ids = keywords[AD_TYPE].ids if AD_TYPE in keywords else []
 
-    ads = ads.filter(q_objects).annotate(
-        relevance=relevance_score
-    ).order_by('-relevance', '-created_at').distinct()
+    near_ids = None
+    if near_city_id:
+        near_ids = nearby_ad_ids(near_city_id, km)
+        if near_ids is None:
+            return Response({
+                'success': False,
+                'error': 'Unknown city or city has no coordinates'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+    ads = search_queryset(query, service_type_ids, location_keywords, location_ad_ids)
+    if near_ids is not None:
+        ads = ads.filter(id__in=near_ids)
+
+    # The fast serializer loads the page's ads itself, only their positions are needed here.
+    # Otherwise load request counts, ratings, owners and photos with the page instead of per ad
+    fast = fast_serializers_enabled()
+    try:
+        page, pagination = paginate_search(ads, fast, fields, cursor_mode, request.GET.get('cursor'), page_num, limit)
+
+        # Typo tolerance: when the exact search finds (almost) nothing, retry with misspelled words corrected.
+        # Only a short first page can mean that, so other searches never count or fuzz
+        corrected_query = None
+        min_results = settings.ADS_SEARCH_FUZZY_MIN_RESULTS
+        first_page = not request.GET.get('cursor') if cursor_mode else pagination['current_page'] == 1
+        if min_results and first_page and has_fewer_results(ads, page, limit, min_results):
+            keep = {'near'}
+            for match in keywords.values():
+                keep.update(tokenize(match.keyword))
+            corrected_query = correct_query(query_lower, keep)
+            if corrected_query:
+                ads = search_queryset(corrected_query, service_type_ids, location_keywords, location_ad_ids)
+                if near_ids is not None:
+                    ads = ads.filter(id__in=near_ids)
+                page, pagination = paginate_search(ads, fast, fields, cursor_mode, request.GET.get('cursor'), page_num, limit)
+    except InvalidCursor:
+        return Response({
+            'success': False,
+            'error': 'Invalid cursor'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    # Serialize results
+    page_ids = [ad.id for ad in page]
+    response_data = {
+        'success': True,
+        'data': serialize_ads(page_ids, fields) if fast else AdSerializer(page, many=True, fields=fields).data,
+        **pagination
+    }
+
+    # Optional total in cursor mode, counted up to a cap so it stays cheap on huge result sets
+    if cursor_mode and request.GET.get('with_total'):
+        cap = settings.ADS_SEARCH_APPROX_TOTAL_CAP
+        approx_total = approximate_count(ads, cap)
+        response_data['approx_total'] = approx_total
+        response_data['approx_total_capped'] = approx_total >= cap
+
+    if corrected_query:
+        response_data['corrected_query'] = corrected_query
+
+    # Optional facet counts (?facets=1) over all matching ads, in one query whatever the number of values
+    if with_facets:
+        response_data['facets'] = search_facets(ads)
+
+    search_cache.set(cache_key, page_ids, response_data, cache_generation)
+    return Response(response_data)
+
+def paginate_search(ads, fast, fields, cursor_mode, cursor, page_num, limit):
+    """Get (the ads of the requested page, its pagination fields for the response) of a search"""
+    page_ads = ads.only('id', 'created_at') if fast else ad_list_queryset(ads, fields)
+
+    # Cursor mode (?cursor=, empty for the first page): keyset pagination without COUNT(*) or OFFSET
+    if cursor_mode:
+        page, next_cursor = paginate_by_cursor(page_ads, cursor, limit)
+        return page, {
+            'next_cursor': next_cursor,
+            'has_next': next_cursor is not None
+        }
+
+    paginator = Paginator(page_ads, limit)
 
-    paginator = Paginator(ads, limit)
-    
     try:
         page_obj = paginator.page(page_num)
     except:
         page_obj = paginator.page(1)
         page_num = 1
-    
-    # Serialize results
-    serializer = AdSerializer(page_obj.object_list, many=True)
 
-    return Response({
-        'success': True,
-        'data': serializer.data,
+    return list(page_obj.object_list), {
         'total': paginator.count,
         'current_page': page_num,
         'total_pages': paginator.num_pages,
         'has_next': page_obj.has_next(),
         'has_previous': page_obj.has_previous()
-    })
-
-
-
+    }
 
+def has_fewer_results(ads, first_page, limit, min_results):
+    """Whether a search found fewer than min_results ads, told by its first page unless that page is full"""
+    if len(first_page) < limit:
+        return len(first_page) < min_results
+    return limit < min_results and approximate_count(ads, min_results) < min_results
 
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+def get_search_suggestions(request):
+    """Typeahead suggestions for the search box, answered from memory"""
+    prefix = request.GET.get('q', '')
+    try:
+        limit = min(max(int(request.GET.get('limit', 8)), 1), MAX_SUGGESTIONS)
+    except ValueError:
+        limit = 8
 
-    
-
+    suggestion_index.ensure_ready()
+    return Response({
+        'success': True,
+        'data': suggestion_index.suggest(prefix, limit)
+    })
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def get_search_stats(request):
+    """Get search cache hit/miss counters and search index size for this worker"""
+    return Response({
+        'success': True,
+        'cache': search_cache.stats(),
+        'index': ad_index.stats(),
+        'suggestions': suggestion_index.stats(),
+        'fuzzy': fuzzy_stats.stats()
+    })
@@ -0,0 +1,354 @@
+import asyncio
+import logging
+import uuid
+import weakref
+import zlib
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .fast_json import dumps_bytes, loads
+from .resp import CONNECTION_ERRORS, RedisConnection, encode_command, read_reply
+
+logger = logging.getLogger(__name__)
+
+"""
+SHARDED REDIS CHANNEL LAYER:
+
+    InMemoryChannelLayer only reaches consumers in its own process, so group_send from one Daphne worker never
+    got to sockets held by another. ShardedRedisChannelLayer routes everything through Redis pub/sub instead:
+        - Groups are pub/sub channels ("<prefix>:group:conversation_<id>"). A process subscribes to a group
+          while at least one of its consumers is in it, and fans a published message out to its local members,
+          so a group_send is one PUBLISH however many workers and sockets are listening
+        - Specific channels (self.channel_name) are named after their process, "specific.<process>!<id>", and
+          sent to through that process' inbox channel ("<prefix>:<process>")
+        - Groups and inboxes are sharded over the configured servers by CRC32 of their name, so every process
+          agrees on where conversation_<id> lives and the load spreads over the servers
+        - group_send_batch pipelines many group sends into one write per server
+        - Pub/sub doesn't store anything: a message published while nobody in a group is connected is dropped,
+          and a crashed worker's subscriptions go away with its connections (no expiring group membership)
+
+    Each event loop gets its own connections and process name (sync views reach the layer via async_to_sync,
+    which runs a short-lived loop per call). They are closed when the loop shuts down: asyncio.run (which
+    async_to_sync uses) cancels the tasks still pending before closing the loop, and a task waiting for that
+    closes the connections. Loops are weakly referenced, so one closed some other way doesn't stay around.
+
+    Configured with CHANNEL_LAYER=redis and REDIS_URLS (see settings.py). Works against Redis or the in-repo
+    stand-in (manage.py redis_standin); manage.py check_channel_layer proves cross-process fan-out.
+"""
+
+
+class Subscriber:
+    """The subscribed connection to one server, passing published messages to on_message(channel, data)"""
+
+    RECONNECT_DELAYS = (0.1, 0.5, 1, 2, 5)
+
+    def __init__(self, url, on_message):
+        self.connection = RedisConnection(url)
+        self.on_message = on_message
+        self.channels = set()
+        self.pending = {}
+        self.task = None
+
+    async def subscribe(self, channel):
+        """Subscribe to a channel, returning once the server confirmed it"""
+        self.channels.add(channel)
+        if self.task is None:
+            await self.connection.connect()
+            self.task = asyncio.create_task(self.read_forever())
+
+        confirmed = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(channel, []).append(confirmed)
+        self.write(encode_command('SUBSCRIBE', channel))
+        await confirmed
+
+    async def unsubscribe(self, channel):
+        self.channels.discard(channel)
+        self.write(encode_command('UNSUBSCRIBE', channel))
+
+    def write(self, data):
+        # While reconnecting there is nothing to write to, reconnect() subscribes to self.channels again
+        if self.connection.writer is not None:
+            self.connection.writer.write(data)
+
+    async def read_forever(self):
+        while True:
+            try:
+                reply = await read_reply(self.connection.reader)
+            except CONNECTION_ERRORS:
+                await self.reconnect()
+                continue
+
+            if not isinstance(reply, list) or len(reply) != 3:
+                continue
+            kind, channel = reply[0].decode(), reply[1].decode()
+            if kind == 'message':
+                try:
+                    self.on_message(channel, reply[2])
+                except Exception:
+                    logger.exception('Error delivering a message from %s', channel)
+            elif kind == 'subscribe':
+                waiting = self.pending.get(channel)
+                if waiting:
+                    future = waiting.pop(0)
+                    if not waiting:
+                        del self.pending[channel]
+                    if not future.done():
+                        future.set_result(True)
+
+    async def reconnect(self):
+        """Reconnect and subscribe to every channel again, retrying with backoff"""
+        self.connection.close()
+        attempt = 0
+        while True:
+            try:
+                await self.connection.connect()
+                if self.channels:
+                    self.write(b''.join(encode_command('SUBSCRIBE', channel) for channel in self.channels))
+                    await self.connection.writer.drain()
+                return
+            except CONNECTION_ERRORS:
+                self.connection.close()
+                delay = self.RECONNECT_DELAYS[min(attempt, len(self.RECONNECT_DELAYS) - 1)]
+                logger.warning('Channel layer lost its connection to %s:%s, retrying in %ss', self.connection.host, self.connection.port, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.task = None
+        self.connection.close()
+        for waiting in self.pending.values():
+            for future in waiting:
+                future.cancel()
+        self.pending = {}
+
+
+class LoopChannelLayer:
+    """The state of the layer in one event loop: its process name, connections, local channels and groups"""
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.name = uuid.uuid4().hex
+        self.inbox = layer.inbox_channel(self.name)
+        self.publishers = [RedisConnection(host) for host in layer.hosts]
+        self.subscribers = [Subscriber(host, self.dispatch) for host in layer.hosts]
+        self.channels = {}
+        self.groups = {}
+        self.subscriptions = {}
+        self.closer = None
+
+    # Subscriptions, shared by everyone in this loop who needs them
+
+    async def subscribe(self, shard, channel):
+        task = self.subscriptions.get(channel)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = self.subscriptions[channel] = asyncio.ensure_future(self.subscribers[shard].subscribe(channel))
+        await asyncio.shield(task)
+
+    async def unsubscribe(self, shard, channel):
+        if self.subscriptions.pop(channel, None) is not None:
+            await self.subscribers[shard].unsubscribe(channel)
+
+    # Local delivery
+
+    def is_local(self, channel):
+        return '!' in channel and channel.split('!', 1)[0].rsplit('.', 1)[-1] == self.name
+
+    def queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.layer.get_capacity(channel))
+        return queue
+
+    def deliver(self, channel, data):
+        """Hand a published message to a channel of this loop, dropping it if the channel is gone or full"""
+        queue = self.channels.get(channel)
+        if queue is None:
+            if not self.is_local(channel):
+                # A group member living in another process
+                asyncio.ensure_future(self.send(channel, loads(data)))
+            return
+        if queue.full():
+            logger.warning('Channel %s is full, dropping a message', channel)
+            return
+        queue.put_nowait(loads(data))
+
+    def dispatch(self, redis_channel, data):
+        if redis_channel == self.inbox:
+            channel, message = data.split(b'\n', 1)
+            self.deliver(channel.decode(), message)
+        elif redis_channel.startswith(self.layer.group_prefix):
+            for channel in list(self.groups.get(redis_channel[len(self.layer.group_prefix):], ())):
+                self.deliver(channel, data)
+        elif redis_channel.startswith(self.layer.channel_prefix):
+            self.deliver(redis_channel[len(self.layer.channel_prefix):], data)
+
+    # Channel layer API
+
+    async def new_channel(self, prefix):
+        await self.subscribe(self.layer.shard(self.name), self.inbox)
+        channel = f'{prefix}{self.name}!{uuid.uuid4().hex}'
+        self.queue(channel)
+        return channel
+
+    async def send(self, channel, message):
+        if self.is_local(channel):
+            queue = self.queue(channel)
+            if queue.full():
+                raise ChannelFull(channel)
+            queue.put_nowait(message)
+            return
+
+        if '!' in channel:
+            # Specific channel of another process: through its inbox
+            process = channel.split('!', 1)[0].rsplit('.', 1)[-1]
+            shard, redis_channel = self.layer.shard(process), self.layer.inbox_channel(process)
+            data = channel.encode() + b'\n' + dumps_bytes(message)
+        else:
+            shard, redis_channel = self.layer.shard(channel), self.layer.channel_prefix + channel
+            data = dumps_bytes(message)
+        await self.publishers[shard].execute('PUBLISH', redis_channel, data)
+
+    async def receive(self, channel):
+        if '!' not in channel:
+            # Named channel: listen to it on its shard
+            self.queue(channel)
+            await self.subscribe(self.layer.shard(channel), self.layer.channel_prefix + channel)
+        queue = self.queue(channel)
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # The consumer is gone (disconnected or crashed): forget its channel and group memberships
+            await asyncio.shield(self.forget_channel(channel))
+            raise
+
+    async def forget_channel(self, channel):
+        self.channels.pop(channel, None)
+        for group, members in list(self.groups.items()):
+            if channel in members:
+                await self.group_discard(group, channel)
+
+    async def group_add(self, group, channel):
+        members = self.groups.setdefault(group, set())
+        members.add(channel)
+        await self.subscribe(self.layer.shard(group), self.layer.group_prefix + group)
+
+    async def group_discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.groups[group]
+            await self.unsubscribe(self.layer.shard(group), self.layer.group_prefix + group)
+
+    async def group_send_batch(self, sends):
+        commands = {}
+        for group, message in sends:
+            commands.setdefault(self.layer.shard(group), []).append(
+                ('PUBLISH', self.layer.group_prefix + group, dumps_bytes(message))
+            )
+        await asyncio.gather(*(
+            self.publishers[shard].execute_many(shard_commands) for shard, shard_commands in commands.items()
+        ))
+
+    async def close(self):
+        for subscriber in self.subscribers:
+            await subscriber.close()
+        for publisher in self.publishers:
+            publisher.close()
+        self.channels = {}
+        self.groups = {}
+        self.subscriptions = {}
+
+
+class ShardedRedisChannelLayer(BaseChannelLayer):
+    """Channel layer over Redis pub/sub, groups and process inboxes sharded over hosts"""
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, hosts=None, prefix='asgi', expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.hosts = list(hosts or ['redis://localhost:6379'])
+        self.prefix = prefix
+        self.group_prefix = f'{prefix}:group:'
+        self.channel_prefix = f'{prefix}:channel:'
+        self.loop_layers = weakref.WeakKeyDictionary()
+
+    def shard(self, name):
+        """Index of the server a group, named channel or process inbox lives on"""
+        return zlib.crc32(name.encode()) % len(self.hosts)
+
+    def inbox_channel(self, process):
+        return f'{self.prefix}:{process}'
+
+    def current(self):
+        """Get the state of the layer in the running event loop, closed when the loop shuts down"""
+        loop = asyncio.get_running_loop()
+        loop_layer = self.loop_layers.get(loop)
+        if loop_layer is None:
+            loop_layer = self.loop_layers[loop] = LoopChannelLayer(self)
+            loop_layer.closer = loop.create_task(self.close_on_shutdown(loop, loop_layer))
+        return loop_layer
+
+    async def close_on_shutdown(self, loop, loop_layer):
+        """Wait until the loop cancels its pending tasks on shutdown, then close the loop's connections"""
+        try:
+            await loop.create_future()
+        except asyncio.CancelledError:
+            if self.loop_layers.get(loop) is loop_layer:
+                del self.loop_layers[loop]
+                await loop_layer.close()
+            raise
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        return await self.current().new_channel(prefix)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self.current().send(channel, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        return await self.current().receive(channel)
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self.current().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self.current().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self.current().group_send_batch([(group, message)])
+
+    async def group_send_batch(self, sends):
+        """Send many (group, message) pairs, pipelined into one write per server"""
+        sends = list(sends)
+        for group, _ in sends:
+            assert self.valid_group_name(group), 'Group name not valid'
+        if sends:
+            await self.current().group_send_batch(sends)
+
+    async def flush(self):
+        loop_layer = self.loop_layers.pop(asyncio.get_running_loop(), None)
+        if loop_layer is not None:
+            loop_layer.closer.cancel()
+            await loop_layer.close()
+
+    async def close(self):
+        await self.flush()
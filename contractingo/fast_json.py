@@ -0,0 +1,113 @@
+import json
+import math
+from decimal import Decimal
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+FAST JSON:
+
+    DRF renders every REST response with the stdlib json module and the websocket consumer encodes and decodes
+    every frame and group fan-out with it too. orjson does the same work in native code:
+        - datetimes, dates, times and UUIDs are encoded natively, UTC written as "Z" like DRF does
+        - Decimals and anything else orjson doesn't know (lazy strings, querysets, ...) go through DRF's
+          JSONEncoder.default, so the output matches DRF's renderer
+        - Payloads orjson refuses (e.g. integers over 64 bits) fall back to the stdlib encoder
+        - FastJSONRenderer escapes U+2028 / U+2029 like DRF does. orjson writes NaN and Infinity as null, so when
+          the output has a null and the data a non-finite number, DRF renders it instead (and raises, with the
+          default STRICT_JSON)
+
+    FAST_JSON = False (or orjson not being installed) switches everything back to the stdlib json module.
+    manage.py benchmark_json compares both on real Ad and Message payloads.
+"""
+
+_drf_encoder = JSONEncoder()
+
+ORJSON_OPTIONS = (orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+
+def fast_json_enabled():
+    return orjson is not None and getattr(settings, 'FAST_JSON', True)
+
+
+def dumps_bytes(data):
+    """Encode data to UTF-8 JSON bytes"""
+    if fast_json_enabled():
+        try:
+            return orjson.dumps(data, default=_drf_encoder.default, option=ORJSON_OPTIONS)
+        except TypeError:
+            pass
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def dumps(data):
+    """Encode data to a JSON string (e.g. for websocket text frames)"""
+    return dumps_bytes(data).decode()
+
+
+def loads(data):
+    """Decode JSON text or bytes. Invalid JSON raises json.JSONDecodeError (orjson's error subclasses it)"""
+    if fast_json_enabled():
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def has_non_finite(data):
+    """Whether data holds a NaN or infinite float (or Decimal), in any nested dict / list / tuple"""
+    pending = [data]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+        elif isinstance(value, float) and not math.isfinite(value):
+            return True
+        elif isinstance(value, Decimal) and not value.is_finite():
+            return True
+    return False
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer using orjson, same output as DRF's compact UTF-8 JSON"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # Indented (browsable / ?indent), ASCII-only or spaced output stays with DRF
+        if (
+            not fast_json_enabled()
+            or self.ensure_ascii
+            or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {})
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            rendered = orjson.dumps(data, default=_drf_encoder.default, option=ORJSON_OPTIONS)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        if b'null' in rendered and has_non_finite(data):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Line / paragraph separators are valid JSON but not valid JavaScript, DRF escapes them
+        return rendered.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class FastJSONParser(JSONParser):
+    """JSONParser using orjson"""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if not fast_json_enabled():
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
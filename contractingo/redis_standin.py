@@ -0,0 +1,101 @@
+import asyncio
+
+from .resp import CONNECTION_ERRORS, ReplyError, read_reply
+
+"""
+REDIS STAND-IN:
+
+    A small asyncio server speaking the part of the Redis protocol the channel layer uses (PUBLISH, SUBSCRIBE,
+    UNSUBSCRIBE, PING, AUTH, SELECT), so several ASGI workers can share a channel layer on a machine without
+    Redis, e.g. in development and in manage.py check_channel_layer. Run it with manage.py redis_standin.
+    Production should point REDIS_URLS at real Redis servers.
+"""
+
+
+def encode_reply(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, str):
+        return b'+%s\r\n' % value.encode()
+    if isinstance(value, ReplyError):
+        return b'-%s\r\n' % str(value).encode()
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    return b'*%d\r\n' % len(value) + b''.join(encode_reply(item) for item in value)
+
+
+class PubSubServer:
+
+    def __init__(self):
+        self.subscribers = {}
+
+    def publish(self, channel, data):
+        """Send data to every subscriber of channel, returns how many there were"""
+        writers = self.subscribers.get(channel, ())
+        message = encode_reply([b'message', channel, data])
+        for writer in writers:
+            writer.write(message)
+        return len(writers)
+
+    def subscribe(self, writer, subscribed, channels):
+        replies = []
+        for channel in channels:
+            self.subscribers.setdefault(channel, set()).add(writer)
+            subscribed.add(channel)
+            replies.append([b'subscribe', channel, len(subscribed)])
+        return replies
+
+    def unsubscribe(self, writer, subscribed, channels):
+        replies = []
+        for channel in channels or list(subscribed):
+            writers = self.subscribers.get(channel)
+            if writers is not None:
+                writers.discard(writer)
+                if not writers:
+                    del self.subscribers[channel]
+            subscribed.discard(channel)
+            replies.append([b'unsubscribe', channel, len(subscribed)])
+        return replies
+
+    async def handle(self, reader, writer):
+        subscribed = set()
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    writer.write(encode_reply(ReplyError('ERR expected a command array')))
+                    continue
+
+                name, args = command[0].upper(), command[1:]
+                if name == b'PUBLISH' and len(args) == 2:
+                    replies = [self.publish(args[0], args[1])]
+                elif name == b'SUBSCRIBE' and args:
+                    replies = self.subscribe(writer, subscribed, args)
+                elif name == b'UNSUBSCRIBE':
+                    replies = self.unsubscribe(writer, subscribed, args)
+                elif name == b'PING':
+                    replies = ['PONG']
+                elif name in (b'AUTH', b'SELECT'):
+                    replies = ['OK']
+                elif name == b'QUIT':
+                    writer.write(encode_reply('OK'))
+                    break
+                else:
+                    replies = [ReplyError(f'ERR unknown or invalid command {name.decode(errors="replace")}')]
+
+                writer.write(b''.join(encode_reply(reply) for reply in replies))
+                await writer.drain()
+        except CONNECTION_ERRORS:
+            pass
+        finally:
+            self.unsubscribe(writer, subscribed, [])
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=6379, started=None):
+        server = await asyncio.start_server(self.handle, host, port)
+        if started is not None:
+            started()
+        async with server:
+            await server.serve_forever()
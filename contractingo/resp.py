@@ -0,0 +1,121 @@
+import asyncio
+from urllib.parse import urlparse
+
+"""
+RESP:
+
+    Just enough of the Redis protocol (RESP2) for the channel layer (contractingo/channel_layer.py) and its
+    stand-in server (contractingo/redis_standin.py): encoding commands, reading replies and a pipelining
+    connection. Pub/sub is all the channel layer needs, so there's no dependency on a Redis client library.
+"""
+
+CONNECTION_ERRORS = (ConnectionError, OSError, asyncio.IncompleteReadError)
+
+
+class ReplyError(Exception):
+    """Error reply (-ERR ...) from the server"""
+
+
+def encode_value(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    return str(value).encode()
+
+
+def encode_command(*args):
+    """Encode a command as a RESP array of bulk strings"""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        data = encode_value(arg)
+        parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(parts)
+
+
+async def read_reply(reader):
+    """
+    Read one RESP value. Bulk strings come back as bytes, error replies as ReplyError instances (not raised,
+    so a pipeline can read past them)
+    """
+    line = await reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('Connection closed')
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b'+':
+        return rest.decode()
+    if kind == b'-':
+        return ReplyError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f'Invalid RESP reply {line!r}')
+
+
+class RedisConnection:
+    """A lazily opened connection to one server, sending commands in pipelines"""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.reader = self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            self.writer.write(encode_command('AUTH', self.password))
+            reply = await read_reply(self.reader)
+            if isinstance(reply, ReplyError):
+                self.close()
+                raise reply
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def execute_many(self, commands):
+        """
+        Send commands (tuples of arguments) in one write and get their replies.
+        Reconnects once when the connection fails before anything was written; once the commands were written the
+        server may have run them (a retried PUBLISH would be delivered twice), so later errors are raised
+        """
+        async with self.lock:
+            for attempt in range(2):
+                written = False
+                try:
+                    if self.writer is not None and (self.reader.at_eof() or self.writer.is_closing()):
+                        # Closed since the last use (e.g. the server restarted)
+                        self.close()
+                    if self.writer is None:
+                        await self.connect()
+                    written = True
+                    self.writer.write(b''.join(encode_command(*command) for command in commands))
+                    await self.writer.drain()
+                    replies = [await read_reply(self.reader) for _ in commands]
+                    break
+                except CONNECTION_ERRORS:
+                    self.close()
+                    if written or attempt:
+                        raise
+
+        for reply in replies:
+            if isinstance(reply, ReplyError):
+                raise reply
+        return replies
+
+    async def execute(self, *args):
+        return (await self.execute_many([args]))[0]
@@ -70,34 +70,104 @@ TEMPLATES = [
 WSGI_APPLICATION = 'contractingo.wsgi.application'
 ASGI_APPLICATION = 'contractingo.asgi.application'
 
-# Channel layers configuration 
-# CHANNEL_LAYERS = {
-#     'default': {
-#         'BACKEND': 'channels_redis.core.RedisChannelLayer',
-#         'CONFIG': {
-#             'hosts': [os.getenv('REDIS_URL', 'redis://localhost:6379/1')],
-#             'capacity': 1500,
-#             'expiry': 60,
-#         },
-#     },
-# }
-
-# Alternative for development only (comment out Redis config above and uncomment this):
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
-}
+# Channel layers configuration
+# CHANNEL_LAYER=redis: Redis pub/sub channel layer (contractingo/channel_layer.py), needed to run more than one
+# ASGI worker. REDIS_URLS is a comma separated list of servers, conversation groups are sharded over them
+# (manage.py redis_standin runs a stand-in server when there is no Redis)
+if os.getenv('CHANNEL_LAYER', 'memory') == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'contractingo.channel_layer.ShardedRedisChannelLayer',
+            'CONFIG': {
+                'hosts': os.getenv('REDIS_URLS', os.getenv('REDIS_URL', 'redis://localhost:6379')).split(','),
+                'prefix': os.getenv('CHANNEL_LAYER_PREFIX', 'contractingo'),
+                'capacity': 1500,
+            },
+        },
+    }
+else:
+    # Development only, a single process
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
 
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'supabase_auth.authentication.SupabaseAuthentication'
-    ]
+    ],
+    # orjson based JSON (see contractingo/fast_json.py), falls back to the stdlib when FAST_JSON is off
+    'DEFAULT_RENDERER_CLASSES': [
+        'contractingo.fast_json.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'contractingo.fast_json.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
+# Encode / decode REST and websocket JSON with orjson when it is installed
+FAST_JSON = os.getenv('FAST_JSON', 'true').lower() == 'true'
+
+# Serialize hot list endpoints (ads, conversations, messages) from values_list() rows instead of DRF serializers
+FAST_SERIALIZERS = os.getenv('FAST_SERIALIZERS', 'false').lower() == 'true'
+
 AUTH_USER_MODEL = 'supabase_auth.User'
 
+# Ads search
+# How often (seconds) the in-process search index re-reads ads changed by other workers
+ADS_SEARCH_INDEX_SYNC_SECONDS = int(os.getenv('ADS_SEARCH_INDEX_SYNC_SECONDS', 5))
+# How often (seconds) that sync also drops ads other workers deleted, by reading the ids of all active ads
+ADS_SEARCH_INDEX_RECONCILE_SECONDS = int(os.getenv('ADS_SEARCH_INDEX_RECONCILE_SECONDS', 60))
+# 'index' (in-process inverted index + icontains) or 'postgres' (tsvector + GIN, falls back to 'index' on other databases)
+ADS_SEARCH_BACKEND = os.getenv('ADS_SEARCH_BACKEND', 'index')
+# Text search configuration used to build and query Ad.search_vector
+ADS_SEARCH_FTS_CONFIG = os.getenv('ADS_SEARCH_FTS_CONFIG', 'english')
+# Max age (seconds) of the compiled city / ad type keyword matcher, so other workers' changes show up
+ADS_SEARCH_KEYWORDS_TTL_SECONDS = int(os.getenv('ADS_SEARCH_KEYWORDS_TTL_SECONDS', 300))
+# Cursor-paginated search only counts results up to this many when asked for a total (?with_total=1)
+ADS_SEARCH_APPROX_TOTAL_CAP = int(os.getenv('ADS_SEARCH_APPROX_TOTAL_CAP', 1000))
+# Per-process search result cache: max cached pages (0 disables it) and how long (seconds) a page stays valid
+ADS_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('ADS_SEARCH_CACHE_MAX_ENTRIES', 1000))
+ADS_SEARCH_CACHE_TTL_SECONDS = int(os.getenv('ADS_SEARCH_CACHE_TTL_SECONDS', 30))
+# How often (seconds) typeahead suggestions are rebuilt from the database
+ADS_SEARCH_SUGGEST_TTL_SECONDS = int(os.getenv('ADS_SEARCH_SUGGEST_TTL_SECONDS', 600))
+# Radius search ("near <city>", ?near=<city id>&km=): default and max radius in km, and grid cell size in degrees
+ADS_SEARCH_NEAR_DEFAULT_KM = float(os.getenv('ADS_SEARCH_NEAR_DEFAULT_KM', 25))
+ADS_SEARCH_NEAR_MAX_KM = float(os.getenv('ADS_SEARCH_NEAR_MAX_KM', 500))
+ADS_SEARCH_GEO_CELL_DEGREES = float(os.getenv('ADS_SEARCH_GEO_CELL_DEGREES', 0.5))
+# Typo tolerance: retry with corrected words below this many results (0 disables), time budget and candidates per word
+ADS_SEARCH_FUZZY_MIN_RESULTS = int(os.getenv('ADS_SEARCH_FUZZY_MIN_RESULTS', 3))
+ADS_SEARCH_FUZZY_BUDGET_MS = float(os.getenv('ADS_SEARCH_FUZZY_BUDGET_MS', 20))
+ADS_SEARCH_FUZZY_MAX_CANDIDATES = int(os.getenv('ADS_SEARCH_FUZZY_MAX_CANDIDATES', 50))
+
+# Messaging
+# Cursor-paginated inbox (?cursor=): default and max conversations per page
+MESSAGING_INBOX_PAGE_SIZE = int(os.getenv('MESSAGING_INBOX_PAGE_SIZE', 20))
+MESSAGING_INBOX_MAX_PAGE_SIZE = int(os.getenv('MESSAGING_INBOX_MAX_PAGE_SIZE', 100))
+# Most conversations one multiplexed websocket (ws/messaging/) can subscribe to
+MESSAGING_WS_MAX_SUBSCRIPTIONS = int(os.getenv('MESSAGING_WS_MAX_SUBSCRIPTIONS', 200))
+# Per-process cache of websocket membership checks: max (conversation, user) answers (0 disables it) and how long
+# (seconds) one stays valid, which bounds how long a participant removed by another worker can still connect here
+MESSAGING_MEMBERSHIP_CACHE_MAX_ENTRIES = int(os.getenv('MESSAGING_MEMBERSHIP_CACHE_MAX_ENTRIES', 100000))
+MESSAGING_MEMBERSHIP_CACHE_TTL_SECONDS = int(os.getenv('MESSAGING_MEMBERSHIP_CACHE_TTL_SECONDS', 60))
+# Typing indicators (messaging/typing.py): min time (ms) between two broadcasts of one user's typing status in a
+# conversation, and seconds without a typing frame after which a typing user is broadcast as stopped
+MESSAGING_TYPING_MIN_INTERVAL_MS = int(os.getenv('MESSAGING_TYPING_MIN_INTERVAL_MS', 1000))
+MESSAGING_TYPING_TIMEOUT_SECONDS = float(os.getenv('MESSAGING_TYPING_TIMEOUT_SECONDS', 5))
+# Write-behind for websocket messages (messaging/write_behind.py): broadcast once journaled, insert in batches
+MESSAGING_WRITE_BEHIND = os.getenv('MESSAGING_WRITE_BEHIND', 'false').lower() == 'true'
+# Journal directory (must survive restarts, recover_message_journal replays it), flush interval (ms) and batch size
+MESSAGING_WRITE_BEHIND_DIR = os.getenv('MESSAGING_WRITE_BEHIND_DIR', str(BASE_DIR / 'var' / 'message-journal'))
+MESSAGING_WRITE_BEHIND_INTERVAL_MS = int(os.getenv('MESSAGING_WRITE_BEHIND_INTERVAL_MS', 50))
+MESSAGING_WRITE_BEHIND_BATCH = int(os.getenv('MESSAGING_WRITE_BEHIND_BATCH', 200))
+# fsync the journal before broadcasting (off: survives a crashed process, not a crashed machine)
+MESSAGING_WRITE_BEHIND_FSYNC = os.getenv('MESSAGING_WRITE_BEHIND_FSYNC', 'true').lower() == 'true'
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 DATABASES = {
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MessagingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messaging'
+
+    def ready(self):
+        # Register unread counter and membership cache signal handlers, and system checks
+        from . import checks, signals  # noqa: F401
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core import checks
+from django.db import connection
+
+from .write_behind import WRITE_BEHIND_VENDORS
+
+
+@checks.register()
+def check_write_behind_database(app_configs, **kwargs):
+    """Write-behind reserves message ids with database specific SQL (see write_behind.reserve_ids)"""
+    if not getattr(settings, 'MESSAGING_WRITE_BEHIND', False) or connection.vendor in WRITE_BEHIND_VENDORS:
+        return []
+    return [checks.Error(
+        f'MESSAGING_WRITE_BEHIND is not supported on {connection.vendor}',
+        hint=f'Use one of {", ".join(WRITE_BEHIND_VENDORS)}, or set MESSAGING_WRITE_BEHIND=false',
+        id='messaging.E001',
+    )]
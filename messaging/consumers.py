@@ -1,21 +1,27 @@
 import json
 import os
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import Conversation, Message, MessageAttachment
+from .models import Conversation
+from .inbox import create_message
+from .membership import membership_cache, participant_conversation_ids, query_participant
 from .serializers import MessageSerializer
+from .typing import TypingCoalescer
+from .write_behind import message_write_behind, write_behind_enabled
 from jose import jwt, JWTError
 from supabase_auth.models import User
+from contractingo.fast_json import dumps, loads
 
 
 """
 WEBSOCKETS:
-    
-    Traditional HTTP: 
+
+    Traditional HTTP:
         - Client asks for data/message -> Server sends data/message -> Connection closes
         - Problem with traditional HTTP is that the user has to keep asking (polling), slow and inefficient
 
-    Websockets: 
+    Websockets:
         - Client says lets keep talking -> Server says sure -> Connection stays opne
         - Data is sent in real-time and in both directions (bidirectional)
         - Connection stays open until either client or server closes it, perfect for chat and notifications
@@ -24,19 +30,28 @@ WEBSOCKETS:
         - Django itself is synchronous and can't hanlde websockets, Django Channels extends Django to support websockets
         - Frontend Websocket URL: ws://.../conversation/123/?token=xyz -> ASGI Server (Daphne)
         -> Channel Layer( Manages groups/broadcasting to multiple users) -> ConversationConsumer (consumers.py) handles websocket events
-    
+
+    One socket per user (UserConsumer):
+        - ws://.../messaging/?token=xyz authenticates once, then the client picks conversations with control frames:
+            {"type": "subscribe", "conversation_ids": [1, 2]}   -> {"type": "subscribed", "conversation_ids": [1, 2]}
+            {"type": "unsubscribe", "conversation_ids": [2]}    -> {"type": "unsubscribed", "conversation_ids": [2]}
+        - send_message and typing frames name their conversation_id, and every event sent back carries one
+        - A user with ten open chats holds one socket, one JWT decode and one participant query per subscribe
+          instead of ten of each. ws://.../conversation/<id>/ still works for older clients
+
 """
 
-# Websocket handler that manages a single conversatoin room
-class ConversationConsumer(AsyncWebsocketConsumer):
+def conversation_group_name(conversation_id):
+    return f'conversation_{conversation_id}'
 
-    # When a user first connects to the websocket
-    async def connect(self):
-        # URL: ws://.../conversation/{conversation_id}
-        # self.scope contains url, headers, query params, similar to django request object but for websockets
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.conversation_group_name = f'conversation_{self.conversation_id}'
+# Typing frames of every socket in this process go through one coalescer (see messaging/typing.py)
+typing_coalescer = TypingCoalescer(conversation_group_name)
+
+# Shared by both consumers: token authentication, sending messages and typing status, and the group event handlers
+class MessagingConsumer(AsyncWebsocketConsumer):
 
+    async def authenticate(self):
+        """Get the user of the token in the query string, or close the socket and return None"""
         # Get supabase token from query params
         # URL: ws://...?token=xyz
         query_string = self.scope['query_string'].decode() if self.scope['query_string'] else ''
@@ -45,112 +60,91 @@ class ConversationConsumer(AsyncWebsocketConsumer):
             if '=' in param:
                 key, value = param.split('=', 1)
                 query_params[key] = value
-        
+
         token = query_params.get('token')
 
         if not token:
             await self.close(code=4004, reason='Token is required')
-            return
-        
+            return None
+
         # Authenticate user with supabase
         # Websockets can't set HTTP headers so pass auth token as query param
         user = await self.authenticate_supabase_user(token)
         if not user:
             await self.close(code=4004, reason='Invalid token')
-            return
-        
-        # Ensure user is part of the conversation
-        # In normal Django views, middleware checks auth automatically, but websockets need to do it manually
-        if not await self.check_user_permission(user, self.conversation_id):
-            await self.close(code=4004, reason='You are not allowed to access this conversation')
-            return
-        
-        self.scope['user'] = user
-        await self.channel_layer.group_add(self.conversation_group_name, self.channel_name)
-
-        await self.accept()
-    
-    # Runs when user closes browser tab, network drops, user navigates away, connection times out
-    async def disconnect(self, close_code):
-        # Leave conversation group
-        await self.channel_layer.group_discard(self.conversation_group_name, self.channel_name)
-    
-    # Runs when client sneds data to server
-    async def receive(self, text_data):
-        try:
-            # parse JSON
-            data = json.loads(text_data)
-            message_type = data.get('type')
-
-            # Handle different message types
-            if message_type == 'send_message':
-                await self.send_message(data)
-            elif message_type == 'typing':
-                await self.handle_typing(data)
-
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({'error': 'Invalid JSON format'}))
-        except Exception as e:
-            await self.send(text_data=json.dumps({'error': f'Error processing message: {str(e)}'}))
-
-    
+            return None
+        return user
 
-    async def send_message(self, data):
+    async def send_message(self, conversation_id, data):
         user = self.scope['user'] # get authenticated user
         content = data.get('content') # get message content
         image_url = data.get('image_url') # get optional image url
 
         # Validate
         if not content and not image_url:
-            await self.send(text_data=json.dumps({
-                'error': 'Message content or image required'
+            await self.send(text_data=dumps({
+                'error': 'Message content or image required',
+                'conversation_id': conversation_id
             }))
             return
-        
-        # Create message in db
-        message = await self.create_message(user, content, image_url)
 
-        # Serialize message
-        message_data = await self.serialize_message(message)
+        if write_behind_enabled():
+            # Journal the message and broadcast it now, it's inserted with the next batch
+            message_data = await message_write_behind.post(user, conversation_id, content, image_url, self.channel_name)
+        else:
+            # Create message in db
+            message = await self.create_message(user, conversation_id, content, image_url)
+
+            # Serialize message
+            message_data = await self.serialize_message(message)
 
         # Broadcast message to all users in conversation group
         await self.channel_layer.group_send(
-            self.conversation_group_name,
+            conversation_group_name(conversation_id),
             {
                 'type': 'conversation_message', # calls conversation_message() method
+                'conversation_id': conversation_id,
                 'message': message_data,
                 'sender_id': user.id
             }
         )
-    
-    async def handle_typing(self, data):
+
+    async def handle_typing(self, conversation_id, data):
         user = self.scope['user']
         is_typing = data.get('is_typing', False)
 
-        # Send typing notification to conversation group
-        await self.channel_layer.group_send(
-            self.conversation_group_name,
-            {
-                'type': 'typing_status',
-                'user_id': user.id,
-                'user_name': user.name,
-                'is_typing': is_typing
-            }
-        )
-    
+        # Send typing notification to conversation group, only when it changed and at most once per interval
+        await typing_coalescer.update(self.channel_layer, conversation_id, user, is_typing, self.channel_name)
+
+    async def stop_typing(self, conversation_ids):
+        # Nobody keeps seeing "typing..." from a socket that's gone
+        if self.scope['user'].is_authenticated:
+            await typing_coalescer.stop(self.scope['user'].id, conversation_ids, self.channel_name)
+
     # Group_sned (broadcasts to all) -> conversation_message runs on each connection -> self.send sends to specific users browser
     async def conversation_message(self, event):
         # Send message to websocket
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps({
             'type': 'message',
+            'conversation_id': event.get('conversation_id'),
             'message': event['message']
         }))
-    
+
+    # Sent by the write-behind flusher (messaging/write_behind.py) when a message this socket sent couldn't be saved
+    async def message_failed(self, event):
+        await self.send(text_data=dumps({
+            'type': 'error',
+            'conversation_id': event['conversation_id'],
+            'message_id': event['message_id'],
+            'error': 'Message could not be saved'
+        }))
+
     async def typing_status(self, event):
         # Send typing status to websocket (exclude sender)
         if event['user_id'] != self.scope['user'].id:
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=dumps({
                 'type': 'typing',
+                'conversation_id': event.get('conversation_id'),
                 'user_id': event['user_id'],
                 'user_name': event['user_name'],
                 'is_typing': event['is_typing']
@@ -165,14 +159,14 @@ class ConversationConsumer(AsyncWebsocketConsumer):
             if not jwt_secret:
                 print("SUPABASE_JWT_SECRET not found in environment")
                 return None
-            
+
             payload = jwt.decode(token , jwt_secret, algorithms=['HS256'], audience='authenticated')
 
             uid = payload.get('sub')
             if not uid:
                 print("No 'sub' claim in token")
                 return None
-            
+
             # Get user
             user = User.objects.get(uid=uid)
             return user
@@ -186,35 +180,174 @@ class ConversationConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             print(f"Supabase authentication error: {e}")
             return None
-        
-    @database_sync_to_async
-    def check_user_permission(self, user, conversation_id):
-        try:
-            conversation = Conversation.objects.get(id=conversation_id)
-            return user in conversation.participants.all()
-        except Conversation.DoesNotExist:
-            return False
-    
+
+    async def check_user_permission(self, user, conversation_id):
+        # Reconnecting clients are answered from the membership cache, without a database query or thread hop
+        is_member = membership_cache.get(conversation_id, user.id)
+        if is_member is None:
+            is_member = await database_sync_to_async(query_participant)(conversation_id, user.id)
+        return is_member
+
     @database_sync_to_async
-    def create_message(self, user, content, image_url=None):
+    def create_message(self, user, conversation_id, content, image_url=None):
         # Create new message in database
-        conversation = Conversation.objects.get(id=self.conversation_id)
-        message = Message.objects.create(
-            conversation=conversation,
-            sender=user,
-            content=content
-        )
+        conversation = Conversation.objects.get(id=conversation_id)
+        return create_message(conversation, user, content, image_url)
 
-        if image_url:
-            MessageAttachment.objects.create(
-                message=message,
-                image_url=image_url
-            )
-
-        return message
-    
     @database_sync_to_async
     def serialize_message(self, message):
         serializer = MessageSerializer(message)
         return serializer.data
 
+# Websocket handler that manages a single conversatoin room
+class ConversationConsumer(MessagingConsumer):
+
+    # When a user first connects to the websocket
+    async def connect(self):
+        # URL: ws://.../conversation/{conversation_id}
+        # self.scope contains url, headers, query params, similar to django request object but for websockets
+        self.conversation_id = int(self.scope['url_route']['kwargs']['conversation_id'])
+        self.conversation_group_name = conversation_group_name(self.conversation_id)
+
+        user = await self.authenticate()
+        if not user:
+            return
+
+        # Ensure user is part of the conversation
+        # In normal Django views, middleware checks auth automatically, but websockets need to do it manually
+        if not await self.check_user_permission(user, self.conversation_id):
+            await self.close(code=4004, reason='You are not allowed to access this conversation')
+            return
+
+        self.scope['user'] = user
+        await self.channel_layer.group_add(self.conversation_group_name, self.channel_name)
+
+        await self.accept()
+
+    # Runs when user closes browser tab, network drops, user navigates away, connection times out
+    async def disconnect(self, close_code):
+        await self.stop_typing([self.conversation_id])
+        # Leave conversation group
+        await self.channel_layer.group_discard(self.conversation_group_name, self.channel_name)
+
+    # Runs when client sneds data to server
+    async def receive(self, text_data):
+        try:
+            # parse JSON
+            data = loads(text_data)
+            message_type = data.get('type')
+
+            # Handle different message types
+            if message_type == 'send_message':
+                await self.send_message(self.conversation_id, data)
+            elif message_type == 'typing':
+                await self.handle_typing(self.conversation_id, data)
+
+        except json.JSONDecodeError:
+            await self.send(text_data=dumps({'error': 'Invalid JSON format'}))
+        except Exception as e:
+            await self.send(text_data=dumps({'error': f'Error processing message: {str(e)}'}))
+
+# Websocket handler for all of a user's conversations over one socket
+class UserConsumer(MessagingConsumer):
+
+    async def connect(self):
+        # URL: ws://.../messaging/?token=xyz
+        self.conversation_ids = set()
+
+        user = await self.authenticate()
+        if not user:
+            return
+
+        self.scope['user'] = user
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await self.stop_typing(self.conversation_ids)
+        # Leave every subscribed conversation group
+        for conversation_id in self.conversation_ids:
+            await self.channel_layer.group_discard(conversation_group_name(conversation_id), self.channel_name)
+        self.conversation_ids = set()
+
+    async def receive(self, text_data):
+        try:
+            data = loads(text_data)
+            message_type = data.get('type')
+
+            # Control frames
+            if message_type == 'subscribe':
+                await self.subscribe(conversation_ids_of(data))
+            elif message_type == 'unsubscribe':
+                await self.unsubscribe(conversation_ids_of(data))
+
+            # Conversation frames, only for subscribed conversations
+            elif message_type in ('send_message', 'typing'):
+                conversation_id = data.get('conversation_id')
+                if conversation_id not in self.conversation_ids:
+                    await self.send(text_data=dumps({
+                        'type': 'error',
+                        'conversation_id': conversation_id,
+                        'error': 'Not subscribed to this conversation'
+                    }))
+                elif message_type == 'send_message':
+                    await self.send_message(conversation_id, data)
+                else:
+                    await self.handle_typing(conversation_id, data)
+
+        except json.JSONDecodeError:
+            await self.send(text_data=dumps({'type': 'error', 'error': 'Invalid JSON format'}))
+        except ValueError as e:
+            await self.send(text_data=dumps({'type': 'error', 'error': str(e)}))
+        except Exception as e:
+            await self.send(text_data=dumps({'type': 'error', 'error': f'Error processing message: {str(e)}'}))
+
+    async def subscribe(self, conversation_ids):
+        new_ids = conversation_ids - self.conversation_ids
+        if len(self.conversation_ids) + len(new_ids) > settings.MESSAGING_WS_MAX_SUBSCRIPTIONS:
+            raise ValueError(f'At most {settings.MESSAGING_WS_MAX_SUBSCRIPTIONS} conversations per socket')
+
+        # One query checks every requested conversation
+        allowed = await self.allowed_conversation_ids(self.scope['user'], new_ids)
+        for conversation_id in allowed:
+            await self.channel_layer.group_add(conversation_group_name(conversation_id), self.channel_name)
+        self.conversation_ids |= allowed
+
+        await self.send(text_data=dumps({
+            'type': 'subscribed',
+            'conversation_ids': sorted(conversation_ids & self.conversation_ids)
+        }))
+        denied = new_ids - allowed
+        if denied:
+            await self.send(text_data=dumps({
+                'type': 'error',
+                'conversation_ids': sorted(denied),
+                'error': 'You are not allowed to access this conversation'
+            }))
+
+    async def unsubscribe(self, conversation_ids):
+        removed = conversation_ids & self.conversation_ids
+        await self.stop_typing(removed)
+        for conversation_id in removed:
+            await self.channel_layer.group_discard(conversation_group_name(conversation_id), self.channel_name)
+        self.conversation_ids -= removed
+
+        await self.send(text_data=dumps({
+            'type': 'unsubscribed',
+            'conversation_ids': sorted(removed)
+        }))
+
+    @database_sync_to_async
+    def allowed_conversation_ids(self, user, conversation_ids):
+        return participant_conversation_ids(user.id, conversation_ids)
+
+
+def conversation_ids_of(data):
+    """Get the conversation ids of a control frame, given as conversation_ids (a list) or conversation_id"""
+    conversation_ids = data.get('conversation_ids')
+    if conversation_ids is None:
+        conversation_ids = [data.get('conversation_id')]
+    if not isinstance(conversation_ids, list) or not all(
+        isinstance(conversation_id, int) and not isinstance(conversation_id, bool) for conversation_id in conversation_ids
+    ):
+        raise ValueError('conversation_ids must be a list of conversation ids')
+    return set(conversation_ids)
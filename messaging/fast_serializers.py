@@ -0,0 +1,119 @@
+from ads.fast_serializers import compile_row, datetime_repr, in_order, optional, serialize_ad_summaries, serialize_ads
+from supabase_auth.models import User
+from .models import Conversation, Message, MessageAttachment
+
+"""
+FAST SERIALIZERS:
+
+    values_list() based versions of MessageSerializer and ConversationSerializer, giving the same output
+    (see ads/fast_serializers.py for how they work). Senders, participants and attachments are loaded with one
+    query each for the whole list, the ad of each conversation is a compact summary (or the full fast AdSerializer
+    output when expanded) and the last messages come from the conversations' last_message pointers (see inbox.py).
+"""
+
+# Users, as messaging.serializers.UserSerializer
+USER_COLUMNS = ('id', 'uid', 'name', 'email', 'profile_photo')
+user_row = compile_row(USER_COLUMNS, (
+    ('id', 'id', None),
+    ('uid', 'uid', str),
+    ('name', 'name', str),
+    ('email', 'email', str),
+    ('profile_photo', 'profile_photo', optional(str)),
+))
+
+
+def users_by_id(user_ids):
+    return {row[0]: user_row(row) for row in User.objects.filter(id__in=set(user_ids)).values_list(*USER_COLUMNS)}
+
+
+# Attachments, as MessageAttachmentSerializer
+ATTACHMENT_COLUMNS = ('message_id', 'id', 'image_url', 'created_at')
+attachment_row = compile_row(ATTACHMENT_COLUMNS, (
+    ('id', 'id', None),
+    ('image_url', 'image_url', str),
+    ('created_at', 'created_at', optional(datetime_repr)),
+))
+
+
+# Messages, as MessageSerializer
+MESSAGE_COLUMNS = ('id', 'content', 'created_at', 'is_read', 'sender_id')
+message_row = compile_row(MESSAGE_COLUMNS, (
+    ('id', 'id', None),
+    ('content', 'content', str),
+    ('created_at', 'created_at', optional(datetime_repr)),
+    ('is_read', 'is_read', bool),
+))
+
+
+def serialize_messages(message_ids):
+    """Get MessageSerializer output for the messages with the given ids, in the order of message_ids"""
+    message_ids = list(message_ids)
+    if not message_ids:
+        return []
+
+    rows = list(Message.objects.filter(id__in=message_ids).order_by().values_list(*MESSAGE_COLUMNS))
+    senders = users_by_id(row[-1] for row in rows)
+
+    attachments = {}
+    attachment_rows = MessageAttachment.objects.filter(
+        message_id__in=message_ids
+    ).order_by('created_at', 'id').values_list(*ATTACHMENT_COLUMNS)
+    for row in attachment_rows:
+        attachments.setdefault(row[0], []).append(attachment_row(row))
+
+    messages = {}
+    for row in rows:
+        message = message_row(row)
+        message['sender'] = senders[row[-1]]
+        message['attachments'] = attachments.get(row[0], [])
+        messages[row[0]] = message
+    return in_order(message_ids, messages)
+
+
+# Conversations, as ConversationSerializer
+CONVERSATION_COLUMNS = ('id', 'ad_id', 'created_at', 'updated_at', 'last_message_at', 'last_message_preview', 'last_message_id')
+conversation_fields = compile_row(CONVERSATION_COLUMNS, (
+    ('created_at', 'created_at', optional(datetime_repr)),
+    ('updated_at', 'updated_at', optional(datetime_repr)),
+    ('last_message_at', 'last_message_at', optional(datetime_repr)),
+    ('last_message_preview', 'last_message_preview', str),
+))
+
+
+def serialize_conversations(conversation_ids, expand_ad=False):
+    """
+    Get ConversationSerializer output for the conversations with the given ids, in the order of conversation_ids.
+    expand_ad embeds full ads instead of summaries
+    """
+    conversation_ids = list(conversation_ids)
+    if not conversation_ids:
+        return []
+
+    rows = list(Conversation.objects.filter(id__in=conversation_ids).order_by().values_list(*CONVERSATION_COLUMNS))
+
+    if expand_ad:
+        ads = {ad['id']: ad for ad in serialize_ads({row[1] for row in rows})}
+    else:
+        ads = serialize_ad_summaries(row[1] for row in rows)
+    messages = {message['id']: message for message in serialize_messages(row[-1] for row in rows if row[-1])}
+
+    participant_ids = {}
+    # In user id order, like ConversationSerializer.get_participants
+    memberships = Conversation.participants.through.objects.filter(
+        conversation_id__in=conversation_ids
+    ).order_by('user_id').values_list('conversation_id', 'user_id')
+    for conversation_id, user_id in memberships:
+        participant_ids.setdefault(conversation_id, []).append(user_id)
+    users = users_by_id(user_id for ids in participant_ids.values() for user_id in ids)
+
+    conversations = {}
+    for row in rows:
+        conversation = {
+            'id': row[0],
+            'ad': ads.get(row[1]),
+            'participants': [users[user_id] for user_id in participant_ids.get(row[0], [])],
+        }
+        conversation.update(conversation_fields(row))
+        conversation['last_message'] = messages.get(row[-1])
+        conversations[row[0]] = conversation
+    return in_order(conversation_ids, conversations)
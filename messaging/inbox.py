@@ -0,0 +1,175 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.text import Truncator
+
+from ads.search.pagination import InvalidCursor
+from .models import Conversation, ConversationParticipant, Message, MessageAttachment
+from .unread import record_unread
+
+"""
+LAST MESSAGE POINTER:
+
+    The inbox showed each conversation's newest message with conversation.messages.last(), one ordered query
+    per row. Conversation carries its newest message instead (last_message, last_message_at and a short
+    last_message_preview):
+        - create_message inserts the message and moves the pointer in the same transaction, for both the
+          REST view and the websocket consumer (record_messages does the same for a batch of messages)
+        - The pointer only ever moves forward (newer created_at, then higher id), so concurrent senders can't
+          leave it on an older message
+        - rebuild_last_messages (management command) recomputes the pointers, e.g. after messages were deleted
+          by hand (deleting the pointed-to message just clears the pointer)
+
+INBOX:
+
+    Listing the inbox used to prefetch every message of every conversation of the user. Each membership row
+    (ConversationParticipant) now carries its conversation's last activity (creation, then newest message),
+    bumped by create_message, and the inbox is a keyset-paginated scan of the (user, last activity)
+    index: newest activity first, conversation id breaking ties. Messages are only loaded for the
+    conversation being opened (MessageListCreateView).
+"""
+
+PREVIEW_LENGTH = Conversation._meta.get_field('last_message_preview').max_length
+
+
+def message_preview(content):
+    """Get a one line preview of a message's content, truncated to fit last_message_preview"""
+    return Truncator(' '.join((content or '').split())).chars(PREVIEW_LENGTH)
+
+
+def record_last_message(message):
+    """Point a message's conversation at it, unless the conversation already has a newer message"""
+    newer = Q(last_message_at__gt=message.created_at) | Q(last_message_at=message.created_at, last_message_id__gt=message.id)
+    return Conversation.objects.filter(id=message.conversation_id).exclude(newer).update(
+        last_message=message,
+        last_message_at=message.created_at,
+        last_message_preview=message_preview(message.content),
+    )
+
+
+def create_message(conversation, sender, content, image_url=None):
+    """
+    Create a message (and its attachment, if any), make it its conversation's last message and count it as
+    unread for the other participants
+    """
+    with transaction.atomic():
+        message = Message.objects.create(conversation=conversation, sender=sender, content=content)
+        if image_url:
+            MessageAttachment.objects.create(message=message, image_url=image_url)
+        record_messages([message])
+    return message
+
+
+def record_messages(messages):
+    """
+    Apply newly inserted messages to their conversations: last message pointers, participants' last activity and
+    unread counters, a few queries per conversation however many messages there are. Call it in their transaction
+    """
+    newest = {}
+    unread = {}
+    for message in messages:
+        current = newest.get(message.conversation_id)
+        if current is None or (message.created_at, message.id) > (current.created_at, current.id):
+            newest[message.conversation_id] = message
+        key = (message.conversation_id, message.sender_id)
+        unread[key] = unread.get(key, 0) + 1
+
+    for conversation_id, message in newest.items():
+        record_last_message(message)
+        ConversationParticipant.objects.filter(
+            conversation_id=conversation_id, last_activity_at__lt=message.created_at
+        ).update(last_activity_at=message.created_at)
+    for (conversation_id, sender_id), count in unread.items():
+        record_unread(conversation_id, sender_id, count)
+
+
+def rebuild_last_messages(conversation_ids=None):
+    """
+    Recompute last message pointers from the Message table, for every conversation or only conversation_ids.
+    Returns the ids of the conversations whose pointer was wrong
+    """
+    newest = Message.objects.filter(conversation=OuterRef('pk')).order_by('-created_at', '-id').values('id')[:1]
+    conversations = Conversation.objects.annotate(newest_message_id=Subquery(newest))
+    if conversation_ids is not None:
+        conversations = conversations.filter(id__in=conversation_ids)
+
+    wrong = {
+        conversation_id: newest_message_id
+        for conversation_id, last_message_id, newest_message_id
+        in conversations.order_by().values_list('id', 'last_message_id', 'newest_message_id')
+        if last_message_id != newest_message_id
+    }
+    messages = Message.objects.in_bulk([message_id for message_id in wrong.values() if message_id])
+
+    repaired = []
+    for conversation_id, message_id in wrong.items():
+        message = messages.get(message_id)
+        repaired.append(Conversation(
+            id=conversation_id,
+            last_message_id=message_id,
+            last_message_at=message.created_at if message else None,
+            last_message_preview=message_preview(message.content) if message else '',
+        ))
+    Conversation.objects.bulk_update(repaired, ['last_message', 'last_message_at', 'last_message_preview'], batch_size=1000)
+
+    # Inbox order follows the (possibly repaired) pointers
+    memberships = ConversationParticipant.objects.all()
+    if conversation_ids is not None:
+        memberships = memberships.filter(conversation_id__in=conversation_ids)
+    activity = Conversation.objects.filter(id=OuterRef('conversation_id')).annotate(
+        activity=Coalesce(F('last_message_at'), F('created_at'))
+    ).values('activity')[:1]
+    memberships.update(last_activity_at=Subquery(activity))
+    return sorted(wrong)
+
+
+INBOX_ORDERING = ('-last_activity_at', '-conversation_id')
+
+
+def inbox_memberships(user):
+    """Get a user's memberships of active conversations, most recently active first"""
+    return ConversationParticipant.objects.filter(user=user, conversation__is_active=True).order_by(*INBOX_ORDERING)
+
+
+def encode_inbox_cursor(last_activity_at, conversation_id):
+    """Encode the position of a conversation in an inbox"""
+    position = [last_activity_at.isoformat(), conversation_id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+
+def decode_inbox_cursor(cursor):
+    """Decode an inbox cursor into (last_activity_at, conversation_id)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_activity_at, conversation_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(conversation_id, int):
+            raise InvalidCursor('Invalid cursor')
+        return datetime.fromisoformat(last_activity_at), conversation_id
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor('Invalid cursor') from e
+
+
+def inbox_page(user, cursor, limit):
+    """
+    Get one page of a user's inbox.
+    Returns (conversation ids on the page, cursor of the next page or None)
+    """
+    memberships = inbox_memberships(user)
+    if cursor:
+        last_activity_at, conversation_id = decode_inbox_cursor(cursor)
+        memberships = memberships.filter(
+            Q(last_activity_at__lt=last_activity_at)
+            | Q(last_activity_at=last_activity_at, conversation_id__lt=conversation_id)
+        )
+
+    # Fetch one extra row to know whether there is a next page
+    page = list(memberships.values_list('conversation_id', 'last_activity_at')[:limit + 1])
+    if len(page) > limit:
+        page = page[:limit]
+        conversation_id, last_activity_at = page[-1]
+        return [row[0] for row in page], encode_inbox_cursor(last_activity_at, conversation_id)
+    return [row[0] for row in page], None
@@ -0,0 +1,99 @@
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from messaging.membership import is_participant, membership_cache
+from messaging.models import Conversation, ConversationParticipant
+from supabase_auth.models import User
+
+class Command(BaseCommand):
+    help = (
+        'Replay a reconnect storm through the websocket membership check: the old participant list check, '
+        'an uncached EXISTS and the membership cache (queries, rows loaded and latency per connect)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=500, help='(conversation, user) pairs that reconnect')
+        parser.add_argument('--reconnects', type=int, default=20, help='Times each client reconnects')
+        parser.add_argument(
+            '--intruders',
+            type=float,
+            default=0.05,
+            help='Share of clients trying to connect to a conversation they are not in',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the storm')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        clients = list(ConversationParticipant.objects.order_by('?').values_list(
+            'conversation_id', 'user_id'
+        )[:options['clients']])
+        if not clients:
+            raise CommandError('Needs conversations with participants in the database')
+
+        # Some clients knock on conversations they aren't in
+        user_ids = list(User.objects.values_list('id', flat=True))
+        for i in range(int(len(clients) * options['intruders'])):
+            conversation_id, _ = clients[i]
+            clients[i] = (conversation_id, rng.choice(user_ids))
+
+        storm = clients * options['reconnects']
+        rng.shuffle(storm)
+        users = User.objects.in_bulk({user_id for _, user_id in storm})
+
+        def participant_list(conversation_id, user_id):
+            # The check before the cache: load the conversation, then every participant
+            try:
+                conversation = Conversation.objects.get(id=conversation_id)
+            except Conversation.DoesNotExist:
+                return False, 0
+            participants = list(conversation.participants.all())
+            return users[user_id] in participants, 1 + len(participants)
+
+        def uncached_exists(conversation_id, user_id):
+            return ConversationParticipant.objects.filter(conversation_id=conversation_id, user_id=user_id).exists(), 1
+
+        def cached(conversation_id, user_id):
+            hits = membership_cache.hits
+            is_member = is_participant(conversation_id, user_id)
+            return is_member, 0 if membership_cache.hits > hits else 1
+
+        self.stdout.write(
+            f'{len(storm)} connects: {len(clients)} clients x {options["reconnects"]} reconnects, '
+            f'{sum(not uncached_exists(*client)[0] for client in clients)} of them not participants'
+        )
+        self.stdout.write(f'{"check":<20} {"queries":>8} {"rows":>8} {"q/connect":>10} {"p50 ms":>8} {"p99 ms":>8} {"total ms":>9}')
+
+        answers = {}
+        membership_cache.clear()
+        for name, check in (('participant list', participant_list), ('exists', uncached_exists), ('membership cache', cached)):
+            latencies, rows, results, queries = [], 0, [], []
+            with connection.execute_wrapper(counting(queries)):
+                for conversation_id, user_id in storm:
+                    started = time.perf_counter()
+                    is_member, loaded = check(conversation_id, user_id)
+                    latencies.append(time.perf_counter() - started)
+                    rows += loaded
+                    results.append(is_member)
+            answers[name] = results
+
+            latencies.sort()
+            p50, p99 = latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            self.stdout.write(
+                f'{name:<20} {len(queries):>8} {rows:>8} {len(queries) / len(storm):>10.3f} '
+                f'{p50 * 1000:>8.3f} {p99 * 1000:>8.3f} {sum(latencies) * 1000:>9.1f}'
+            )
+
+        self.stdout.write(f'Membership cache: {membership_cache.stats()}')
+        if len({tuple(results) for results in answers.values()}) != 1:
+            self.stdout.write(self.style.ERROR('The checks disagree on who may connect'))
+            raise SystemExit(1)
+        self.stdout.write(self.style.SUCCESS('All checks agree on who may connect'))
+
+
+def counting(queries):
+    """Query wrapper appending every executed query to queries (the debug query log only keeps the last 9000)"""
+    def wrapper(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+    return wrapper
@@ -0,0 +1,114 @@
+import asyncio
+import random
+from types import SimpleNamespace
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from channels.layers import get_channel_layer
+from messaging.consumers import conversation_group_name
+from messaging.typing import TypingCoalescer
+
+class Command(BaseCommand):
+    help = (
+        'Replay keystroke typing frames from simulated clients through the typing coalescer and check that '
+        'broadcasts are changes only, throttled, and always end with "stopped"'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='Typing clients, each a user in a conversation')
+        parser.add_argument('--conversations', type=int, default=10, help='Conversations the clients are spread over')
+        parser.add_argument('--duration', type=float, default=5, help='Seconds the clients type for')
+        parser.add_argument('--keystroke-ms', type=float, default=100, help='Average time between keystrokes')
+        parser.add_argument('--interval-ms', type=int, default=None, help='Default: MESSAGING_TYPING_MIN_INTERVAL_MS')
+        parser.add_argument('--timeout', type=float, default=None, help='Default: MESSAGING_TYPING_TIMEOUT_SECONDS')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the clients')
+
+    def handle(self, *args, **options):
+        interval_ms = options['interval_ms'] if options['interval_ms'] is not None else settings.MESSAGING_TYPING_MIN_INTERVAL_MS
+        timeout = options['timeout'] if options['timeout'] is not None else settings.MESSAGING_TYPING_TIMEOUT_SECONDS
+        coalescer = TypingCoalescer(conversation_group_name, interval_ms, timeout)
+        frames, broadcasts = asyncio.run(replay(coalescer, options, timeout + interval_ms / 1000))
+
+        keys = {}
+        for at, message in broadcasts:
+            keys.setdefault((message['conversation_id'], message['user_id']), []).append((at, message['is_typing']))
+
+        failures = []
+        min_gap = None
+        for key, sent in keys.items():
+            for (previous_at, previous), (at, is_typing) in zip(sent, sent[1:]):
+                if previous == is_typing:
+                    failures.append(f'{key}: broadcast is_typing={is_typing} twice in a row')
+                gap = at - previous_at
+                min_gap = gap if min_gap is None else min(min_gap, gap)
+            if sent[-1][1]:
+                failures.append(f'{key}: still shown as typing at the end')
+        if min_gap is not None and min_gap < interval_ms / 1000 - 0.005:
+            failures.append(f'Two broadcasts of one user {min_gap * 1000:.0f}ms apart, the interval is {interval_ms}ms')
+        if coalescer.states or coalescer.tasks:
+            failures.append(f'{len(coalescer.states)} typing states and {len(coalescer.tasks)} tasks left behind')
+
+        self.stdout.write(
+            f'{frames} typing frames from {options["clients"]} clients in {options["duration"]:.0f}s -> '
+            f'{len(broadcasts)} broadcasts ({frames / max(len(broadcasts), 1):.1f}x fewer group sends)'
+        )
+        self.stdout.write(
+            f'Min gap between broadcasts of one user: '
+            f'{"-" if min_gap is None else f"{min_gap * 1000:.0f}ms"} (interval {interval_ms}ms), '
+            f'{coalescer.expired} stopped by the {timeout:g}s timeout'
+        )
+        for failure in failures[:20]:
+            self.stdout.write(self.style.ERROR(failure))
+        if failures:
+            raise SystemExit(1)
+        self.stdout.write(self.style.SUCCESS('Typing broadcasts are coalesced, throttled and always end stopped'))
+
+
+class RecordingLayer:
+    """Passes group sends on to the channel layer, recording when each one happened"""
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((asyncio.get_running_loop().time(), message))
+        await self.layer.group_send(group, message)
+
+
+async def replay(coalescer, options, settle):
+    layer = RecordingLayer(get_channel_layer())
+    rng = random.Random(options['seed'])
+    keystroke = options['keystroke_ms'] / 1000
+    frames = 0
+
+    async def client(i):
+        # Bursts of keystrokes, ended by an explicit stop, some typing/stopped flapping or nothing at all
+        user = SimpleNamespace(id=i, name=f'User {i}')
+        conversation_id = i % options['conversations'] + 1
+        deadline = asyncio.get_running_loop().time() + options['duration']
+
+        async def frame(is_typing):
+            nonlocal frames
+            frames += 1
+            await coalescer.update(layer, conversation_id, user, is_typing, f'client-{i}')
+
+        while asyncio.get_running_loop().time() < deadline:
+            burst_end = asyncio.get_running_loop().time() + rng.uniform(0.5, 2.5)
+            while asyncio.get_running_loop().time() < min(burst_end, deadline):
+                await frame(True)
+                await asyncio.sleep(rng.uniform(0.3, 1.7) * keystroke)
+            ending = rng.random()
+            if ending < 0.6:
+                await frame(False)
+            elif ending < 0.8:
+                for is_typing in (False, True, False):
+                    await frame(is_typing)
+                    await asyncio.sleep(0.02)
+            await asyncio.sleep(rng.uniform(0.2, 2))
+        if rng.random() < 0.5:
+            await frame(False)
+
+    await asyncio.gather(*(client(i) for i in range(options['clients'])))
+    # Pending throttled broadcasts and timeouts
+    await asyncio.sleep(settle + 0.2)
+    return frames, layer.sent
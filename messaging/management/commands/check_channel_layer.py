@@ -0,0 +1,206 @@
+import asyncio
+import multiprocessing
+import queue
+import socket
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from contractingo.channel_layer import ShardedRedisChannelLayer
+from contractingo.redis_standin import PubSubServer
+
+class Command(BaseCommand):
+    help = (
+        'Prove cross-process delivery of the Redis channel layer: worker processes join conversation groups, '
+        'this process group_sends to them and every worker must get every message exactly once, in order'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Worker processes, each one consumer in every group')
+        parser.add_argument('--groups', type=int, default=50, help='conversation_<id> groups')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent to each group')
+        parser.add_argument('--batch', type=int, default=100, help='Group sends per group_send_batch pipeline')
+        parser.add_argument(
+            '--hosts',
+            nargs='+',
+            help='Redis URLs to use (default: REDIS_URLS when CHANNEL_LAYER=redis, else stand-in servers started here)',
+        )
+        parser.add_argument('--shards', type=int, default=2, help='Stand-in servers to start when no hosts are given')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for the workers')
+
+    def handle(self, *args, **options):
+        hosts = options['hosts'] or configured_hosts()
+        standins = []
+        try:
+            if not hosts:
+                standins = start_standins(options['shards'], options['timeout'])
+                hosts = [host for host, _ in standins]
+                self.stdout.write(f'Started {len(standins)} stand-in servers: {" ".join(hosts)}')
+
+            groups = [f'conversation_{i}' for i in range(1, options['groups'] + 1)]
+            elapsed, reports = fan_out(
+                hosts, options['workers'], groups, options['messages'], options['batch'], options['timeout']
+            )
+        finally:
+            for _, standin in standins:
+                standin.terminate()
+
+        failed = False
+        latencies = []
+        for report in reports:
+            latencies.extend(report['latencies'])
+            if report['error']:
+                failed = True
+                self.stdout.write(self.style.ERROR(f"Worker {report['pid']}: {report['error']}"))
+            else:
+                self.stdout.write(f"Worker {report['pid']}: {report['received']} messages, all groups in order")
+
+        sent = len(groups) * options['messages']
+        self.stdout.write(
+            f'Sent {sent} group messages over {len(hosts)} shards in {elapsed * 1000:.0f}ms '
+            f'({sent / max(elapsed, 1e-9):.0f}/s), {sent * len(reports)} deliveries expected'
+        )
+        if latencies:
+            latencies.sort()
+            p50, p99 = latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            self.stdout.write(f'Delivery latency p50 {p50 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms')
+
+        if failed:
+            raise SystemExit(1)
+        self.stdout.write(self.style.SUCCESS('Cross-process fan-out OK'))
+
+
+def configured_hosts():
+    layer = settings.CHANNEL_LAYERS['default']
+    if layer['BACKEND'].endswith('ShardedRedisChannelLayer'):
+        return list(layer.get('CONFIG', {}).get('hosts', []))
+    return []
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise CommandError(f'Stand-in server on port {port} did not start')
+
+
+def start_standins(count, timeout):
+    """Start count stand-in servers in their own processes, as [(redis URL, process)]"""
+    context = multiprocessing.get_context('spawn')
+    standins = []
+    try:
+        for _ in range(count):
+            port = free_port()
+            standin = context.Process(target=run_standin, args=(port,), daemon=True)
+            standin.start()
+            standins.append((f'redis://127.0.0.1:{port}', standin))
+            wait_for_port(port, timeout)
+    except BaseException:
+        for _, standin in standins:
+            standin.terminate()
+        raise
+    return standins
+
+
+def fan_out(hosts, workers, groups, messages, batch, timeout):
+    """
+    Start worker processes joined to every group, send each group messages from here and collect the workers'
+    reports of what they received. Returns (seconds the sends took, [report])
+    """
+    context = multiprocessing.get_context('spawn')
+    expected = len(groups) * messages + 1
+    ready, results = context.Queue(), context.Queue()
+    processes = [
+        context.Process(target=run_worker, args=(hosts, groups, expected, ready, results, timeout), daemon=True)
+        for _ in range(workers)
+    ]
+    try:
+        for process in processes:
+            process.start()
+        try:
+            channels = [ready.get(timeout=timeout) for _ in processes]
+        except queue.Empty:
+            raise CommandError('Workers did not start in time (is the channel layer reachable?)')
+
+        elapsed = asyncio.run(publish(hosts, groups, channels, messages, batch))
+        try:
+            reports = [results.get(timeout=timeout) for _ in processes]
+        except queue.Empty:
+            raise CommandError('Workers did not report in time')
+    finally:
+        for process in processes:
+            process.terminate()
+    return elapsed, reports
+
+
+def run_standin(port):
+    asyncio.run(PubSubServer().serve('127.0.0.1', port))
+
+
+async def publish(hosts, groups, channels, messages, batch):
+    """Send every group its messages in group_send_batch pipelines, then message each worker's channel directly"""
+    layer = ShardedRedisChannelLayer(hosts=hosts)
+    sends = [
+        (group, {'type': 'chat.message', 'group': group, 'seq': seq, 'sent_at': time.time()})
+        for seq in range(messages) for group in groups
+    ]
+    started = time.perf_counter()
+    for start in range(0, len(sends), batch):
+        await layer.group_send_batch(sends[start:start + batch])
+    elapsed = time.perf_counter() - started
+
+    # Specific channels of other processes go through their inbox
+    for channel in channels:
+        await layer.send(channel, {'type': 'chat.done'})
+    await layer.close()
+    return elapsed
+
+
+def run_worker(hosts, groups, expected, ready, results, timeout):
+    import django
+    django.setup()
+    results.put(asyncio.run(worker(hosts, groups, expected, ready, timeout)))
+
+
+async def worker(hosts, groups, expected, ready, timeout):
+    """Join every group with one channel and check what arrives"""
+    import os
+    layer = ShardedRedisChannelLayer(hosts=hosts, capacity=expected)
+    channel = await layer.new_channel()
+    for group in groups:
+        await layer.group_add(group, channel)
+    ready.put(channel)
+
+    # Order is only kept per shard, so the direct message can overtake group messages from other shards
+    next_seq = {group: 0 for group in groups}
+    latencies, error, received, done = [], None, 0, False
+    try:
+        while received < expected:
+            message = await asyncio.wait_for(layer.receive(channel), timeout)
+            received += 1
+            if message['type'] == 'chat.done':
+                done = True
+                continue
+            latencies.append(time.time() - message['sent_at'])
+            if message['seq'] != next_seq[message['group']]:
+                error = f"{message['group']}: got message {message['seq']}, expected {next_seq[message['group']]}"
+                break
+            next_seq[message['group']] += 1
+    except asyncio.TimeoutError:
+        error = f'timed out after {received} messages'
+    await layer.close()
+
+    if error is None:
+        missing = [group for group, seq in next_seq.items() if seq != (expected - 1) // len(groups)]
+        if missing or received != expected or not done:
+            error = f'received {received} of {expected} messages, {len(missing)} groups incomplete'
+    return {'pid': os.getpid(), 'received': received, 'error': error, 'latencies': latencies}
@@ -0,0 +1,144 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+class Command(BaseCommand):
+    help = (
+        'Crash test of write-behind message persistence: a writer process journals and "broadcasts" messages, '
+        'dies before flushing them, and recovery must insert every broadcast message exactly as it was sent'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500, help='Messages the writer sends before crashing')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for the writer')
+
+    def handle(self, *args, **options):
+        # Imported here, the writer process loads this module before Django is set up
+        from ads.models import Ad
+        from messaging.inbox import rebuild_last_messages
+        from messaging.models import Conversation, Message
+        from messaging.serializers import MessageSerializer
+        from messaging.unread import check_unread_counts
+        from messaging.write_behind import recover_journals
+        from supabase_auth.models import User
+
+        users = list(User.objects.order_by('id')[:2])
+        ad = Ad.objects.order_by('id').first()
+        if len(users) < 2 or ad is None:
+            raise CommandError('Needs at least two users and one ad in the database')
+
+        conversation = Conversation.objects.create(ad=ad)
+        conversation.participants.add(*users)
+        directory = tempfile.mkdtemp(prefix='message-journal-')
+        context = multiprocessing.get_context('spawn')
+        results, crash = context.Queue(), context.Event()
+        writer = context.Process(
+            target=run_writer,
+            args=(directory, conversation.id, [user.id for user in users], options['messages'], results, crash),
+            daemon=True,
+        )
+        failures = []
+        try:
+            writer.start()
+            try:
+                report = results.get(timeout=options['timeout'])
+            except queue.Empty:
+                raise CommandError('The writer did not report in time')
+            payloads = report['payloads']
+            self.stdout.write(
+                f"Writer broadcast {len(payloads)} messages, journal write to broadcast p50 "
+                f"{report['p50'] * 1000:.2f}ms, p99 {report['p99'] * 1000:.2f}ms"
+            )
+
+            ids = [payload['id'] for payload in payloads]
+            if Message.objects.filter(id__in=ids).exists():
+                failures.append('Messages were inserted before the flush, the test proves nothing')
+            if recover_journals(directory) != (0, 0):
+                failures.append('Recovery took over the journal of a live writer')
+
+            # Crash, and leave a torn half line at the end of the journal like a crash mid-write would
+            crash.set()
+            writer.join(options['timeout'])
+            journals = os.listdir(directory)
+            if len(journals) != 1:
+                failures.append(f'Expected one journal after the crash, found {len(journals)}')
+            else:
+                with open(os.path.join(directory, journals[0]), 'ab') as journal:
+                    journal.write(b'{"id": 1, "conversation_id"')
+
+            recovered = recover_journals(directory)
+            self.stdout.write(f'Recovered {recovered[1]} messages from {recovered[0]} journals')
+
+            stored = {
+                message.id: message for message in
+                Message.objects.filter(id__in=ids).select_related('sender').prefetch_related('attachments')
+            }
+            missing = [message_id for message_id in ids if message_id not in stored]
+            if missing:
+                failures.append(f'{len(missing)} broadcast messages were lost, e.g. {missing[:10]}')
+            changed = [
+                payload['id'] for payload in payloads
+                if payload['id'] in stored and MessageSerializer(stored[payload['id']]).data != payload
+            ]
+            if changed:
+                failures.append(f'{len(changed)} messages differ from what was broadcast, e.g. {changed[:10]}')
+
+            if check_unread_counts([conversation.id]):
+                failures.append('Unread counters do not match the recovered messages')
+            with transaction.atomic():
+                if rebuild_last_messages([conversation.id]):
+                    failures.append('The last message pointer is not the newest recovered message')
+            if recover_journals(directory) != (0, 0) or os.listdir(directory):
+                failures.append('Recovery is not idempotent or left journals behind')
+        finally:
+            if writer.is_alive():
+                writer.terminate()
+            conversation.delete()
+            shutil.rmtree(directory, ignore_errors=True)
+
+        for failure in failures:
+            self.stdout.write(self.style.ERROR(failure))
+        if failures:
+            raise SystemExit(1)
+        self.stdout.write(self.style.SUCCESS('Every broadcast message survived the crash'))
+
+
+def run_writer(directory, conversation_id, user_ids, messages, results, crash):
+    import django
+    django.setup()
+    from supabase_auth.models import User
+    senders = list(User.objects.filter(id__in=user_ids).order_by('id'))
+    report, write_behind = asyncio.run(write(directory, conversation_id, senders, messages))
+    results.put(report)
+    # write_behind (and its locked journal) lives until the crash, which skips any cleanup
+    crash.wait()
+    os._exit(1)
+
+
+async def write(directory, conversation_id, senders, messages):
+    """Send messages through a write-behind that never gets to flush, alternating senders, some with images"""
+    from messaging.write_behind import MessageWriteBehind
+    write_behind = MessageWriteBehind(directory=directory, interval_ms=3600 * 1000, batch_size=messages + 1)
+
+    async def send(i):
+        started = time.perf_counter()
+        payload = await write_behind.post(
+            senders[i % 2], conversation_id, f'Message {i}',
+            f'https://example.com/{i}.jpg' if i % 5 == 0 else None,
+        )
+        return payload, time.perf_counter() - started
+
+    sent = await asyncio.gather(*(send(i) for i in range(messages)))
+    latencies = sorted(latency for _, latency in sent)
+    report = {
+        'payloads': [payload for payload, _ in sent],
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+    return report, write_behind
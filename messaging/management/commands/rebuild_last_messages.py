@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from messaging.inbox import rebuild_last_messages
+
+class Command(BaseCommand):
+    help = 'Backfill and repair the last message pointer of every conversation from the Message table'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            repaired = rebuild_last_messages()
+        self.stdout.write(self.style.SUCCESS(f'Repaired the last message of {len(repaired)} conversations'))
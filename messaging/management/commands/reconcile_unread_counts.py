@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from messaging.unread import check_unread_counts, reconcile_unread_counts
+
+class Command(BaseCommand):
+    help = 'Recompute per-participant unread counters from the Message table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report counters that do not match the messages, without fixing them',
+        )
+
+    def handle(self, *args, **options):
+        if options['check']:
+            wrong = check_unread_counts()
+            if not wrong:
+                self.stdout.write(self.style.SUCCESS('Unread counters match the messages'))
+                return
+            self.stdout.write(self.style.ERROR(
+                f'{len(wrong)} unread counters are wrong, e.g. (conversation, user) {wrong[:10]}'
+            ))
+            raise SystemExit(1)
+
+        with transaction.atomic():
+            repaired = reconcile_unread_counts()
+        self.stdout.write(self.style.SUCCESS(f'Repaired {len(repaired)} unread counters'))
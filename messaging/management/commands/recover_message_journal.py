@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from messaging.write_behind import recover_journals
+
+class Command(BaseCommand):
+    help = (
+        'Insert the websocket messages left in the write-behind journals of dead processes '
+        '(journals of running processes are skipped)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dir',
+            default=None,
+            help='Journal directory (default: MESSAGING_WRITE_BEHIND_DIR)',
+        )
+
+    def handle(self, *args, **options):
+        journals, inserted = recover_journals(options['dir'] or settings.MESSAGING_WRITE_BEHIND_DIR)
+        self.stdout.write(self.style.SUCCESS(f'Recovered {inserted} messages from {journals} journals'))
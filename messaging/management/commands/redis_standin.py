@@ -0,0 +1,19 @@
+import asyncio
+from django.core.management.base import BaseCommand
+from contractingo.redis_standin import PubSubServer
+
+class Command(BaseCommand):
+    help = 'Run the in-repo Redis pub/sub stand-in, so several ASGI workers can share a channel layer without Redis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+        parser.add_argument('--port', type=int, default=6379, help='Port to listen on')
+
+    def handle(self, *args, **options):
+        started = lambda: self.stdout.write(self.style.SUCCESS(
+            f"Redis stand-in listening on redis://{options['host']}:{options['port']}"
+        ))
+        try:
+            asyncio.run(PubSubServer().serve(options['host'], options['port'], started))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import ConversationParticipant
+
+"""
+MEMBERSHIP CACHE:
+
+    Every websocket connect (and mobile clients reconnect all the time) checked membership by loading the
+    conversation and every participant. is_participant answers from a per-process cache instead:
+        - Keyed by (conversation_id, user_id), holding yes or no, so repeated denied attempts are cheap too
+        - A miss is one EXISTS query on the (conversation, user) unique index of the participants table, and
+          participant_conversation_ids checks many conversations of one user in one query
+        - Participant changes and deleted conversations drop the conversation's entries once committed
+          (see messaging/signals.py). Each drop also bumps the conversation's version: a lookup reads it before
+          its query and the answer isn't cached if it changed meanwhile, so a query that raced an invalidation
+          can't put back what it dropped
+        - Entries expire after MESSAGING_MEMBERSHIP_CACHE_TTL_SECONDS, which covers changes made by other
+          workers: someone removed from a conversation there can still connect here until then
+        - LRU bounded by MESSAGING_MEMBERSHIP_CACHE_MAX_ENTRIES (0 disables the cache)
+
+    manage.py benchmark_reconnects compares the database load of a reconnect storm with and without it.
+"""
+
+
+class MembershipCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_conversation = {}
+        # Invalidation counters: per conversation, and of clear() for all of them
+        self._versions = {}
+        self._cleared = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_sets = 0
+
+    def get(self, conversation_id, user_id):
+        """Get whether user_id is a participant of conversation_id, or None when not cached"""
+        key = (conversation_id, user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            is_member, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return is_member
+
+    def version(self, conversation_id):
+        """Get the invalidation version of a conversation, to read before querying its membership"""
+        with self._lock:
+            return self._cleared, self._versions.get(conversation_id, 0)
+
+    def set(self, conversation_id, user_id, is_member, version=None):
+        """Cache an answer, unless the conversation was invalidated since version was read"""
+        max_entries = getattr(settings, 'MESSAGING_MEMBERSHIP_CACHE_MAX_ENTRIES', 100000)
+        if max_entries <= 0:
+            return
+        ttl = getattr(settings, 'MESSAGING_MEMBERSHIP_CACHE_TTL_SECONDS', 60)
+
+        key = (conversation_id, user_id)
+        with self._lock:
+            if version is not None and version != (self._cleared, self._versions.get(conversation_id, 0)):
+                # Read before an invalidation, may be out of date already
+                self.stale_sets += 1
+                return
+            self._entries[key] = (is_member, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            self._by_conversation.setdefault(conversation_id, set()).add(user_id)
+            while len(self._entries) > max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self._entries[key]
+        users = self._by_conversation.get(key[0])
+        if users is not None:
+            users.discard(key[1])
+            if not users:
+                del self._by_conversation[key[0]]
+
+    def invalidate_conversations(self, conversation_ids):
+        """Drop every cached answer about the given conversations"""
+        with self._lock:
+            for conversation_id in conversation_ids:
+                for user_id in self._by_conversation.pop(conversation_id, ()):
+                    self._entries.pop((conversation_id, user_id), None)
+                self._versions[conversation_id] = self._versions.get(conversation_id, 0) + 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_conversation.clear()
+            self._cleared += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'stale_sets': self.stale_sets,
+            }
+
+
+# One cache per process, shared by every consumer and request
+membership_cache = MembershipCache()
+
+
+def is_participant(conversation_id, user_id):
+    """Whether a user is a participant of a conversation (False when the conversation doesn't exist)"""
+    is_member = membership_cache.get(conversation_id, user_id)
+    if is_member is None:
+        is_member = query_participant(conversation_id, user_id)
+    return is_member
+
+
+def query_participant(conversation_id, user_id):
+    """is_participant straight from the database, caching the answer"""
+    version = membership_cache.version(conversation_id)
+    is_member = ConversationParticipant.objects.filter(conversation_id=conversation_id, user_id=user_id).exists()
+    membership_cache.set(conversation_id, user_id, is_member, version)
+    return is_member
+
+
+def participant_conversation_ids(user_id, conversation_ids):
+    """Get the ids among conversation_ids of the conversations the user is a participant of"""
+    allowed, unknown = set(), set()
+    for conversation_id in conversation_ids:
+        is_member = membership_cache.get(conversation_id, user_id)
+        if is_member is None:
+            unknown.add(conversation_id)
+        elif is_member:
+            allowed.add(conversation_id)
+
+    if unknown:
+        versions = {conversation_id: membership_cache.version(conversation_id) for conversation_id in unknown}
+        members = set(ConversationParticipant.objects.filter(
+            user_id=user_id, conversation_id__in=unknown
+        ).values_list('conversation_id', flat=True))
+        for conversation_id in unknown:
+            membership_cache.set(conversation_id, user_id, conversation_id in members, versions[conversation_id])
+        allowed |= members
+    return allowed
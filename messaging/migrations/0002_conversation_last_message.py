@@ -0,0 +1,54 @@
+# Generated by Django 5.2.2 on 2026-10-17 18:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.utils.text import Truncator
+
+
+def backfill_last_messages(apps, schema_editor):
+    Conversation = apps.get_model('messaging', 'Conversation')
+    Message = apps.get_model('messaging', 'Message')
+
+    newest = Message.objects.filter(conversation=OuterRef('pk')).order_by('-created_at', '-id')
+    Conversation.objects.update(
+        last_message_id=Subquery(newest.values('id')[:1]),
+        last_message_at=Subquery(newest.values('created_at')[:1]),
+    )
+
+    conversations = []
+    rows = Message.objects.filter(
+        id__in=Conversation.objects.filter(last_message__isnull=False).values('last_message_id')
+    ).values_list('conversation_id', 'content')
+    for conversation_id, content in rows.iterator():
+        conversations.append(Conversation(
+            id=conversation_id,
+            last_message_preview=Truncator(' '.join((content or '').split())).chars(140),
+        ))
+    Conversation.objects.bulk_update(conversations, ['last_message_preview'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messaging.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=140),
+        ),
+        migrations.RunPython(backfill_last_messages, migrations.RunPython.noop),
+    ]
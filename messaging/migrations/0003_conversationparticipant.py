@@ -0,0 +1,61 @@
+# Generated by Django 5.2.2 on 2026-10-17 18:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_last_activity(apps, schema_editor):
+    Conversation = apps.get_model('messaging', 'Conversation')
+    ConversationParticipant = apps.get_model('messaging', 'ConversationParticipant')
+
+    activity = Conversation.objects.filter(id=OuterRef('conversation_id')).annotate(
+        activity=Coalesce(F('last_message_at'), F('created_at'))
+    ).values('activity')[:1]
+    ConversationParticipant.objects.update(last_activity_at=Subquery(activity))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0002_conversation_last_message'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # The participants M2M table already exists, only Django's view of it changes
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ConversationParticipant',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='messaging.conversation')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'messaging_conversation_participants',
+                        'unique_together': {('conversation', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='conversation',
+                    name='participants',
+                    field=models.ManyToManyField(related_name='user_conversations', through='messaging.ConversationParticipant', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_last_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='conversationparticipant',
+            index=models.Index(fields=['user', '-last_activity_at', '-conversation'], name='messaging_inbox_idx'),
+        ),
+    ]
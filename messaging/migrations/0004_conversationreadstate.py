@@ -0,0 +1,51 @@
+# Generated by Django 5.2.2 on 2026-10-17 19:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Q
+
+
+def backfill_read_states(apps, schema_editor):
+    ConversationParticipant = apps.get_model('messaging', 'ConversationParticipant')
+    ConversationReadState = apps.get_model('messaging', 'ConversationReadState')
+
+    memberships = ConversationParticipant.objects.order_by().annotate(
+        unread_count=Count(
+            'conversation__messages',
+            filter=Q(conversation__messages__is_read=False) & ~Q(conversation__messages__sender_id=F('user_id')),
+        )
+    ).values_list('conversation_id', 'user_id', 'unread_count')
+    ConversationReadState.objects.bulk_create(
+        [
+            ConversationReadState(conversation_id=conversation_id, user_id=user_id, unread_count=unread_count)
+            for conversation_id, user_id, unread_count in memberships.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0003_conversationparticipant'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='messaging.conversation')),
+                ('last_read_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messaging.message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('conversation', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_read_states, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.2 on 2026-10-17 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0005_message_created_at_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationreadstate',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
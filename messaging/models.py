@@ -1,13 +1,18 @@
 from django.db import models
+from django.utils import timezone
 from ads.models import Ad
 from supabase_auth.models import User
 
 class Conversation(models.Model):
     ad = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name='conversations')
-    participants = models.ManyToManyField(User, related_name='user_conversations')
+    participants = models.ManyToManyField(User, through='ConversationParticipant', related_name='user_conversations')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
+    # Newest message, kept up to date when messages are created (see messaging/inbox.py)
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=140, blank=True, default='')
 
     class Meta:
         ordering = ['-updated_at']
@@ -15,11 +20,29 @@ class Conversation(models.Model):
     def __str__(self):
         return f"Conversation about {self.ad.title}"
 
+class ConversationParticipant(models.Model):
+    # Membership row of the participants M2M (same table as before it had a through model), carrying the
+    # conversation's last activity so a user's inbox is read straight off the (user, last activity) index
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_memberships')
+    last_activity_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'messaging_conversation_participants'
+        unique_together = [('conversation', 'user')]
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at', '-conversation'], name='messaging_inbox_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} in conversation {self.conversation_id}"
+
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Like auto_now_add, but lets write-behind persistence (see messaging/write_behind.py) keep the time it assigned
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     is_read = models.BooleanField(default=False)
 
     class Meta:
@@ -31,10 +54,27 @@ class Message(models.Model):
 class MessageAttachment(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='attachments')
     image_url = models.URLField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         ordering = ['created_at']
     
     def __str__(self):
-        return f"Attachment for message {self.message.id}"
\ No newline at end of file
+        return f"Attachment for message {self.message.id}"
+
+
+class ConversationReadState(models.Model):
+    # Per participant unread counter, kept up to date on message creation and mark_as_read (see messaging/unread.py)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_read_states')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # When mark_read last ran, so messages sent before it but inserted later (write-behind) aren't counted unread
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('conversation', 'user')]
+
+    def __str__(self):
+        return f"{self.user_id} has {self.unread_count} unread in conversation {self.conversation_id}"
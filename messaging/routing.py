@@ -2,5 +2,7 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/conversation/(?P<conversation_id>\d+)/$',consumers.ConversationConsumer.as_asgi())
+    re_path(r'ws/conversation/(?P<conversation_id>\d+)/$',consumers.ConversationConsumer.as_asgi()),
+    # One socket for all of a user's conversations
+    re_path(r'ws/messaging/$', consumers.UserConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -1,7 +1,7 @@
 from rest_framework import serializers
 from .models import Conversation, Message, MessageAttachment
 from supabase_auth.models import User
-from ads.serializers import AdSerializer
+from ads.serializers import AdSerializer, AdSummarySerializer
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -22,16 +22,27 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'content', 'created_at', 'is_read', 'sender', 'attachments']
 
 class ConversationSerializer(serializers.ModelSerializer):
-    participants = UserSerializer(many=True, read_only=True)
-    ad = AdSerializer(read_only=True)
+    participants = serializers.SerializerMethodField()
+    # Compact ad summary by default, the full ad when the context asks for it (expand_ad, from ?expand=ad)
+    ad = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
 
     class Meta:
         model = Conversation
-        fields = ['id', 'ad', 'participants', 'created_at', 'updated_at', 'last_message']
+        fields = ['id', 'ad', 'participants', 'created_at', 'updated_at', 'last_message_at', 'last_message_preview', 'last_message']
     
+    def get_participants(self, obj):
+        # In user id order, sorted here so the prefetched participants are reused
+        participants = sorted(obj.participants.all(), key=lambda user: user.id)
+        return UserSerializer(participants, many=True).data
+
+    def get_ad(self, obj):
+        if self.context.get('expand_ad'):
+            return AdSerializer(obj.ad).data
+        return AdSummarySerializer(obj.ad).data
+
     def get_last_message(self, obj):
-        last_msg = obj.messages.last()
-        if last_msg:
-            return MessageSerializer(last_msg).data
+        # Denormalized pointer, see messaging/inbox.py
+        if obj.last_message_id:
+            return MessageSerializer(obj.last_message).data
         return None
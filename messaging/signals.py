@@ -0,0 +1,50 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+
+from .membership import membership_cache
+from .models import Conversation, ConversationReadState
+from .unread import ensure_read_states
+
+
+# Every participant gets an unread counter when they join a conversation, in the same transaction
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def update_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add':
+        if reverse:
+            # user.user_conversations.add(...)
+            for conversation_id in pk_set:
+                ensure_read_states(conversation_id, [instance.id])
+        else:
+            ensure_read_states(instance.id, pk_set)
+    elif action == 'post_remove':
+        if reverse:
+            ConversationReadState.objects.filter(user_id=instance.id, conversation_id__in=pk_set).delete()
+        else:
+            ConversationReadState.objects.filter(conversation_id=instance.id, user_id__in=pk_set).delete()
+    elif action == 'post_clear':
+        if reverse:
+            ConversationReadState.objects.filter(user_id=instance.id).delete()
+        else:
+            ConversationReadState.objects.filter(conversation_id=instance.id).delete()
+
+
+# Cached membership checks (see messaging/membership.py) are dropped once participant changes are committed
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def invalidate_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        transaction.on_commit(lambda: membership_cache.invalidate_conversations([instance.id]))
+    elif pk_set is not None:
+        conversation_ids = list(pk_set)
+        transaction.on_commit(lambda: membership_cache.invalidate_conversations(conversation_ids))
+    else:
+        # user.user_conversations.clear() doesn't say which conversations it left
+        transaction.on_commit(membership_cache.clear)
+
+
+@receiver(post_delete, sender=Conversation)
+def invalidate_deleted_conversation(sender, instance, **kwargs):
+    conversation_id = instance.id
+    transaction.on_commit(lambda: membership_cache.invalidate_conversations([conversation_id]))
@@ -1,3 +1,792 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from django.db import connection
+from django.db.models import Prefetch, QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from jose import jwt
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ads.models import Ad, AdType, Photo
+from ads.querysets import ad_list_queryset, ad_summary_queryset
+from ads.serializers import AdSerializer
+from contractingo.channel_layer import ShardedRedisChannelLayer
+from contractingo.resp import RedisConnection, read_reply
+from supabase_auth.models import User
+from . import write_behind
+from .checks import check_write_behind_database
+from .consumers import UserConsumer
+from .fast_serializers import serialize_conversations
+from .inbox import PREVIEW_LENGTH, create_message, inbox_page, rebuild_last_messages, record_messages
+from .management.commands.check_channel_layer import fan_out, free_port, run_standin, start_standins, wait_for_port
+from .membership import MembershipCache, membership_cache, participant_conversation_ids, query_participant
+from .models import Conversation, ConversationParticipant, Message
+from .serializers import ConversationSerializer, MessageSerializer
+from .typing import TypingCoalescer
+from .unread import check_unread_counts, conversation_unread_count, mark_read, user_unread_count
+from .views import ConversationDetailView, ConversationListCreateView, get_unread_counts
+from .write_behind import MessageWriteBehind, recover_journals
+
+
+def create_user(n):
+    return User.objects.create_user(uid=f'uid-{n}', email=f'user{n}@example.com', name=f'User {n}')
+
+
+def create_conversation(ad, *users):
+    conversation = Conversation.objects.create(ad=ad)
+    conversation.participants.add(*users)
+    return conversation
+
+
+class FastSerializerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner, client = create_user(1), create_user(2)
+        ad_type = AdType.objects.create(name='Plumbing')
+        ad = Ad.objects.create(title='Plumber', description='', ad_type=ad_type, cost='50', user=owner)
+        Photo.objects.create(ad=ad, image_url='https://example.com/1.jpg')
+        with_messages = create_conversation(ad, client, owner)
+        create_message(with_messages, client, 'Hi, are you free tomorrow?')
+        create_message(with_messages, owner, 'Yes', image_url='https://example.com/reply.jpg')
+        empty = create_conversation(ad, owner, client)
+        cls.conversation_ids = [with_messages.id, empty.id]
+
+    def drf_conversations(self, expand_ad):
+        ads = ad_list_queryset() if expand_ad else ad_summary_queryset()
+        conversations = Conversation.objects.filter(id__in=self.conversation_ids).select_related(
+            'last_message__sender'
+        ).prefetch_related('participants', 'last_message__attachments', Prefetch('ad', queryset=ads)).order_by('id')
+        return ConversationSerializer(conversations, many=True, context={'expand_ad': expand_ad}).data
+
+    def test_serialize_conversations_matches_conversation_serializer(self):
+        renderer = JSONRenderer()
+        for expand_ad in (False, True):
+            self.assertEqual(
+                renderer.render(serialize_conversations(self.conversation_ids, expand_ad=expand_ad)),
+                renderer.render(self.drf_conversations(expand_ad)),
+                expand_ad,
+            )
+
+    def test_participants_are_in_user_id_order_on_both_paths(self):
+        conversations = Conversation.objects.filter(id__in=self.conversation_ids).prefetch_related(
+            Prefetch('participants', queryset=User.objects.order_by('-id'))
+        ).order_by('id')
+        drf = [
+            [user['id'] for user in conversation['participants']]
+            for conversation in ConversationSerializer(conversations, many=True).data
+        ]
+        fast = [
+            [user['id'] for user in conversation['participants']]
+            for conversation in serialize_conversations(self.conversation_ids)
+        ]
+        self.assertEqual(drf, fast)
+        self.assertTrue(all(ids == sorted(ids) and len(ids) == 2 for ids in drf))
+
+
+class ConversationAdTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.client_user = create_user(1), create_user(2)
+        ad_type = AdType.objects.create(name='Plumbing')
+        cls.ad = Ad.objects.create(title='Plumber', description='Leaks and pipes', ad_type=ad_type, cost='50', user=cls.owner)
+        Photo.objects.create(ad=cls.ad, image_url='https://example.com/second.jpg', order=1)
+        Photo.objects.create(ad=cls.ad, image_url='https://example.com/first.jpg', order=0)
+        cls.conversation = create_conversation(cls.ad, cls.client_user, cls.owner)
+
+    def conversation_ad(self, **params):
+        request = APIRequestFactory().get('/api/messaging/conversations/', params)
+        force_authenticate(request, self.client_user)
+        return ConversationListCreateView.as_view()(request).data[0]['ad']
+
+    def test_conversations_embed_an_ad_summary(self):
+        for fast in (True, False):
+            with self.subTest(fast=fast), self.settings(FAST_SERIALIZERS=fast):
+                self.assertEqual(self.conversation_ad(), {
+                    'id': self.ad.id,
+                    'title': 'Plumber',
+                    'first_photo': 'https://example.com/first.jpg',
+                })
+
+    def test_expand_ad_embeds_the_full_ad(self):
+        for fast in (True, False):
+            with self.subTest(fast=fast), self.settings(FAST_SERIALIZERS=fast):
+                ad = self.conversation_ad(expand='ad')
+                self.assertEqual(list(ad), AdSerializer.Meta.fields)
+                self.assertEqual(ad['description'], 'Leaks and pipes')
+                self.assertEqual([photo['order'] for photo in ad['photos']], [0, 1])
+
+    def test_detail_view_embeds_a_summary_unless_expanded(self):
+        view = ConversationDetailView.as_view()
+        for params, keys in (({}, ['id', 'title', 'first_photo']), ({'expand': 'ad'}, AdSerializer.Meta.fields)):
+            request = APIRequestFactory().get(f'/api/messaging/conversations/{self.conversation.id}/', params)
+            force_authenticate(request, self.client_user)
+            response = view(request, pk=self.conversation.id)
+            self.assertEqual(list(response.data['ad']), keys, params)
+
+
+class LastMessageTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.client_user = create_user(1), create_user(2)
+        ad_type = AdType.objects.create(name='Plumbing')
+        ad = Ad.objects.create(title='Plumber', description='', ad_type=ad_type, cost='50', user=cls.owner)
+        cls.conversation = create_conversation(ad, cls.client_user, cls.owner)
+
+    def pointer(self):
+        conversation = Conversation.objects.get(id=self.conversation.id)
+        return conversation.last_message_id, conversation.last_message_at, conversation.last_message_preview
+
+    def test_new_messages_move_the_pointer(self):
+        first = create_message(self.conversation, self.client_user, 'Hi')
+        self.assertEqual(self.pointer(), (first.id, first.created_at, 'Hi'))
+
+        second = create_message(self.conversation, self.owner, '  Yes,\n\n  tomorrow  works ' + 'x' * 200)
+        last_message_id, last_message_at, preview = self.pointer()
+        self.assertEqual((last_message_id, last_message_at), (second.id, second.created_at))
+        self.assertTrue(preview.startswith('Yes, tomorrow works x'))
+        self.assertEqual(len(preview), PREVIEW_LENGTH)
+
+    def test_older_messages_dont_move_the_pointer_back(self):
+        newest = create_message(self.conversation, self.client_user, 'Newest')
+        older = Message.objects.create(
+            conversation=self.conversation, sender=self.owner, content='Older',
+            created_at=newest.created_at - timedelta(minutes=1),
+        )
+        record_messages([older])
+        self.assertEqual(self.pointer()[0], newest.id)
+        self.assertEqual(rebuild_last_messages(), [])
+
+    def test_deleted_last_message_is_repaired_by_rebuild(self):
+        first = create_message(self.conversation, self.client_user, 'Hi')
+        create_message(self.conversation, self.owner, 'Yes').delete()
+        # Deleting the pointed-to message only clears the pointer
+        self.assertIsNone(self.pointer()[0])
+
+        self.assertEqual(rebuild_last_messages(), [self.conversation.id])
+        self.assertEqual(self.pointer(), (first.id, first.created_at, 'Hi'))
+        self.assertEqual(rebuild_last_messages(), [])
+
+    def test_serializers_read_the_pointer(self):
+        create_message(self.conversation, self.client_user, 'Hi')
+        message = create_message(self.conversation, self.owner, 'Yes')
+        conversation = Conversation.objects.select_related('last_message__sender').get(id=self.conversation.id)
+        with CaptureQueriesContext(connection) as queries:
+            data = ConversationSerializer(conversation).data
+        self.assertEqual(data['last_message']['id'], message.id)
+        self.assertFalse(any('FROM "messaging_message"' in query['sql'] for query in queries))
+        self.assertEqual(serialize_conversations([self.conversation.id])[0]['last_message']['id'], message.id)
+
+
+class InboxTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = create_user(1)
+        ad_type = AdType.objects.create(name='Plumbing')
+        ad = Ad.objects.create(title='Plumber', description='', ad_type=ad_type, cost='50', user=cls.owner)
+        cls.conversations = [create_conversation(ad, create_user(2 + i), cls.owner) for i in range(5)]
+
+    def get(self, **params):
+        request = APIRequestFactory().get('/api/messaging/conversations/', params)
+        force_authenticate(request, self.owner)
+        return ConversationListCreateView.as_view()(request)
+
+    def walk(self, limit):
+        pages = []
+        cursor = ''
+        while True:
+            response = self.get(cursor=cursor, limit=limit)
+            pages.append([conversation['id'] for conversation in response.data['data']])
+            if not response.data['has_next']:
+                self.assertIsNone(response.data['next_cursor'])
+                return pages
+            cursor = response.data['next_cursor']
+
+    def test_newest_activity_first(self):
+        # Same activity for all (ties go to the higher conversation id), then messages move two to the top
+        ConversationParticipant.objects.update(last_activity_at=self.conversations[0].created_at)
+        first, second = self.conversations[1], self.conversations[3]
+        create_message(first, first.participants.exclude(id=self.owner.id).get(), 'Hi')
+        create_message(second, self.owner, 'Hello')
+
+        ids = [conversation.id for conversation in self.conversations]
+        expected = [second.id, first.id] + sorted(set(ids) - {first.id, second.id}, reverse=True)
+        self.assertEqual(inbox_page(self.owner, None, 10), (expected, None))
+        self.assertEqual([conversation['id'] for conversation in self.get().data], expected)
+
+    def test_cursor_walks_the_inbox_once(self):
+        ConversationParticipant.objects.update(last_activity_at=self.conversations[0].created_at)
+        create_message(self.conversations[2], self.owner, 'Hello')
+
+        pages = self.walk(limit=2)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), [conversation['id'] for conversation in self.get().data])
+
+        self.assertEqual(self.walk(limit=5), [sum(pages, [])])
+
+    def test_archived_conversations_are_left_out(self):
+        Conversation.objects.filter(id=self.conversations[0].id).update(is_active=False)
+        ids, _ = inbox_page(self.owner, None, 10)
+        self.assertNotIn(self.conversations[0].id, ids)
+        self.assertEqual(len(ids), 4)
+
+    def test_invalid_cursor_or_limit_is_rejected(self):
+        self.assertEqual(self.get(cursor='not-a-cursor').status_code, 400)
+        self.assertEqual(self.get(cursor='', limit='ten').status_code, 400)
+
+
+class UnreadCountTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.client_user = create_user(1), create_user(2)
+        ad_type = AdType.objects.create(name='Plumbing')
+        ad = Ad.objects.create(title='Plumber', description='', ad_type=ad_type, cost='50', user=cls.owner)
+        cls.conversation = create_conversation(ad, cls.client_user, cls.owner)
+
+    def test_counters_match_the_messages_after_mark_read(self):
+        create_message(self.conversation, self.client_user, 'Hi')
+        create_message(self.conversation, self.client_user, 'Are you free tomorrow?')
+        self.assertEqual(conversation_unread_count(self.conversation.id, self.owner), 2)
+        self.assertEqual(check_unread_counts(), [])
+
+        mark_read(self.conversation, self.owner)
+        self.assertEqual(conversation_unread_count(self.conversation.id, self.owner), 0)
+        self.assertEqual(conversation_unread_count(self.conversation.id, self.client_user), 0)
+        self.assertEqual(check_unread_counts(), [])
+
+    def get(self, view, user, **params):
+        request = APIRequestFactory().get('/api/messaging/conversations/', params)
+        force_authenticate(request, user)
+        return view(request)
+
+    def test_total_only_counts_active_conversations(self):
+        archived = create_conversation(self.conversation.ad, self.client_user, self.owner)
+        create_message(self.conversation, self.client_user, 'Hi')
+        create_message(archived, self.client_user, 'Still there?')
+        Conversation.objects.filter(id=archived.id).update(is_active=False)
+
+        response = self.get(get_unread_counts, self.owner)
+        self.assertEqual(response.data['unread_counts'], {self.conversation.id: 1})
+        self.assertEqual(response.data['total'], 1)
+        self.assertEqual(user_unread_count(self.owner), 1)
+
+    def test_with_unread_is_a_boolean(self):
+        create_message(self.conversation, self.client_user, 'Hi')
+        view = ConversationListCreateView.as_view()
+        for value, expected in (('1', True), ('true', True), ('0', False), ('false', False)):
+            data = self.get(view, self.owner, with_unread=value).data
+            self.assertEqual('unread_count' in data[0], expected, value)
+        self.assertEqual(self.get(view, self.owner, with_unread='true').data[0]['unread_count'], 1)
+
+
+class MembershipCacheTests(SimpleTestCase):
+
+    def test_answer_read_before_an_invalidation_is_not_cached(self):
+        cache = MembershipCache()
+        version = cache.version(1)
+        # The user is removed while the membership query runs
+        cache.invalidate_conversations([1])
+        cache.set(1, 10, True, version)
+        self.assertIsNone(cache.get(1, 10))
+
+    def test_answer_read_before_a_clear_is_not_cached(self):
+        cache = MembershipCache()
+        version = cache.version(1)
+        cache.clear()
+        cache.set(1, 10, True, version)
+        self.assertIsNone(cache.get(1, 10))
+
+    def test_other_conversations_invalidations_dont_matter(self):
+        cache = MembershipCache()
+        version = cache.version(1)
+        cache.invalidate_conversations([2])
+        cache.set(1, 10, True, version)
+        self.assertIs(cache.get(1, 10), True)
+
+
+class MembershipQueryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.client_user = create_user(1), create_user(2)
+        ad_type = AdType.objects.create(name='Plumbing')
+        ad = Ad.objects.create(title='Plumber', description='', ad_type=ad_type, cost='50', user=cls.owner)
+        cls.conversation = create_conversation(ad, cls.client_user, cls.owner)
+
+    def setUp(self):
+        membership_cache.clear()
+
+    def removed_during(self, method):
+        """Patch a QuerySet method so the conversation is invalidated right after it read the database"""
+        real = getattr(QuerySet, method)
+
+        def read_then_invalidate(queryset, *args, **kwargs):
+            result = real(queryset, *args, **kwargs)
+            membership_cache.invalidate_conversations([self.conversation.id])
+            return result
+        return mock.patch.object(QuerySet, method, autospec=True, side_effect=read_then_invalidate)
+
+    def test_query_participant_doesnt_cache_an_answer_raced_by_an_invalidation(self):
+        with self.removed_during('exists'):
+            self.assertTrue(query_participant(self.conversation.id, self.owner.id))
+        self.assertIsNone(membership_cache.get(self.conversation.id, self.owner.id))
+
+        self.assertTrue(query_participant(self.conversation.id, self.owner.id))
+        self.assertIs(membership_cache.get(self.conversation.id, self.owner.id), True)
+
+    def test_participant_conversation_ids_doesnt_cache_an_answer_raced_by_an_invalidation(self):
+        with self.removed_during('__iter__'):
+            self.assertEqual(participant_conversation_ids(self.owner.id, {self.conversation.id}), {self.conversation.id})
+        self.assertIsNone(membership_cache.get(self.conversation.id, self.owner.id))
+
+
+class ChannelLayerTests(SimpleTestCase):
+
+    def test_group_messages_fan_out_to_every_worker_process(self):
+        standins = start_standins(2, timeout=10)
+        try:
+            hosts = [host for host, _ in standins]
+            groups = [f'conversation_{i}' for i in range(1, 6)]
+            _elapsed, reports = fan_out(hosts, workers=2, groups=groups, messages=3, batch=4, timeout=10)
+        finally:
+            for _, standin in standins:
+                standin.terminate()
+
+        self.assertEqual(len(reports), 2)
+        for report in reports:
+            self.assertIsNone(report['error'])
+            self.assertEqual(report['received'], len(groups) * 3 + 1)
+
+    def test_connections_are_closed_when_an_async_to_sync_loop_shuts_down(self):
+        port = free_port()
+        threading.Thread(target=run_standin, args=(port,), daemon=True).start()
+        wait_for_port(port, 10)
+        layer = ShardedRedisChannelLayer(hosts=[f'redis://127.0.0.1:{port}'])
+
+        loop_layers = []
+
+        async def send():
+            loop_layers.append(layer.current())
+            await layer.group_send('conversation_1', {'type': 'chat.message'})
+
+        async_to_sync(send)()
+        async_to_sync(send)()
+        self.assertEqual(len(layer.loop_layers), 0)
+        self.assertIsNot(loop_layers[0], loop_layers[1])
+        for loop_layer in loop_layers:
+            self.assertTrue(all(publisher.writer is None for publisher in loop_layer.publishers))
+
+
+class WebsocketCommunicator(ApplicationCommunicator):
+    """
+    What the tests use of channels.testing.WebsocketCommunicator, which can't be imported here: the channels.testing
+    package also loads its live server test case, which needs daphne
+    """
+
+    def __init__(self, application, path):
+        path, _, query_string = path.partition('?')
+        super().__init__(application, {
+            'type': 'websocket', 'path': path, 'query_string': query_string.encode(), 'headers': [], 'subprotocols': [],
+        })
+
+    async def connect(self, timeout=1):
+        await self.send_input({'type': 'websocket.connect'})
+        response = await self.receive_output(timeout)
+        return response['type'] == 'websocket.accept', response.get('code')
+
+    async def send_json_to(self, data):
+        await self.send_input({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def receive_json_from(self, timeout=1):
+        response = await self.receive_output(timeout)
+        return json.loads(response['text'])
+
+    async def disconnect(self, code=1000, timeout=1):
+        await self.send_input({'type': 'websocket.disconnect', 'code': code})
+        await self.wait(timeout)
+
+
+@override_settings(MESSAGING_WRITE_BEHIND=False)
+class UserConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        membership_cache.clear()
+        self.owner, self.client_user, self.outsider = create_user(1), create_user(2), create_user(3)
+        ad_type = AdType.objects.create(name='Plumbing')
+        ad = Ad.objects.create(title='Plumber', description='', ad_type=ad_type, cost='50', user=self.owner)
+        self.conversation = create_conversation(ad, self.client_user, self.owner)
+        self.others = create_conversation(ad, self.outsider, self.owner)
+
+    async def connect(self, user):
+        token = jwt.encode({'sub': user.uid, 'aud': 'authenticated'}, os.environ['SUPABASE_JWT_SECRET'], algorithm='HS256')
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), f'/ws/messaging/?token={token}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def subscribe(self, communicator, *conversation_ids):
+        await communicator.send_json_to({'type': 'subscribe', 'conversation_ids': list(conversation_ids)})
+        return await communicator.receive_json_from()
+
+    def test_subscribe_skips_conversations_of_others(self):
+        async def run():
+            socket = await self.connect(self.client_user)
+            subscribed = await self.subscribe(socket, self.conversation.id, self.others.id)
+            denied = await socket.receive_json_from()
+            await socket.disconnect()
+            return subscribed, denied
+
+        subscribed, denied = async_to_sync(run)()
+        self.assertEqual(subscribed, {'type': 'subscribed', 'conversation_ids': [self.conversation.id]})
+        self.assertEqual(denied['type'], 'error')
+        self.assertEqual(denied['conversation_ids'], [self.others.id])
+
+    def test_sending_to_an_unsubscribed_conversation_is_refused(self):
+        async def run():
+            socket = await self.connect(self.owner)
+            await self.subscribe(socket, self.conversation.id)
+            await socket.send_json_to({'type': 'send_message', 'conversation_id': self.others.id, 'content': 'Hi'})
+            reply = await socket.receive_json_from()
+            await socket.disconnect()
+            return reply
+
+        reply = async_to_sync(run)()
+        self.assertEqual(reply, {
+            'type': 'error', 'conversation_id': self.others.id, 'error': 'Not subscribed to this conversation',
+        })
+        self.assertFalse(Message.objects.exists())
+
+    def test_unsubscribe_stops_messages_and_typing(self):
+        async def run():
+            owner, client = await self.connect(self.owner), await self.connect(self.client_user)
+            await self.subscribe(owner, self.conversation.id)
+            await self.subscribe(client, self.conversation.id)
+
+            # The client was typing when it unsubscribed: the owner is told it stopped
+            await client.send_json_to({'type': 'typing', 'conversation_id': self.conversation.id, 'is_typing': True})
+            started = await owner.receive_json_from()
+            await client.send_json_to({'type': 'unsubscribe', 'conversation_ids': [self.conversation.id]})
+            unsubscribed = await client.receive_json_from()
+            stopped = await owner.receive_json_from(timeout=3)
+
+            await owner.send_json_to({'type': 'typing', 'conversation_id': self.conversation.id, 'is_typing': True})
+            await owner.send_json_to({'type': 'send_message', 'conversation_id': self.conversation.id, 'content': 'Hi'})
+            echoed = await owner.receive_json_from()
+            client_got_nothing = await client.receive_nothing(timeout=0.3)
+            await owner.disconnect()
+            await client.disconnect()
+            return started, unsubscribed, stopped, echoed, client_got_nothing
+
+        started, unsubscribed, stopped, echoed, client_got_nothing = async_to_sync(run)()
+        self.assertEqual((started['type'], started['is_typing']), ('typing', True))
+        self.assertEqual(unsubscribed, {'type': 'unsubscribed', 'conversation_ids': [self.conversation.id]})
+        self.assertEqual((stopped['type'], stopped['user_id'], stopped['is_typing']), ('typing', self.client_user.id, False))
+        self.assertEqual((echoed['type'], echoed['message']['content']), ('message', 'Hi'))
+        self.assertTrue(client_got_nothing)
+
+    @override_settings(MESSAGING_WS_MAX_SUBSCRIPTIONS=2)
+    def test_subscriptions_are_limited(self):
+        extra = create_conversation(self.conversation.ad, self.client_user, self.owner)
+
+        async def run():
+            socket = await self.connect(self.owner)
+            await self.subscribe(socket, self.conversation.id, self.others.id)
+            refused = await self.subscribe(socket, extra.id)
+            await socket.send_json_to({'type': 'send_message', 'conversation_id': extra.id, 'content': 'Hi'})
+            not_subscribed = await socket.receive_json_from()
+            await socket.disconnect()
+            return refused, not_subscribed
+
+        refused, not_subscribed = async_to_sync(run)()
+        self.assertEqual(refused, {'type': 'error', 'error': 'At most 2 conversations per socket'})
+        self.assertEqual(not_subscribed['error'], 'Not subscribed to this conversation')
+
+
+class RedisConnectionTests(SimpleTestCase):
+
+    async def serve(self, handle, test):
+        """Run test(connection) against a server calling handle(commands, reader, writer) per connection"""
+        commands = []
+
+        async def client(reader, writer):
+            await handle(commands, reader, writer)
+            writer.close()
+
+        server = await asyncio.start_server(client, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        connection = RedisConnection(f'redis://127.0.0.1:{port}')
+        try:
+            await test(connection)
+        finally:
+            connection.close()
+            server.close()
+        return commands
+
+    def test_commands_are_not_sent_twice_when_the_connection_drops_after_the_write(self):
+        async def handle(commands, reader, writer):
+            # Runs the command, then goes away before replying
+            commands.append(await read_reply(reader))
+
+        async def test(connection):
+            with self.assertRaises(ConnectionError):
+                await connection.execute('PUBLISH', 'group.conversation_1', b'{}')
+
+        commands = asyncio.run(self.serve(handle, test))
+        self.assertEqual(commands, [[b'PUBLISH', b'group.conversation_1', b'{}']])
+
+    def test_connection_closed_by_the_server_is_reopened(self):
+        async def handle(commands, reader, writer):
+            # Answers one command per connection, like a server restarting in between
+            commands.append(await read_reply(reader))
+            writer.write(b':1\r\n')
+            await writer.drain()
+
+        async def test(connection):
+            self.assertEqual(await connection.execute('PUBLISH', 'a', b'1'), 1)
+            await asyncio.sleep(0.05)
+            self.assertEqual(await connection.execute('PUBLISH', 'b', b'2'), 1)
+
+        commands = asyncio.run(self.serve(handle, test))
+        self.assertEqual(commands, [[b'PUBLISH', b'a', b'1'], [b'PUBLISH', b'b', b'2']])
+
+
+class RecordingLayer:
+    """Channel layer stand-in recording (time, message) of every group send"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((asyncio.get_running_loop().time(), message))
+
+
+class TypingCoalescerTests(SimpleTestCase):
+    interval = 0.05
+    timeout = 0.2
+
+    def setUp(self):
+        self.coalescer = TypingCoalescer(lambda conversation_id: f'conversation_{conversation_id}', self.interval * 1000, self.timeout)
+        self.layer = RecordingLayer()
+        self.user = SimpleNamespace(id=1, name='User 1')
+
+    def broadcasts(self):
+        return [message['is_typing'] for _, message in self.layer.sent]
+
+    async def typing(self, is_typing, channel_name='socket-1'):
+        await self.coalescer.update(self.layer, 7, self.user, is_typing, channel_name)
+
+    async def settle(self):
+        await asyncio.sleep(self.timeout + self.interval * 2)
+
+    def test_a_typing_burst_is_broadcast_as_started_then_stopped(self):
+        async def burst():
+            for _ in range(20):
+                await self.typing(True)
+                await asyncio.sleep(0.005)
+            await self.typing(False)
+            await self.settle()
+
+        asyncio.run(burst())
+        self.assertEqual(self.broadcasts(), [True, False])
+        self.assertEqual(self.layer.sent[0][1]['conversation_id'], 7)
+        self.assertEqual(self.coalescer.states, {})
+        self.assertEqual(self.coalescer.tasks, set())
+
+    def test_broadcasts_are_changes_at_least_an_interval_apart(self):
+        async def flap():
+            for i in range(40):
+                await self.typing(i % 3 != 2)
+                await asyncio.sleep(self.interval / 8)
+            await self.typing(False)
+            await self.settle()
+
+        asyncio.run(flap())
+        broadcasts = self.broadcasts()
+        self.assertLessEqual(len(broadcasts), 40 / 8 + 2)
+        self.assertEqual(broadcasts[-1], False)
+        for previous, current in zip(self.layer.sent, self.layer.sent[1:]):
+            self.assertNotEqual(previous[1]['is_typing'], current[1]['is_typing'])
+            self.assertGreaterEqual(current[0] - previous[0], self.interval - 0.005)
+
+    def test_silent_typing_expires(self):
+        async def go_silent():
+            await self.typing(True)
+            await asyncio.sleep(self.timeout / 2)
+            self.assertEqual(self.broadcasts(), [True])
+            await self.settle()
+
+        asyncio.run(go_silent())
+        self.assertEqual(self.broadcasts(), [True, False])
+        self.assertEqual(self.coalescer.expired, 1)
+        self.assertEqual(self.coalescer.states, {})
+
+    def test_user_is_typing_while_any_of_their_sockets_is(self):
+        async def two_sockets():
+            await self.typing(True, 'socket-1')
+            await self.typing(True, 'socket-2')
+            # One tab closes while the other is still typing
+            await self.coalescer.stop(self.user.id, [7], 'socket-1')
+            await asyncio.sleep(self.interval * 2)
+            self.assertEqual(self.broadcasts(), [True])
+
+            await self.coalescer.stop(self.user.id, [7], 'socket-2')
+            await self.settle()
+
+        asyncio.run(two_sockets())
+        self.assertEqual(self.broadcasts(), [True, False])
+
+    def test_only_silent_sockets_expire(self):
+        async def one_silent_socket():
+            await self.typing(True, 'silent')
+            for _ in range(int(self.timeout * 2 / 0.02)):
+                await self.typing(True, 'busy')
+                await asyncio.sleep(0.02)
+            self.assertEqual(self.broadcasts(), [True])
+            self.assertEqual(self.coalescer.expired, 1)
+            await self.typing(False, 'busy')
+            await self.settle()
+
+        asyncio.run(one_silent_socket())
+        self.assertEqual(self.broadcasts(), [True, False])
+
+
+class WriteBehindCheckTests(SimpleTestCase):
+
+    @override_settings(MESSAGING_WRITE_BEHIND=True)
+    def test_unsupported_database_fails_the_system_check(self):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            self.assertEqual([error.id for error in check_write_behind_database(None)], ['messaging.E001'])
+        self.assertEqual(check_write_behind_database(None), [])
+
+    @override_settings(MESSAGING_WRITE_BEHIND=False)
+    def test_check_passes_with_write_behind_off(self):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            self.assertEqual(check_write_behind_database(None), [])
+
+
+@skipIf(write_behind.fcntl is None, 'Live journals are told apart by their file lock')
+class WriteBehindRecoveryTests(TransactionTestCase):
+
+    def setUp(self):
+        self.owner, self.client_user = create_user(1), create_user(2)
+        ad_type = AdType.objects.create(name='Plumbing')
+        ad = Ad.objects.create(title='Plumber', description='', ad_type=ad_type, cost='50', user=self.owner)
+        self.conversation = create_conversation(ad, self.client_user, self.owner)
+        self.directory = tempfile.mkdtemp(prefix='message-journal-')
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def send(self, senders, count):
+        """Journal and "broadcast" count messages through a write-behind that never gets to flush"""
+        queue = MessageWriteBehind(directory=self.directory, interval_ms=3600 * 1000, batch_size=count + 1, fsync=False)
+
+        async def send_all():
+            return await asyncio.gather(*(
+                queue.post(
+                    senders[i % len(senders)], self.conversation.id, f'Message {i}',
+                    f'https://example.com/{i}.jpg' if i % 3 == 0 else None,
+                )
+                for i in range(count)
+            ))
+        return queue, async_to_sync(send_all)()
+
+    def crash(self, queue):
+        """Die without flushing: the journal stays, unlocked, with a torn half line at the end"""
+        os.close(queue.journal.fd)
+        with open(queue.journal.path, 'ab') as journal:
+            journal.write(b'{"id": 1, "conversation_id"')
+        return queue.journal.path
+
+    def test_recovery_inserts_every_broadcast_message_once(self):
+        queue, payloads = self.send([self.client_user, self.owner], 20)
+        ids = [payload['id'] for payload in payloads]
+        self.assertFalse(Message.objects.filter(id__in=ids).exists())
+        # The writer is alive and holds its journal
+        self.assertEqual(recover_journals(self.directory), (0, 0))
+
+        path = self.crash(queue)
+        with open(path, 'rb') as journal:
+            contents = journal.read()
+        self.assertEqual(recover_journals(self.directory), (1, 20))
+        self.assertEqual(os.listdir(self.directory), [])
+
+        stored = Message.objects.filter(id__in=ids).select_related('sender').prefetch_related('attachments').in_bulk()
+        self.assertEqual([MessageSerializer(stored[message_id]).data for message_id in ids], payloads)
+        self.assertEqual(conversation_unread_count(self.conversation.id, self.owner), 10)
+        self.assertEqual(conversation_unread_count(self.conversation.id, self.client_user), 10)
+        self.assertEqual(check_unread_counts([self.conversation.id]), [])
+        newest = max(payloads, key=lambda payload: (payload['created_at'], payload['id']))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, newest['id'])
+        self.assertEqual(rebuild_last_messages([self.conversation.id]), [])
+
+        # Replaying the same journal again inserts and counts nothing
+        with open(path, 'wb') as journal:
+            journal.write(contents)
+        self.assertEqual(recover_journals(self.directory), (1, 0))
+        self.assertEqual(Message.objects.filter(conversation=self.conversation).count(), 20)
+        self.assertEqual(conversation_unread_count(self.conversation.id, self.owner), 10)
+        self.assertEqual(check_unread_counts([self.conversation.id]), [])
+
+    def test_messages_read_before_they_are_inserted_are_not_counted(self):
+        queue, payloads = self.send([self.client_user], 3)
+        # The owner saw the broadcast and opened the conversation before the flush
+        mark_read(self.conversation, self.owner)
+
+        self.crash(queue)
+        self.assertEqual(recover_journals(self.directory), (1, 3))
+        self.assertEqual(conversation_unread_count(self.conversation.id, self.owner), 0)
+        self.assertFalse(Message.objects.filter(conversation=self.conversation, is_read=False).exists())
+        self.assertEqual(check_unread_counts([self.conversation.id]), [])
+
+        create_message(self.conversation, self.client_user, 'Still there?')
+        self.assertEqual(conversation_unread_count(self.conversation.id, self.owner), 1)
+
+    def test_non_participants_cant_post(self):
+        outsider = create_user(3)
+        queue = MessageWriteBehind(directory=self.directory, interval_ms=3600 * 1000, batch_size=5, fsync=False)
+        with self.assertRaisesMessage(ValueError, 'not allowed'):
+            async_to_sync(queue.post)(outsider, self.conversation.id, 'Hi')
+        with self.assertRaisesMessage(ValueError, 'not allowed'):
+            async_to_sync(queue.post)(self.owner, self.conversation.id + 1, 'Hi')
+        # Nothing was journaled and no id was reserved
+        self.assertEqual(queue.pending, [])
+        self.assertEqual(queue.ids[Message], [])
+
+    def test_sender_is_told_when_a_message_is_dropped(self):
+        other = create_conversation(self.conversation.ad, self.client_user, self.owner)
+        other_id = other.id
+        queue = MessageWriteBehind(directory=self.directory, interval_ms=3600 * 1000, batch_size=5, fsync=False)
+        channel_layer = InMemoryChannelLayer()
+
+        async def send_then_flush():
+            reply_channel = await channel_layer.new_channel()
+            kept = await queue.post(self.client_user, self.conversation.id, 'Hi', reply_channel=reply_channel)
+            dropped = await queue.post(self.client_user, other_id, 'Hi', reply_channel=reply_channel)
+            # Deleted after the broadcast, before the flush
+            await database_sync_to_async(other.delete)()
+            await queue.flush()
+            return kept, dropped, await asyncio.wait_for(channel_layer.receive(reply_channel), 5)
+
+        with mock.patch.object(write_behind, 'get_channel_layer', return_value=channel_layer), \
+                self.assertLogs('messaging.write_behind', 'WARNING'):
+            kept, dropped, event = async_to_sync(send_then_flush)()
+        self.assertEqual(event, {'type': 'message_failed', 'conversation_id': other_id, 'message_id': dropped['id']})
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [kept['id']])
+        self.assertEqual(queue.pending, [])
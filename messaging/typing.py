@@ -0,0 +1,171 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+"""
+TYPING INDICATOR COALESCING:
+
+    Clients send a typing frame on every keystroke, and each one used to be a group_send to the conversation.
+    TypingCoalescer sits between the consumers and the channel layer, per (conversation, user):
+        - Only changes are broadcast: repeated "typing" frames while the user is already shown as typing (or
+          "stopped" while shown as stopped) are dropped
+        - At most one broadcast per MESSAGING_TYPING_MIN_INTERVAL_MS. A change inside the interval is sent when it
+          ends, with whatever the latest state is by then, so typing/stopped flapping collapses to nothing
+        - A user is shown as typing while at least one of their sockets (channels) is typing. A socket that sends
+          no typing frame for MESSAGING_TYPING_TIMEOUT_SECONDS (closed the app, lost the connection, a client that
+          never sends "stopped") stops typing, same when it disconnects; "stopped" is broadcast once none is left
+    So a typing burst costs two broadcasts (started, stopped) however many keystrokes it has, and a conversation
+    never gets more than one typing broadcast per user per interval. State is per process: a user typing on two
+    workers at once is coalesced per worker. manage.py benchmark_typing replays keystroke traffic through it.
+"""
+
+
+class TypingState:
+    """Typing status of one user in one conversation"""
+
+    def __init__(self, channel_layer, conversation_id, user_id, user_name):
+        self.channel_layer = channel_layer
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.user_name = user_name
+        # The user's typing sockets (channel name -> time of their last typing frame), and what the conversation
+        # was last told
+        self.typing_channels = {}
+        self.broadcast = False
+        self.sent_at = None
+        self.flush_timer = None
+        self.expiry_timer = None
+
+    @property
+    def wanted(self):
+        return bool(self.typing_channels)
+
+
+class TypingCoalescer:
+
+    def __init__(self, group_name, interval_ms=None, timeout_seconds=None):
+        self.group_name = group_name
+        self.interval = (
+            interval_ms if interval_ms is not None else getattr(settings, 'MESSAGING_TYPING_MIN_INTERVAL_MS', 1000)
+        ) / 1000
+        self.timeout = (
+            timeout_seconds if timeout_seconds is not None else getattr(settings, 'MESSAGING_TYPING_TIMEOUT_SECONDS', 5)
+        )
+        self.states = {}
+        self.tasks = set()
+
+        self.updates = 0
+        self.broadcasts = 0
+        self.expired = 0
+
+    async def update(self, channel_layer, conversation_id, user, is_typing, channel_name):
+        """A typing frame from the client on channel_name"""
+        self.updates += 1
+        key = (conversation_id, user.id)
+        state = self.states.get(key)
+        if state is None:
+            if not is_typing:
+                # Not shown as typing, nothing to stop
+                return
+            state = self.states[key] = TypingState(channel_layer, conversation_id, user.id, user.name)
+
+        if is_typing:
+            state.typing_channels[channel_name] = asyncio.get_running_loop().time()
+            if state.expiry_timer is None:
+                state.expiry_timer = asyncio.get_running_loop().call_later(self.timeout, self.expire, key, state)
+        else:
+            state.typing_channels.pop(channel_name, None)
+        await self.sync(key, state)
+
+    async def stop(self, user_id, conversation_ids, channel_name):
+        """Stop a socket's typing in conversations, e.g. when it disconnects"""
+        for conversation_id in conversation_ids:
+            state = self.states.get((conversation_id, user_id))
+            if state is not None and channel_name in state.typing_channels:
+                del state.typing_channels[channel_name]
+                await self.sync((conversation_id, user_id), state)
+
+    async def sync(self, key, state):
+        """Broadcast the wanted state, now or as soon as the interval allows, unless it's what was broadcast last"""
+        if state.flush_timer is not None:
+            # A throttled broadcast is coming, it will send the latest state
+            return
+        if state.wanted == state.broadcast:
+            self.forget_if_idle(key, state)
+            return
+
+        loop = asyncio.get_running_loop()
+        if state.sent_at is not None and loop.time() < state.sent_at + self.interval:
+            state.flush_timer = loop.call_at(state.sent_at + self.interval, self.flush, key, state)
+            return
+
+        state.broadcast = state.wanted
+        state.sent_at = loop.time()
+        self.broadcasts += 1
+        await state.channel_layer.group_send(
+            self.group_name(state.conversation_id),
+            {
+                'type': 'typing_status',
+                'conversation_id': state.conversation_id,
+                'user_id': state.user_id,
+                'user_name': state.user_name,
+                'is_typing': state.broadcast
+            }
+        )
+        self.forget_if_idle(key, state)
+
+    def flush(self, key, state):
+        state.flush_timer = None
+        self.spawn(self.sync(key, state))
+
+    def expire(self, key, state):
+        state.expiry_timer = None
+        if not state.wanted:
+            return
+        # Re-armed lazily: typing frames only move their channel's time, the timer checks them when it fires
+        now = asyncio.get_running_loop().time()
+        for channel_name, typing_at in list(state.typing_channels.items()):
+            if typing_at + self.timeout <= now:
+                del state.typing_channels[channel_name]
+                self.expired += 1
+        if state.wanted:
+            remaining = min(state.typing_channels.values()) + self.timeout - now
+            state.expiry_timer = asyncio.get_running_loop().call_later(remaining, self.expire, key, state)
+            return
+        self.spawn(self.sync(key, state))
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Could not broadcast a typing status', exc_info=task.exception())
+
+    def forget_if_idle(self, key, state):
+        """Drop the state of a user shown as stopped once nothing is scheduled for it"""
+        if state.wanted or state.broadcast or state.flush_timer is not None:
+            return
+        loop = asyncio.get_running_loop()
+        if state.sent_at is not None and loop.time() < state.sent_at + self.interval:
+            # Kept until the interval is over, so a new typing burst right away is throttled too
+            state.flush_timer = loop.call_at(state.sent_at + self.interval, self.flush, key, state)
+            return
+        if state.expiry_timer is not None:
+            state.expiry_timer.cancel()
+            state.expiry_timer = None
+        if self.states.get(key) is state:
+            del self.states[key]
+
+    def stats(self):
+        return {
+            'typing': len(self.states),
+            'updates': self.updates,
+            'broadcasts': self.broadcasts,
+            'expired': self.expired,
+        }
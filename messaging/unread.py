@@ -0,0 +1,140 @@
+from django.db import transaction
+from django.db.models import Count, F, Q, Subquery, Sum
+from django.utils import timezone
+
+from .models import Conversation, ConversationParticipant, ConversationReadState, Message
+
+"""
+UNREAD COUNTERS:
+
+    The unread badges counted unread messages with a COUNT over Message joined to the participants table on
+    every poll. ConversationReadState keeps a running unread_count per (conversation, participant) instead,
+    so a badge is one row read and the total is one SUM over the user's rows:
+        - Rows are created when participants are added to a conversation (see messaging/signals.py)
+        - create_message adds 1 for every participant but the sender, in the message's transaction, with F()
+          so concurrent messages don't lose updates
+        - mark_read zeroes the reader's counter and remembers the last message they read and when. The counter
+          is reset before the messages are flagged read, so a message sent meanwhile is either flagged or counted.
+          Write-behind messages are broadcast before they're inserted: those sent before the reader's last
+          mark_read are inserted read and not counted (see write_behind.persist_entries)
+        - unread_counts reads the counters of a whole inbox at once, for the bulk endpoint and ?with_unread=1
+        - reconcile_unread_counts (management command) recomputes the counters from the Message table
+"""
+
+
+def ensure_read_states(conversation_id, user_ids):
+    """Create the missing read state rows of some participants of a conversation"""
+    ConversationReadState.objects.bulk_create(
+        [ConversationReadState(conversation_id=conversation_id, user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+
+
+def record_unread(conversation_id, sender_id, count=1):
+    """Count count new messages of a sender as unread for everyone else in the conversation"""
+    return ConversationReadState.objects.filter(
+        conversation_id=conversation_id
+    ).exclude(user_id=sender_id).update(unread_count=F('unread_count') + count)
+
+
+def record_read(conversation_id, user_id, count):
+    """Take back count messages counted unread for a user who had read them already"""
+    return ConversationReadState.objects.filter(
+        conversation_id=conversation_id, user_id=user_id, unread_count__gte=count
+    ).update(unread_count=F('unread_count') - count)
+
+
+def mark_read(conversation, user):
+    """Mark every message of a conversation read for a user and reset their counter"""
+    last_message = Conversation.objects.filter(id=conversation.id).values('last_message_id')
+    with transaction.atomic():
+        updated = ConversationReadState.objects.filter(conversation_id=conversation.id, user_id=user.id).update(
+            unread_count=0, last_read_message_id=Subquery(last_message), last_read_at=timezone.now()
+        )
+        if not updated:
+            ensure_read_states(conversation.id, [user.id])
+        Message.objects.filter(conversation_id=conversation.id, is_read=False).exclude(sender=user).update(is_read=True)
+
+
+def user_unread_count(user):
+    """Get the number of unread messages of a user over their active conversations, same as the unread_counts total"""
+    return ConversationReadState.objects.filter(user=user, conversation__is_active=True).aggregate(total=Sum('unread_count'))['total'] or 0
+
+
+def conversation_unread_count(conversation_id, user):
+    """Get a user's unread messages in a conversation, None if they have no read state there"""
+    return ConversationReadState.objects.filter(
+        conversation_id=conversation_id, user=user
+    ).values_list('unread_count', flat=True).first()
+
+
+def unread_counts(user, conversation_ids=None):
+    """Get {conversation id: unread count} for a user's active conversations (or only conversation_ids), in one query"""
+    states = ConversationReadState.objects.filter(user=user, conversation__is_active=True)
+    if conversation_ids is not None:
+        states = states.filter(conversation_id__in=conversation_ids)
+    return dict(states.order_by().values_list('conversation_id', 'unread_count'))
+
+
+def expected_unread_counts(conversation_ids=None):
+    """Get {(conversation id, user id): unread count} computed from the Message table"""
+    memberships = ConversationParticipant.objects.order_by()
+    if conversation_ids is not None:
+        memberships = memberships.filter(conversation_id__in=conversation_ids)
+
+    rows = memberships.annotate(
+        unread_count=Count(
+            'conversation__messages',
+            filter=Q(conversation__messages__is_read=False) & ~Q(conversation__messages__sender_id=F('user_id')),
+        )
+    ).values_list('conversation_id', 'user_id', 'unread_count')
+    return {(conversation_id, user_id): unread_count for conversation_id, user_id, unread_count in rows}
+
+
+def stored_unread_counts(conversation_ids=None):
+    """Get {(conversation id, user id): unread count} of the stored read states"""
+    states = ConversationReadState.objects.order_by()
+    if conversation_ids is not None:
+        states = states.filter(conversation_id__in=conversation_ids)
+    return {
+        (conversation_id, user_id): unread_count
+        for conversation_id, user_id, unread_count in states.values_list('conversation_id', 'user_id', 'unread_count')
+    }
+
+
+def check_unread_counts(conversation_ids=None):
+    """Get the (conversation id, user id) pairs whose stored counter is wrong or missing"""
+    expected = expected_unread_counts(conversation_ids)
+    stored = stored_unread_counts(conversation_ids)
+    return sorted(key for key in set(expected) | set(stored) if expected.get(key) != stored.get(key))
+
+
+def reconcile_unread_counts(conversation_ids=None):
+    """
+    Recompute unread counters from the Message table, for every conversation or only conversation_ids.
+    Returns the (conversation id, user id) pairs whose stored counter was wrong or missing
+    """
+    expected = expected_unread_counts(conversation_ids)
+    stored = stored_unread_counts(conversation_ids)
+    wrong = sorted(key for key in set(expected) | set(stored) if expected.get(key) != stored.get(key))
+
+    # Read states of users who are no longer participants
+    stale = Q(pk__in=[])
+    for conversation_id, user_id in wrong:
+        if (conversation_id, user_id) not in expected:
+            stale |= Q(conversation_id=conversation_id, user_id=user_id)
+    ConversationReadState.objects.filter(stale).delete()
+
+    repaired = [
+        ConversationReadState(conversation_id=conversation_id, user_id=user_id, unread_count=expected[conversation_id, user_id])
+        for conversation_id, user_id in wrong if (conversation_id, user_id) in expected
+    ]
+    if repaired:
+        ConversationReadState.objects.bulk_create(
+            repaired,
+            update_conflicts=True,
+            unique_fields=['conversation', 'user'],
+            update_fields=['unread_count'],
+            batch_size=1000,
+        )
+    return wrong
@@ -13,5 +13,6 @@ urlpatterns = [
     path('conversations/<int:conversation_id>/unread-count/', views.get_conversation_unread_count, name='conversation-unread-count'),
     path('conversations/with-user/<int:user_id>/ad/<int:ad_id>/', views.get_conversation_with_user, name='get-conversation-with-user'),
     path('conversations/unread-count/', views.get_unread_count, name='unread-count'),
+    path('conversations/unread-counts/', views.get_unread_counts, name='unread-counts'),
     
 ]
\ No newline at end of file
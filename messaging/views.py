@@ -4,15 +4,36 @@ from channels.layers import get_channel_layer
 from rest_framework import generics, status, permissions, serializers
 from rest_framework.decorators import api_view, permission_classes, parser_classes
 from rest_framework.response import Response
+from django.conf import settings
 from django.shortcuts import get_object_or_404
-from django.db.models import Q
+from django.db.models import Q, Prefetch
 from .models import Conversation, Message, MessageAttachment
 from .serializers import ConversationSerializer, MessageSerializer
+from .fast_serializers import serialize_conversations, serialize_messages
+from .inbox import create_message, inbox_memberships, inbox_page
+from .membership import is_participant
+from .unread import conversation_unread_count, mark_read, unread_counts, user_unread_count
+from ads.fast_serializers import fast_serializers_enabled
+from ads.querysets import ad_list_queryset, ad_summary_queryset
+from ads.search.pagination import InvalidCursor
 from supabase_auth.models import User
 from ads.models import Ad
 from rest_framework.parsers import MultiPartParser, FormParser
 from contractingo.supabase_client import supabase
 
+def expand_ad_requested(request):
+    """Whether the client asked for full ads instead of summaries in conversations (?expand=ad)"""
+    return 'ad' in request.GET.get('expand', '').split(',')
+
+def with_unread_requested(request):
+    """Whether the client asked for unread counts with the conversations (?with_unread=1 / true)"""
+    return request.GET.get('with_unread', '').lower() in ('1', 'true', 'yes')
+
+def with_conversation_ads(conversations, expand_ad):
+    """Load the ads of a page of conversations in one query: compact summaries, or full ads when expanded"""
+    ads = ad_list_queryset() if expand_ad else ad_summary_queryset()
+    return conversations.prefetch_related(Prefetch('ad', queryset=ads))
+
 # Generic view for GET and POST requests
 class ConversationListCreateView(generics.ListCreateAPIView):
     """
@@ -22,7 +43,57 @@ class ConversationListCreateView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Conversation.objects.filter(participants=self.request.user, is_active=True).prefetch_related('participants', 'ad', 'messages')
+        conversations = Conversation.objects.filter(participants=self.request.user, is_active=True).select_related('last_message__sender').prefetch_related('participants', 'last_message__attachments')
+        return with_conversation_ads(conversations, expand_ad_requested(self.request))
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'expand_ad': expand_ad_requested(self.request)}
+
+    def list(self, request, *args, **kwargs):
+        # Most recently active first, read off the (user, last activity) membership index
+        # Cursor mode (?cursor=, empty for the first page): one page of the inbox at a time
+        if 'cursor' in request.GET:
+            try:
+                limit = int(request.GET.get('limit', settings.MESSAGING_INBOX_PAGE_SIZE))
+            except ValueError:
+                return Response({
+                    'success': False,
+                    'error': 'limit must be a number'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            limit = min(max(limit, 1), settings.MESSAGING_INBOX_MAX_PAGE_SIZE)
+
+            try:
+                conversation_ids, next_cursor = inbox_page(request.user, request.GET.get('cursor'), limit)
+            except InvalidCursor:
+                return Response({
+                    'success': False,
+                    'error': 'Invalid cursor'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            return Response({
+                'success': True,
+                'data': self.serialize_inbox(conversation_ids),
+                'next_cursor': next_cursor,
+                'has_next': next_cursor is not None
+            })
+
+        conversation_ids = inbox_memberships(request.user).values_list('conversation_id', flat=True)
+        return Response(self.serialize_inbox(list(conversation_ids)))
+
+    def serialize_inbox(self, conversation_ids):
+        """Serialize conversations in the order of conversation_ids, with their unread counts if asked (?with_unread=1)"""
+        if fast_serializers_enabled():
+            data = serialize_conversations(conversation_ids, expand_ad_requested(self.request))
+        else:
+            conversations = self.get_queryset().in_bulk(conversation_ids)
+            ordered = [conversations[conversation_id] for conversation_id in conversation_ids if conversation_id in conversations]
+            data = self.get_serializer(ordered, many=True).data
+
+        if with_unread_requested(self.request):
+            counts = unread_counts(self.request.user, conversation_ids)
+            for conversation in data:
+                conversation['unread_count'] = counts.get(conversation['id'], 0)
+        return data
 
     def perform_create(self, serializer):
         ad_id = self.request.data.get('ad')
@@ -56,9 +127,13 @@ class ConversationDetailView(generics.RetrieveUpdateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Conversation.objects.filter(
+        conversations = Conversation.objects.filter(
             participants=self.request.user, is_active=True
-        ).prefetch_related('participants', 'ad', 'messages')
+        ).select_related('last_message__sender').prefetch_related('participants', 'last_message__attachments')
+        return with_conversation_ads(conversations, expand_ad_requested(self.request))
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'expand_ad': expand_ad_requested(self.request)}
 
 class MessageListCreateView(generics.ListCreateAPIView):
     """
@@ -79,6 +154,11 @@ class MessageListCreateView(generics.ListCreateAPIView):
         )
         # return all messaged in conversation
         return Message.objects.filter(conversation=conversation).order_by('created_at')
+
+    def list(self, request, *args, **kwargs):
+        if not fast_serializers_enabled():
+            return super().list(request, *args, **kwargs)
+        return Response(serialize_messages(self.get_queryset().values_list('id', flat=True)))
     
     # POST /conversation/[conversation_id]/messages/{content}
     def create(self, request, *args, **kwargs):
@@ -95,18 +175,14 @@ class MessageListCreateView(generics.ListCreateAPIView):
             }, status=status.HTTP_404_NOT_FOUND)
         
         # Check if user is participant
-        if request.user not in conversation.participants.all():
+        if not is_participant(conversation.id, request.user.id):
             return Response({
                 'success': False,
                 'error': 'You are not a participant in this conversation'
             }, status=status.HTTP_403_FORBIDDEN)
         
-        # Create message
-        message = Message.objects.create(
-            conversation=conversation,
-            sender=request.user,
-            content=content
-        )
+        # Create message, and make it the conversation's last message
+        message = create_message(conversation, request.user, content)
 
         # If image is provided, create message attachment
         if image_file:
@@ -140,6 +216,7 @@ class MessageListCreateView(generics.ListCreateAPIView):
             conversation_group_name,
             {
                 'type': 'conversation_message',
+                'conversation_id': conversation.id,
                 'message': serializer.data,
                 'sender_id': request.user.id
             }
@@ -161,7 +238,7 @@ def mark_as_read(request, conversation_id):
         id=conversation_id
     )
 
-    Message.objects.filter(conversation=conversation).exclude(sender=request.user).update(is_read=True)
+    mark_read(conversation, request.user)
 
     return Response({'success': True})
 
@@ -183,40 +260,50 @@ def get_conversation_with_user(request, user_id, ad_id):
         conversation = Conversation.objects.create(ad=ad)
         conversation.participants.add(request.user, other_user)
     
-    serializer = ConversationSerializer(conversation)
+    serializer = ConversationSerializer(conversation, context={'expand_ad': expand_ad_requested(request)})
     return Response(serializer.data)
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def get_unread_count(request):
     """
-    Get count of unread messages for the current user
+    Get count of unread messages for the current user, over their active conversations
     """
-    unread_count = Message.objects.filter(
-        conversation__participants=request.user,
-        is_read=False
-    ).exclude(sender=request.user).count()
+    unread_count = user_unread_count(request.user)
     
     return Response({
         'success': True,
         'unread_count': unread_count
         })
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def get_unread_counts(request):
+    """
+    Get unread message counts of all the current user's active conversations, {conversation id: count}
+    """
+    counts = unread_counts(request.user)
+
+    return Response({
+        'success': True,
+        'unread_counts': counts,
+        'total': sum(counts.values())
+        })
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def get_conversation_unread_count(request, conversation_id):
     """
     Get count of unread messages for a specific conversation
     """
-    conversation = get_object_or_404(
-        Conversation.objects.filter(participants=request.user),
-        id=conversation_id
-    )
-
-    unread_count = Message.objects.filter(
-        conversation=conversation,
-        is_read=False
-    ).exclude(sender=request.user).count()
+    # Only participants have a read state, so its row doubles as the access check
+    unread_count = conversation_unread_count(conversation_id, request.user)
+    if unread_count is None:
+        get_object_or_404(
+            Conversation.objects.filter(participants=request.user),
+            id=conversation_id
+        )
+        unread_count = 0
     return Response({
         'success': True,
         'unread_count': unread_count}
@@ -0,0 +1,419 @@
+import asyncio
+import glob
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils import timezone
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from contractingo.fast_json import dumps_bytes, loads
+from supabase_auth.models import User
+from .inbox import record_messages
+from .membership import membership_cache, query_participant
+from .models import Conversation, ConversationReadState, Message, MessageAttachment
+from .serializers import MessageSerializer
+from .unread import record_read
+
+logger = logging.getLogger(__name__)
+
+"""
+WRITE-BEHIND MESSAGE PERSISTENCE:
+
+    Every websocket send_message took two thread pool hops (insert the message, then serialize it) before it
+    was broadcast, so chat bursts queued up behind the database. With MESSAGING_WRITE_BEHIND on, the consumer
+    hands the message to MessageWriteBehind instead:
+        - The sender's membership of the conversation is checked first (from the membership cache when it can),
+          nothing is journaled or broadcast for a conversation the sender can't post to
+        - Message and attachment ids are reserved from the database in blocks (the table's own sequence), and
+          created_at is set right away, so the broadcast payload is final and the same as a later read
+        - The message is appended to this process' journal file and broadcast as soon as the journal is on disk.
+          Concurrent messages share one fsync (group commit)
+        - A flusher inserts the pending messages every MESSAGING_WRITE_BEHIND_INTERVAL_MS, or as soon as
+          MESSAGING_WRITE_BEHIND_BATCH are waiting, with bulk_create plus the last message, activity and unread
+          updates of the whole batch (record_messages) in one transaction. A message that can't be inserted
+          (its conversation was deleted meanwhile, or the row is rejected) is dropped, and its sender's socket gets
+          a message_failed event
+
+    Durability: a message is only broadcast once it's in the journal (fsynced unless MESSAGING_WRITE_BEHIND_FSYNC
+    is off, then it survives a crashed process but not a crashed machine). If the process dies before the
+    flush, the journal stays behind, locked by nobody. recover_journals, run when a process starts its
+    write-behind and by manage.py recover_message_journal, inserts what's missing with the original ids and
+    times. Inserting is idempotent (rows already there are skipped), so a journal can be replayed any number of
+    times. Messages of conversations or senders deleted in the meantime are dropped. Until the flush, REST reads
+    don't see the message yet (at most one interval behind the broadcast), and a recipient can mark the
+    conversation read before it exists: messages sent before a recipient's last mark_read are inserted read and
+    not counted as unread for them.
+
+    Ids are reserved with database specific SQL, PostgreSQL and SQLite only (the messaging.E001 system check
+    fails on other databases when MESSAGING_WRITE_BEHIND is on).
+
+    manage.py check_write_behind crashes a writer process on purpose and checks the recovery.
+"""
+
+JOURNAL_ROTATE_LINES = 10000
+
+# Databases reserve_ids knows how to reserve ids from
+WRITE_BEHIND_VENDORS = ('postgresql', 'sqlite')
+
+
+def write_behind_enabled():
+    return getattr(settings, 'MESSAGING_WRITE_BEHIND', False)
+
+
+def reserve_ids(model, count):
+    """
+    Reserve count primary keys from model's id sequence, for rows inserted later with explicit ids.
+    The database is one of WRITE_BEHIND_VENDORS, checked at startup (see messaging/checks.py)
+    """
+    table = model._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", [table, count])
+            return [row[0] for row in cursor.fetchall()]
+
+        # SQLite
+        cursor.execute('UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s RETURNING seq', [count, table])
+        row = cursor.fetchone()
+        if row is None:
+            # No row has been inserted into the table yet
+            cursor.execute(
+                f'INSERT INTO sqlite_sequence (name, seq) SELECT %s, COALESCE(MAX(id), 0) + %s FROM {connection.ops.quote_name(table)}',
+                [table, count],
+            )
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            row = cursor.fetchone()
+        return list(range(row[0] - count + 1, row[0] + 1))
+
+
+# Journal
+
+class MessageJournal:
+    """Append-only file of the messages of one process that may not be in the database yet, one JSON line each"""
+
+    def __init__(self, directory, fsync=True):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'messages-{os.getpid()}-{uuid.uuid4().hex}.jsonl')
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        if fcntl is not None:
+            # Held for the life of the process: recover_journals leaves locked journals alone
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.fsync = fsync
+        self.lines = 0
+        self.outstanding = 0
+        self.written = 0
+        self.synced = 0
+        self.syncing = None
+
+    def append(self, entry):
+        """Write an entry, returns its position for sync()"""
+        os.write(self.fd, dumps_bytes(entry) + b'\n')
+        self.lines += 1
+        self.outstanding += 1
+        self.written += 1
+        return self.written
+
+    async def sync(self, position):
+        """Wait until the entry at position is on disk. One fsync covers every entry written before it started"""
+        if not self.fsync:
+            return
+        while self.synced < position:
+            if self.syncing is None:
+                self.syncing = asyncio.ensure_future(self.sync_written())
+            await asyncio.shield(self.syncing)
+
+    async def sync_written(self):
+        try:
+            written = self.written
+            await asyncio.to_thread(os.fsync, self.fd)
+            self.synced = max(self.synced, written)
+        finally:
+            self.syncing = None
+
+    def truncate(self):
+        """Empty the journal, once everything in it is in the database"""
+        os.ftruncate(self.fd, 0)
+        self.lines = 0
+
+    def remove(self):
+        os.close(self.fd)
+        os.remove(self.path)
+
+
+def read_journal(fd):
+    """Read the entries of a journal, skipping a torn last line left by a crash mid-write"""
+    chunks = []
+    while True:
+        chunk = os.read(fd, 1 << 20)
+        if not chunk:
+            break
+        chunks.append(chunk)
+
+    entries = []
+    for line in b''.join(chunks).split(b'\n'):
+        if not line:
+            continue
+        try:
+            entries.append(loads(line))
+        except ValueError:
+            logger.warning('Skipping a torn message journal line')
+    return entries
+
+
+def recover_journals(directory):
+    """
+    Insert the messages of journals left behind by dead processes and delete the journals.
+    Journals still locked by a live process are skipped. Without file locks (Windows) every journal counts as
+    left behind, so only run it with the workers stopped there. Returns (journals recovered, messages inserted)
+    """
+    journals = inserted = 0
+    for path in sorted(glob.glob(os.path.join(directory, 'messages-*.jsonl'))):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+            inserted += persist_batch(read_journal(fd))
+            os.remove(path)
+            journals += 1
+        finally:
+            os.close(fd)
+    return journals, inserted
+
+
+# Database
+
+def entry_created_at(entry):
+    return datetime.fromisoformat(entry['created_at'])
+
+
+def persist_entries(entries, dropped=None):
+    """
+    Insert the journaled messages (and attachments) that aren't in the database yet, and apply them to their
+    conversations, in one transaction. Returns how many messages were inserted, the ids of the messages that
+    can't be inserted are appended to dropped
+    """
+    if not entries:
+        return 0
+
+    with transaction.atomic():
+        existing = set(Message.objects.filter(id__in=[entry['id'] for entry in entries]).values_list('id', flat=True))
+        entries = [entry for entry in entries if entry['id'] not in existing]
+        conversations = set(Conversation.objects.filter(
+            id__in={entry['conversation_id'] for entry in entries}
+        ).values_list('id', flat=True))
+        senders = set(User.objects.filter(id__in={entry['sender_id'] for entry in entries}).values_list('id', flat=True))
+
+        messages, attachments = [], []
+        for entry in entries:
+            if entry['conversation_id'] not in conversations or entry['sender_id'] not in senders:
+                logger.warning('Dropping message %s, its conversation or sender was deleted', entry['id'])
+                if dropped is not None:
+                    dropped.append(entry['id'])
+                continue
+            messages.append(Message(
+                id=entry['id'],
+                conversation_id=entry['conversation_id'],
+                sender_id=entry['sender_id'],
+                content=entry['content'],
+                created_at=entry_created_at(entry),
+            ))
+            for attachment in entry['attachments']:
+                attachments.append(MessageAttachment(
+                    id=attachment['id'],
+                    message_id=entry['id'],
+                    image_url=attachment['image_url'],
+                    created_at=entry_created_at(entry),
+                ))
+
+        # The messages were broadcast before they existed here: recipients who marked their conversation read
+        # after one was sent have read it. Locking the read states makes a mark_read running meanwhile wait for
+        # this batch, it then flags the batch read itself
+        read_at = {}
+        read_states = ConversationReadState.objects.select_for_update().filter(
+            conversation_id__in={message.conversation_id for message in messages}
+        ).order_by('id').values_list('conversation_id', 'user_id', 'last_read_at')
+        for conversation_id, user_id, last_read_at in read_states:
+            if last_read_at is not None:
+                read_at.setdefault(conversation_id, []).append((user_id, last_read_at))
+        already_read = {}
+        for message in messages:
+            for user_id, last_read_at in read_at.get(message.conversation_id, ()):
+                if user_id != message.sender_id and last_read_at >= message.created_at:
+                    message.is_read = True
+                    key = (message.conversation_id, user_id)
+                    already_read[key] = already_read.get(key, 0) + 1
+
+        Message.objects.bulk_create(messages, batch_size=500)
+        MessageAttachment.objects.bulk_create(attachments, batch_size=500)
+        record_messages(messages)
+        for (conversation_id, user_id), count in already_read.items():
+            record_read(conversation_id, user_id, count)
+    return len(messages)
+
+
+def persist_batch(entries, dropped=None):
+    """persist_entries, falling back to one message at a time so one bad row can't hold back the rest"""
+    try:
+        return persist_entries(entries, dropped)
+    except (IntegrityError, DataError):
+        if len(entries) == 1:
+            logger.exception('Dropping message %s, it cannot be inserted', entries[0]['id'])
+            if dropped is not None:
+                dropped.append(entries[0]['id'])
+            return 0
+    return sum(persist_batch([entry], dropped) for entry in entries)
+
+
+# Write-behind queue
+
+class MessageWriteBehind:
+    """The per-process write-behind queue of websocket messages"""
+
+    def __init__(self, directory=None, interval_ms=None, batch_size=None, fsync=None):
+        self.directory = directory or settings.MESSAGING_WRITE_BEHIND_DIR
+        self.interval = (interval_ms if interval_ms is not None else settings.MESSAGING_WRITE_BEHIND_INTERVAL_MS) / 1000
+        self.batch_size = batch_size or settings.MESSAGING_WRITE_BEHIND_BATCH
+        self.fsync = settings.MESSAGING_WRITE_BEHIND_FSYNC if fsync is None else fsync
+        self.ids = {Message: [], MessageAttachment: []}
+        self.id_locks = {Message: asyncio.Lock(), MessageAttachment: asyncio.Lock()}
+        self.start_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.pending = []
+        self.journal = None
+        self.flush_task = None
+
+    async def start(self):
+        async with self.start_lock:
+            if self.flush_task is not None:
+                return
+            self.journal = MessageJournal(self.directory, self.fsync)
+            # Messages journaled by processes that died before flushing them
+            journals, inserted = await database_sync_to_async(recover_journals)(self.directory)
+            if journals:
+                logger.warning('Recovered %s messages from %s message journals', inserted, journals)
+            self.flush_task = asyncio.create_task(self.flush_forever())
+
+    async def take_id(self, model):
+        async with self.id_locks[model]:
+            if not self.ids[model]:
+                self.ids[model] = await database_sync_to_async(reserve_ids)(model, self.batch_size)
+            return self.ids[model].pop(0)
+
+    async def post(self, sender, conversation_id, content, image_url=None, reply_channel=None):
+        """
+        Journal a new message and get its MessageSerializer output, ready to broadcast. It's inserted later, if that
+        fails reply_channel (the sender's channel) gets a message_failed event.
+        Raises ValueError when the sender isn't a participant of the conversation
+        """
+        image_field = MessageAttachment._meta.get_field('image_url')
+        if image_url and len(image_url) > image_field.max_length:
+            raise ValueError(f'image_url is longer than {image_field.max_length} characters')
+
+        conversation_id = int(conversation_id)
+        is_member = membership_cache.get(conversation_id, sender.id)
+        if is_member is None:
+            is_member = await database_sync_to_async(query_participant)(conversation_id, sender.id)
+        if not is_member:
+            raise ValueError('You are not allowed to access this conversation')
+        await self.start()
+
+        entry = {
+            'id': await self.take_id(Message),
+            'conversation_id': conversation_id,
+            'sender_id': sender.id,
+            'content': content or '',
+            'created_at': timezone.now().isoformat(),
+            'attachments': [{'id': await self.take_id(MessageAttachment), 'image_url': image_url}] if image_url else [],
+        }
+        journal = self.journal
+        position = journal.append(entry)
+        self.pending.append((entry, journal, reply_channel))
+        if journal.lines >= JOURNAL_ROTATE_LINES:
+            self.journal = MessageJournal(self.directory, self.fsync)
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+        await journal.sync(position)
+        return serialize_entry(entry, sender)
+
+    async def flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Insert everything pending. On database errors the messages stay pending and the next flush retries"""
+        batch = self.pending[:]
+        if not batch:
+            return
+        dropped = []
+        try:
+            await database_sync_to_async(persist_batch)([entry for entry, _, _ in batch], dropped)
+        except Exception:
+            logger.exception('Could not insert %s pending messages, retrying', len(batch))
+            return
+        del self.pending[:len(batch)]
+
+        if dropped:
+            await self.report_dropped([(entry, reply_channel) for entry, _, reply_channel in batch], set(dropped))
+
+        # Journals whose every message is in the database can go
+        for _, journal, _ in batch:
+            journal.outstanding -= 1
+        for journal in {journal for _, journal, _ in batch}:
+            if journal.outstanding == 0:
+                if journal is self.journal:
+                    journal.truncate()
+                else:
+                    journal.remove()
+
+    async def report_dropped(self, sent, dropped_ids):
+        """Tell the senders of dropped messages, their clients already showed the broadcast"""
+        channel_layer = get_channel_layer()
+        for entry, reply_channel in sent:
+            if entry['id'] not in dropped_ids or reply_channel is None:
+                continue
+            try:
+                await channel_layer.send(reply_channel, {
+                    'type': 'message_failed',
+                    'conversation_id': entry['conversation_id'],
+                    'message_id': entry['id'],
+                })
+            except Exception:
+                logger.exception('Could not tell %s that message %s was dropped', reply_channel, entry['id'])
+
+
+def serialize_entry(entry, sender):
+    """MessageSerializer output of a journaled message, without touching the database"""
+    created_at = entry_created_at(entry)
+    message = Message(
+        id=entry['id'], conversation_id=entry['conversation_id'], sender=sender,
+        content=entry['content'], created_at=created_at,
+    )
+    message._prefetched_objects_cache = {'attachments': [
+        MessageAttachment(id=attachment['id'], message=message, image_url=attachment['image_url'], created_at=created_at)
+        for attachment in entry['attachments']
+    ]}
+    return MessageSerializer(message).data
+
+
+message_write_behind = MessageWriteBehind()
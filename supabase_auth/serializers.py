@@ -1,5 +1,4 @@
 from rest_framework import serializers
-from django.db import models
 from .models import User
 
 
@@ -13,15 +12,9 @@ class UserSerializer(serializers.ModelSerializer):
     
     def get_average_rating(self, obj):
         """
-        Calculate the average rating for this user based on all reviews they received.
+        Get the average rating of the reviews this user received, from their rating stats row.
         Returns None if the user has no reviews.
         """
-        from ads.models import Review 
-        
-        reviews = Review.objects.filter(reviewee=obj)
-        if not reviews.exists():
-            return None
-        
-        average = reviews.aggregate(models.Avg('rating'))['rating__avg']
-        # Round to 1 decimal place
-        return round(average, 1) if average else None
+        from ads.ratings import user_average_rating
+
+        return user_average_rating(obj)